@@ -0,0 +1,200 @@
+import argparse
+import json
+import multiprocessing
+import os
+
+import matplotlib
+matplotlib.use('Agg') # render without a display. Must come before pyplot is first imported
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+import calculateIdles as ci
+import dayPlot as dp
+import instrument
+import multiSource
+import statAggregator as sa
+
+FIGURE_SIZE = (16, 9) # inches
+IDLE_ESTIMATE = 'conservative' # what idle frames plot
+SETTINGS_FILE = '.exportSettings.json' # in the output directory, the settings every file there was drawn with
+PLOT_ARGUMENTS = ('filename', 'min', 'max', 'sorted', 'format', 'invalid') # arguments that change what frames show
+
+
+def newFigure():
+    """
+    Returns a figure and axes laid out like flipThruPlotter()'s, with room for a legend on the right
+    """
+    fig = plt.figure(figsize=FIGURE_SIZE)
+    ax = fig.add_subplot(111)
+    box = ax.get_position()
+    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+    return fig, ax
+
+
+def renderFrame(job):
+    """
+    Inputs:
+    job - a (plotFunction, plots, kwargs, paths) tuple. plotFunction(curr_pos=0, plots=plots, ax=ax, **kwargs) draws
+    the frame, which is then saved to each of paths, in the format given by its extension
+
+    Runs in worker processes, so jobs only carry the data of their own frame
+    """
+    plotFunction, plots, kwargs, paths = job
+    fig, ax = newFigure()
+    plotFunction(curr_pos=0, plots=plots, ax=ax, **kwargs)
+    for path in paths:
+        fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return paths
+
+
+def loadSettings(directory):
+    """
+    Returns a dict from the absolute path of every file exported to directory to the settings it was drawn with, as
+    exportFrames() records them in SETTINGS_FILE
+    """
+    try:
+        with open(os.path.join(directory, SETTINGS_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError): # never exported to, or unreadable, so nothing counts as drawn with any settings
+        return {}
+
+
+def isUpToDate(paths, sourceTime, settings=None, drawnWith=None):
+    """
+    Returns whether every path exists and is newer than sourceTime, the modification time of the data it was drawn
+    from, and, if settings is given, was drawn with settings according to drawnWith, loadSettings()' output. If
+    sourceTime is None, existing is enough
+    """
+    for path in paths:
+        if not os.path.exists(path) or sourceTime is not None and os.path.getmtime(path) < sourceTime:
+            return False
+        if settings is not None and (drawnWith or {}).get(os.path.abspath(path)) != settings:
+            return False
+    return True
+
+
+def exportFrames(frames, directory, formats=('png',), workers=1, sourceTime=None, pdf=None, settings=None):
+    """
+    Inputs:
+    frames - a list of (name, plotFunction, plots, kwargs) tuples, one per figure, as for renderFrame()
+    directory - where to write one file per frame and format, named after the frame
+    formats - file extensions to save each frame as, e.g. 'png', 'pdf' or 'svg'
+    workers - number of processes to render with
+    sourceTime - modification time of the input data. Frames with every file newer than it are skipped
+    pdf - path of a multi-page PDF to also write, one frame per page, or None
+    settings - a JSON-serializable dict of what frames were drawn with, e.g. the date range and estimate. Files drawn
+    with other settings are rendered again however new they are. Recorded in directory's SETTINGS_FILE
+
+    Outputs:
+    The paths that were written
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    drawnWith = loadSettings(directory)
+    if settings is not None:
+        settings = json.loads(json.dumps(settings)) # as it reads back from SETTINGS_FILE, to compare equal
+
+    jobs = []
+    for name, plotFunction, plots, kwargs in frames:
+        paths = [os.path.join(directory, name + '.' + fmt) for fmt in formats]
+        if paths and not isUpToDate(paths, sourceTime, settings, drawnWith):
+            jobs.append((plotFunction, plots, kwargs, paths))
+    print "Rendering " + str(len(jobs)) + " of " + str(len(frames)) + " frames, skipping the rest as up to date"
+
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            written = pool.map(renderFrame, jobs, chunksize=max(len(jobs) / (workers * 4), 1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = map(renderFrame, jobs)
+    written = [path for paths in written for path in paths]
+
+    # Pages of one PDF can't be written from several processes, so the multi-page PDF is drawn here
+    if pdf and not isUpToDate([pdf], sourceTime, settings, drawnWith):
+        with PdfPages(pdf) as pages:
+            for name, plotFunction, plots, kwargs in frames:
+                fig, ax = newFigure()
+                plotFunction(curr_pos=0, plots=plots, ax=ax, **kwargs)
+                pages.savefig(fig, bbox_inches='tight')
+                plt.close(fig)
+        written.append(pdf)
+
+    if settings is not None and written:
+        for path in written:
+            drawnWith[os.path.abspath(path)] = settings
+        with open(os.path.join(directory, SETTINGS_FILE), 'w') as f:
+            json.dump(drawnWith, f, indent=1, sort_keys=True)
+    return written
+
+
+def dayPlotFrames(procs):
+    """
+    Returns a frame of dp.dayPlot() per day of procs, a ProcedureTable, named day_<date>
+    """
+    frames = []
+    for dayProcs in dp.groupTableByDay(procs):
+        name = 'day_' + dayProcs[0].date.isoformat()[:10]
+        frames.append((name, dp.dayPlot, [dayProcs], {}))
+    return frames
+
+
+def idlePlotFrames(procs, workers=1):
+    """
+    Returns a frame of ci.dailyIdlePlot() per day of procs, a ProcedureTable, named idle_<date>
+    """
+    ideals, roomIdles = ci.calculateTableEstimates(procs, workers=workers, estimates=(IDLE_ESTIMATE,))
+    ideals, roomIdles = ideals[IDLE_ESTIMATE], roomIdles[IDLE_ESTIMATE]
+    roomPlots = roomIdles.plotTuples()
+    realRoomPlots = roomIdles.minus(ideals).plotTuples()
+
+    frames = []
+    for i, date in enumerate(ci.dayDates(procs)):
+        name = 'idle_' + date.isoformat()[:10]
+        frames.append((name, ci.dailyIdlePlot, [[roomPlots[i]], [realRoomPlots[i]]], {'dates': [date]}))
+    return frames
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Render every day's plots from an excel file to image files, without "
+                                                 "a display")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
+    parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data. If row, 1 refers "
+                                            "to first row containing data, not necessarily first row of excel sheet",
+                        required=True)
+    parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data. If row, 1 refers ",
+                        required=True)
+    parser.add_argument("-o", "--out", default="plots", help="Directory to write plots to")
+    parser.add_argument("-f", "--formats", default="png", help="Comma separated file formats, e.g. png,pdf,svg")
+    parser.add_argument("-p", "--plots", default="day,idle", help="Comma separated plots to render: day, idle or both")
+    parser.add_argument("--pdf", help="Also write every plot as one page of this multi-page PDF")
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes to render with")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.fromArgs(args)
+
+    excel = sa.StatAggregator.fromArgs(args)
+    frames = []
+    plots = args.plots.split(',')
+    if 'day' in plots:
+        frames.extend(dayPlotFrames(excel.procs))
+    if 'idle' in plots:
+        frames.extend(idlePlotFrames(excel.procs, workers=args.workers))
+
+    # Idle frames also depend on the ideals, which depend on every day read, so on the range as well as the estimate
+    settings = dict((name, getattr(args, name)) for name in PLOT_ARGUMENTS)
+    settings['estimate'] = IDLE_ESTIMATE
+    with instrument.stage('render', rows=len(frames)):
+        exportFrames(frames, args.out, formats=args.formats.split(','), workers=args.workers,
+                     sourceTime=multiSource.modifiedTime(args.filename), pdf=args.pdf, settings=settings)
+
+if __name__ == "__main__":
+    parseInputs()
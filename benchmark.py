@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import datetime as dt
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg') # render without a display. Must come before pyplot is first imported
+import matplotlib.pyplot as plt
+import numpy as np
+
+import calculateIdles as ci
+import dayPlot as dp
+import generateSchedules as gs
+import scenarios as sc
+import statAggregator as sa
+import timeline as tl
+
+ROOMS = 40
+PROCS_PER_ROOM_DAY = 4.9 # average of generateColumns() with its default blocks and cases
+DEFAULT_SIZES = '1000,10000,100000,1000000,10000000'
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkResults.jsonl')
+FLIP_DAYS = 10 # days flipped through by the 'flip' stage
+TIMELINE_DAYS = 7 # days the 'timeline' stage draws procedure by procedure, before drawing everything as a heatmap
+SWEEP_TARGETS = range(0, 121) # turnover targets the 'sweep' stage replays, a minute apart
+REGRESSION_RATIO = 1.2 # a stage this many times slower than before is reported as a regression,
+NOISE_SECONDS = 0.01 # unless it's slower by less than this
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silences the per procedure and per room prints of the stages being timed
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timeStage(results, stage, size, function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs), appends how long it took to results and returns its output
+    """
+    with quiet():
+        start = time.time()
+        output = function(*args, **kwargs)
+        seconds = time.time() - start
+    results.append({'stage': stage, 'size': size, 'seconds': seconds})
+    print "%10d  %-28s %10.4f s" % (size, stage, seconds)
+    return output
+
+
+def legacyIdles(procs):
+    """
+    idBlocks() and findIdles() day by day over Procedure-like rows, as calculateIdleStats() does for lists
+    """
+    roomIdles = []
+    for day in dp.groupProcsByDay(procs):
+        blocks = ci.idBlocks(day)
+        roomIdles.append(ci.findIdles(day, trailingIdles=True, blocks=blocks))
+    return roomIdles
+
+
+def renderFrames(procs, roomPlots):
+    fig, ax = plt.subplots()
+    dp.dayPlot(curr_pos=0, plots=[dp.groupTableByDay(procs)[0]], ax=ax)
+    fig.canvas.draw()
+    ax.cla()
+    ci.dailyIdlePlot(curr_pos=0, plots=[roomPlots[:1]], ax=ax, dates=ci.dayDates(procs)[:1])
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def flipFrames(procs, roomPlots, days=FLIP_DAYS):
+    """
+    Flips through the first days of dayPlot() and dailyIdlePlot() as ci.flipThruPlotter() does, updating the first
+    day's artists in place, with every frame computed ahead of time as its FrameCache would have
+    """
+    dayList = dp.groupTableByDay(procs)[:days]
+    plots = [roomPlots[:days]]
+    dates = ci.dayDates(procs)[:days]
+    for plotFunction, frameFunction, kwargs in ((dp.dayPlot, dp.dayFrame, {'plots': dayList}),
+                                                (ci.dailyIdlePlot, ci.dailyIdleFrame, {'plots': plots, 'dates': dates})):
+        frames = [frameFunction(curr_pos=i, **kwargs) for i in range(len(dates))]
+        fig, ax = plt.subplots()
+        artists = None
+        for i, frame in enumerate(frames):
+            artists = plotFunction(curr_pos=i, ax=ax, frame=frame, artists=artists, **kwargs)
+            fig.canvas.draw()
+        plt.close(fig)
+
+
+def browseTimeline(procs, days=TIMELINE_DAYS):
+    """
+    Indexes procs for timeline.TimelineView, then draws its first days procedure by procedure and all of it as an
+    occupancy heatmap, as zooming out would
+    """
+    fig, ax = plt.subplots()
+    timeline = tl.Timeline(procs)
+    view = tl.TimelineView(timeline, ax, timeline.first, timeline.first + days * ci.MINUTES_PER_DAY)
+    fig.canvas.draw()
+    view.update(timeline.first, timeline.last)
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def sweepTargets(procs, blocks, targets=SWEEP_TARGETS):
+    """
+    Indexes procs for scenarios.sweep(), then replays every target in one process
+    """
+    return sc.sweep(sc.Replay(procs, blocks=blocks), targets)
+
+
+def benchmarkSize(size, maxIngest, maxLegacy, maxNested):
+    """
+    Times every stage of the pipeline on a generated schedule of about size procedures. Stages that build a Python
+    object per procedure or per idle are only run up to maxLegacy or maxNested procedures, and ingestion, which
+    needs a workbook to be written first, only up to maxIngest
+    """
+    results = []
+    days = int(math.ceil(size / (ROOMS * PROCS_PER_ROOM_DAY)))
+    columns = gs.generateColumns(rooms=ROOMS, days=days)
+
+    if size <= maxIngest:
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            gs.writeWorkbook(path, columns)
+            excel = timeStage(results, 'ingestion', size, sa.StatAggregator, path, min='1', max=str(10 * size))
+        finally:
+            os.remove(path)
+        procs = excel.procs
+    else:
+        builder = sa.ProcedureTableBuilder()
+        builder.extend(columns)
+        procs = builder.build()
+    del columns
+
+    blocks = timeStage(results, 'idTableBlocks', size, ci.idTableBlocks, procs)
+    timeStage(results, 'tableIdles', size, ci.tableIdles, procs, trailingIdles=True, blocks=blocks)
+    timeStage(results, 'timeline', size, browseTimeline, procs)
+    timeStage(results, 'sweep', size, sweepTargets, procs, blocks)
+    if size <= maxLegacy:
+        rows = list(procs)
+        timeStage(results, 'idBlocks+findIdles (per day)', size, legacyIdles, rows)
+        del rows
+    if size <= maxNested:
+        roomIdles = timeStage(results, 'findTableIdles', size, ci.findTableIdles, procs, trailingIdles=True,
+                              blocks=blocks)
+        timeStage(results, 'calculateIdealIdles', size, ci.calculateIdealIdles, ci.iterTableIdles(procs, blocks=blocks))
+        roomPlots = timeStage(results, 'idleDictsToTuples', size, ci.idleDictsToTuples, roomIdles)
+        del roomIdles
+        timeStage(results, 'render', size, renderFrames, procs, roomPlots)
+        timeStage(results, 'flip', size, flipFrames, procs, roomPlots)
+
+    for result in results:
+        result['procedures'] = len(procs)
+    return results
+
+
+def revision():
+    """
+    Returns the git commit of the code being benchmarked, or None outside a git checkout
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def saveResults(path, results):
+    """
+    Appends results to the JSON lines file at path, tagged with this run's revision and time
+    """
+    run = {'revision': revision(), 'time': dt.datetime.now().isoformat()[:19], 'python': sys.version.split()[0],
+           'numpy': np.__version__}
+    with open(path, 'a') as f:
+        for result in results:
+            result.update(run)
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def compareResults(path):
+    """
+    Prints how the latest run in the results file at path compares to the latest run of a different revision,
+    stage by stage and size by size
+    """
+    with open(path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    if not results:
+        return
+    latest = results[-1]['time']
+    current = [r for r in results if r['time'] == latest]
+    previous = [r for r in results if r['revision'] != current[0]['revision']]
+    if not previous:
+        print "No results from another revision to compare " + str(current[0]['revision']) + " to"
+        return
+
+    # The most recent timing of each stage and size from other revisions
+    before = {}
+    for r in previous:
+        before[(r['stage'], r['size'])] = r
+
+    print "\n%-28s %10s %12s %12s %8s" % ('stage', 'size', 'before (s)', 'now (s)', 'ratio')
+    for r in current:
+        old = before.get((r['stage'], r['size']))
+        if old is None:
+            continue
+        ratio = r['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        slower = ratio > REGRESSION_RATIO and r['seconds'] - old['seconds'] > NOISE_SECONDS
+        flag = '  REGRESSION vs ' + str(old['revision']) if slower else ''
+        print "%-28s %10d %12.4f %12.4f %7.2fx%s" % (r['stage'], r['size'], old['seconds'], r['seconds'], ratio, flag)
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Time every stage of the idle pipeline on generated schedules of "
+                                                 "increasing size")
+    parser.add_argument("-s", "--sizes", default=DEFAULT_SIZES, help="Comma separated numbers of procedures")
+    parser.add_argument("--max-ingest", type=int, default=100000,
+                        help="Largest size to write and read a workbook for. Larger sizes are generated in memory")
+    parser.add_argument("--max-legacy", type=int, default=100000,
+                        help="Largest size to run the per day idBlocks() and findIdles() on")
+    parser.add_argument("--max-nested", type=int, default=1000000,
+                        help="Largest size to build nested per day idle dicts and plots for")
+    parser.add_argument("-r", "--results", default=DEFAULT_RESULTS, help="JSON lines file results are appended to")
+    parser.add_argument("--no-compare", action="store_true", help="Don't compare to the previous revision's results")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results.extend(benchmarkSize(size, args.max_ingest, args.max_legacy, args.max_nested))
+    saveResults(args.results, results)
+    if not args.no_compare:
+        compareResults(args.results)
+
+if __name__ == "__main__":
+    parseInputs()
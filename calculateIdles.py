@@ -1,23 +1,94 @@
 import argparse
+import collections
+import functools
+import multiprocessing
+import os
+import Queue
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
 import datetime as dt
 from sortedcontainers import SortedList
 
+import dayIndex
+import idleIndex
+import instrument
 import statAggregator as sa
 
-def calculateIdleStats(procs):
+MINUTES_PER_DAY = 24 * 60
+ENDS = {'conservative': 'outRoom', 'liberal': 'procEnd'} # the end of a surgery each estimate measures idles from
+ESTIMATES = ('conservative', 'liberal')
+IDLE_VIEWS = (('conservative', True), ('conservative', False), ('liberal', True), ('liberal', False)) # with trailing?
+FRAME_CACHE_SIZE = 64 # frames flipThruPlotter() keeps computed, least recently shown dropped first
+IDLE_BAR_WIDTH = 0.2 # of each plot's bars in dailyIdlePlot()
+PRERENDER_FRAMES = 2 # frames on either side of the shown one that flipThruPlotter() computes in the background
+
+def estimateStage(name):
+    """
+    Returns the instrument stage name of a call of findIdles() or one of its table versions, e.g.
+    'findIdles (conservative, trailing)', so that every estimate is timed separately
+    """
+    def stageName(procs, estimate='conservative', trailingIdles=False, blocks=None):
+        return name + ' (' + estimate + (', trailing' if trailingIdles else '') + ')'
+    return stageName
+
+def pyplot():
+    """
+    Returns matplotlib.pyplot, imported on first use, so that analysis and queries that don't plot never load matplotlib
+    """
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+def calculateIdleStats(procs, workers=1, plot=False):
     """
     Inputs:
-    procs - a list of at least one days worth of Procedure objects, in chronological order
+    procs - a list of at least one days worth of Procedure objects, in any order, or a ProcedureTable, which
+    is handled by the vectorized idTableBlocks() and tableIdles()
+    workers - number of processes to split a ProcedureTable's days between. Results are identical to a single process.
+    Lists are always processed in one process, with a note if workers asks for more
+    plot - flip through a histogram of each room's individual idle times
 
     Outputs:
     roomCumIdles - a list of dicts, where keys are rooms and values are cumulative conservative idle time, cumulative
     liberal idle time, and number of idle intervals. Each dict is one day.
     """
 
-    roomIdles = []
-    onlyInBetweenIdles = []
+    ideals, roomIdles = calculateIdleEstimates(procs, workers, estimates=('conservative',),
+                                               plot=('conservative',) if plot else ())
+    return ideals['conservative'], roomIdles['conservative']
+
+def calculateIdleEstimates(procs, workers=1, estimates=ESTIMATES, plot=(), percentile=None):
+    """
+    Inputs:
+    procs, workers - as for calculateIdleStats()
+    estimates - which estimates to compute: 'conservative', idles from the previous surgery's out of room time, and
+    'liberal', idles from its procedure end time
+    plot - estimates to flip through a histogram of each room's individual idle times for
+    percentile - if given, ideals are this quantile of each room's idles instead of the fastest, as for
+    calculateIdealIdles()
+
+    Outputs:
+    ideals - a dict where keys are estimates and values are dicts of each room's estimated ideal idle time
+    roomIdles - a dict where keys are estimates and values are lists of dicts of idles, including trailing idles, one
+    per day, as calculateIdleStats() returns them
+
+    Each day is grouped, sorted and walked once for every estimate, with and without trailing idles, by
+    findIdleViews() or tableIdleViews(). Idles without trailing idles are only needed for ideals, so aren't kept.
+    """
+
+    if isinstance(procs, sa.ProcedureTable):
+        ideals, tableIdles = calculateTableEstimates(procs, workers, estimates, plot, percentile)
+        with instrument.stage('TableIdles.days') as stage:
+            roomIdles = dict((estimate, list(tableIdles[estimate].days())) for estimate in estimates)
+            stage.rows = sum(len(days) for days in roomIdles.values())
+        return ideals, roomIdles
+
+    if workers > 1:
+        print "Computing idles of a list of procedures in one process. " + str(workers) + " workers only split the " \
+              "days of a ProcedureTable"
+    procs = sorted(procs, key=lambda proc: proc.date) # stable, so each day's procedures keep their order
+    views = [(estimate, trailingIdles) for estimate in estimates for trailingIdles in (True, False)]
+    roomIdles = dict((estimate, []) for estimate in estimates)
+    estimators = dict((estimate, IdealIdleEstimator()) for estimate in estimates)
     i = 0
     while i < len(procs): # Because i is incremented in inner loop, this outer while loop is iterated once per day
 
@@ -27,21 +98,96 @@ def calculateIdleStats(procs):
             todaysProcs.append(procs[i])
             i += 1
 
-        idBlocks(todaysProcs)
-        roomIdle = findIdles(todaysProcs, trailingIdles=True)
-        roomIdles.append(roomIdle)
-        inBetweenIdle = findIdles(todaysProcs)
-        onlyInBetweenIdles.append(inBetweenIdle)
+        blocks = idBlocks(todaysProcs)
+        dayIdles = findIdleViews(todaysProcs, views, blocks=blocks)
+        for estimate in estimates:
+            roomIdles[estimate].append(dayIdles[(estimate, True)])
+            estimators[estimate].addDay(dayIdles[(estimate, False)])
+
+    return estimateIdeals(estimators, estimates, plot, percentile), roomIdles
+
+def calculateTableEstimates(procs, workers=1, estimates=ESTIMATES, plot=(), percentile=None):
+    """
+    Inputs:
+    procs - a ProcedureTable
+    workers, estimates, plot, percentile - as for calculateIdleEstimates()
+
+    Outputs:
+    ideals - as for calculateIdleEstimates()
+    roomIdles - a dict where keys are estimates and values are TableIdles of all of procs' idles, including trailing
+    idles. Much smaller than calculateIdleEstimates()' nested lists, and what they're converted from
+    """
+
+    if workers > 1:
+        # Several chunks per worker, so that a slow chunk doesn't hold the rest up
+        pool = multiprocessing.Pool(workers)
+        try:
+            if instrument.isEnabled():
+                results = []
+                for result, stages in pool.map(functools.partial(profiledTableEstimateStats, estimates=estimates),
+                                               splitDays(procs, workers * 4)):
+                    results.append(result)
+                    instrument.merge(stages)
+            else:
+                results = pool.map(functools.partial(tableEstimateStats, estimates=estimates),
+                                   splitDays(procs, workers * 4))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [tableEstimateStats(procs, estimates)]
+
+    return combineEstimates(results, estimates, plot, percentile)
+
+def calculateChunkEstimates(chunks, estimates=ESTIMATES, plot=(), percentile=None):
+    """
+    Inputs:
+    chunks - ProcedureTables of whole days, in chronological order, whose room codes all index into the room labels of
+    the last one, e.g. dayIndex.DaySorter.chunks()
+    estimates, plot, percentile - as for calculateIdleEstimates()
+
+    Outputs:
+    ideals, roomIdles - as for calculateTableEstimates() of all of chunks' procedures
+
+    Chunks are processed one at a time and only their idles are kept, so procedures never all need to be in memory
+    """
+
+    return combineEstimates([tableEstimateStats(procs, estimates) for procs in chunks], estimates, plot, percentile)
 
-    ideals = calculateIdealIdles(onlyInBetweenIdles, plot=True)
+def combineEstimates(results, estimates, plot, percentile=None):
+    """
+    Returns the ideals and TableIdles of calculateTableEstimates() of tableEstimateStats() results of chunks of days
+    """
+
+    roomIdles, estimators = {}, {}
+    for estimate in estimates:
+        roomIdles[estimate] = TableIdles.concatenate([chunkIdles[estimate] for chunkIdles, _ in results])
+        estimators[estimate] = IdealIdleEstimator()
+        for _, chunkEstimators in results:
+            estimators[estimate].merge(chunkEstimators[estimate])
 
-    return ideals, roomIdles
+    return estimateIdeals(estimators, estimates, plot, percentile), roomIdles
 
+def estimateIdeals(estimators, estimates, plot, percentile=None):
+    """
+    Returns a dict where keys are estimates and values are calculateIdealIdles() of their IdealIdleEstimators
+    """
+    ideals = {}
+    for estimate in estimates:
+        if len(estimates) > 1:
+            print "\n" + estimate.capitalize() + " estimate:"
+        ideals[estimate] = calculateIdealIdles(estimators[estimate], plot=estimate in plot, percentile=percentile)
+    return ideals
+
+@instrument.timed('idBlocks')
 def idBlocks(procs):
     """
     Inputs:
     procs - a list of exactly one days worth of Procedure objects
 
+    Outputs:
+    blocks - a list of Blocks, indexed by blockId
+
     idBlocks() adds a blockId field to each procedure, identifying which block the procedure belongs to. Indexing
     starts at 0 every day, so only useful for looking at blocks within the same day.
     """
@@ -49,164 +195,723 @@ def idBlocks(procs):
     # Group the procedures by room
     rooms = makeRoomsDict(procs)
 
-    # Join contiguous procedures into blocks with blockIds
-    blockId = 0
+    # Join contiguous procedures into blocks with blockIds, tracking each block's scheduled end as it grows
+    blocks = []
     for room, surgeries in rooms.items():
         surgeries.sort(key=lambda x: x.schedStart) # sort by scheduled start time
-        surgeries[0].blockId = blockId
+        block = Block(room, surgeries, 0)
+        blocks.append(block)
+        surgeries[0].blockId = len(blocks) - 1
         for i, surgery in enumerate(surgeries[1:]):
             if surgery.schedStart != surgeries[i].schedEnd: # if surgery start time != end time of previous surgery, make new block
-                blockId += 1
-            surgery.blockId = blockId
-        blockId += 1
+                block = Block(room, surgeries, i + 1)
+                blocks.append(block)
+            block.add(surgery)
+            surgery.blockId = len(blocks) - 1
+
+    return blocks
+
+
+class Block(object):
+    """
+    One block of back to back surgeries in a room, as found by idBlocks(). Its members are procs[start:stop] of the
+    room's surgeries in scheduled order, and schedEnd is the latest scheduled end among them. Only the range is kept,
+    not procs, so blocks don't hold on to a day's procedures.
+    """
+
+    def __init__(self, room, procs, start):
+        self.room = room
+        self.start = start
+        self.stop = start + 1
+        self.schedEnd = procs[start].schedEnd
+
+    def add(self, proc):
+        self.stop += 1
+        self.schedEnd = max(self.schedEnd, proc.schedEnd)
 
 
-def findIdles(procs, estimate='conservative', trailingIdles = False):
+@instrument.timed(estimateStage('findIdles'))
+def findIdles(procs, estimate='conservative', trailingIdles = False, blocks=None):
     """
     Inputs:
     procs - a list of exactly one days worth of Procedure objects
+    blocks - the output of idBlocks(procs). If not given, trailing idles need blockIds already set on procs
 
     Outputs:
     roomIdles - a dict where keys are rooms and values are liberal and conservative idle times. Represents one day.
     """
 
+    return findIdleViews(procs, [(estimate, trailingIdles)], blocks)[(estimate, trailingIdles)] # TODO: add a withTrailing data structure
+
+
+@instrument.timed('findIdleViews')
+def findIdleViews(procs, views=IDLE_VIEWS, blocks=None):
+    """
+    Inputs:
+    procs - a list of exactly one days worth of Procedure objects
+    views - (estimate, trailingIdles) tuples, each naming a findIdles() output to compute
+    blocks - the output of idBlocks(procs). If not given, trailing idles need blockIds already set on procs
+
+    Outputs:
+    viewIdles - a dict where keys are views and values are what findIdles(procs, estimate, trailingIdles) returns
+
+    Procedures are grouped by room and each room is sorted and walked once for every view
+    """
+
+    for estimate, _ in views:
+        if estimate not in ENDS:
+            raise ValueError('findIdles() was given an invalid argument for estimate. Must me liberal or conservative')
+
     # Group the procedures by room
     rooms = makeRoomsDict(procs)
 
+    # Scheduled end of each block, for trailing idles
+    if blocks is not None:
+        schedBlockEnds = [block.schedEnd for block in blocks]
+    elif any(trailingIdles for _, trailingIdles in views):
+        schedBlockEnds = {}
+        for proc in procs:
+            if proc.blockId not in schedBlockEnds or proc.schedEnd > schedBlockEnds[proc.blockId]:
+                schedBlockEnds[proc.blockId] = proc.schedEnd
+
     # Calculate idles
-    roomIdles = {}
+    viewIdles = dict((view, {}) for view in views)
     for room, surgeries in rooms.items():
         surgeries.sort(key=lambda x: x.inRoom) # sort by real start time, to accommodate for schedules that were shuffled
-        individualIdles = []
-        currentBlockIdles = []
+        individualIdles = dict((view, []) for view in views)
+        currentBlockIdles = dict((view, []) for view in views)
 
         if surgeries:
 
             currentBlockId = surgeries[0].blockId
             for i, surgery in enumerate(surgeries[1:]):
+                prevSurgery = surgeries[i]
 
                 if surgery.blockId == currentBlockId:
 
-                    if estimate == 'liberal':
-                        # In case, surgery is in same block, but started next day
-                        sameBlockNewDay = (surgery.date != surgeries[i].date) and not surgeries[i].procEndStraddledMidnight
-                        # must be datetimes, not time objects, for subtraction
-                        inRoom = dt.datetime.combine(dt.datetime(1, 1, 1 + sameBlockNewDay), surgery.inRoom)
-                        prevProcEnd = dt.datetime.combine(dt.datetime(1,1,1), surgeries[i].procEnd)
-                        delta = inRoom - prevProcEnd
-                    elif estimate == 'conservative':
-                        # In case, surgery is in same block, but started next day
-                        sameBlockNewDay = (surgery.date != surgeries[i].date) and not surgeries[i].outRoomStraddledMidnight
-                        # must be datetimes, not time objects, for subtraction
-                        inRoom = dt.datetime.combine(dt.datetime(1, 1, 1 + sameBlockNewDay), surgery.inRoom)
-                        prevOutRoom = dt.datetime.combine(dt.datetime(1,1,1), surgeries[i].outRoom)
-                        delta = inRoom - prevOutRoom
-                    else:
-                        raise ValueError('findIdles() was given an invalid argument for estimate. Must me liberal or conservative')
-
-                    delta = delta.seconds / 60 # convert to int in minutes
-                    currentBlockIdles.append(delta)
+                    # % wraps idles around midnight, in case surgery is in same block, but started next day
+                    inRoom = minutes(surgery.inRoom)
+                    for view in views:
+                        prevEnd = minutes(getattr(prevSurgery, ENDS[view[0]]))
+                        currentBlockIdles[view].append((inRoom - prevEnd) % MINUTES_PER_DAY)
 
                 else: # finish current block, begin next
 
-                    if trailingIdles:
-                        # Find schedEnd of this block and append any trailing idle time to currentBlockIdles
-                        currBlockProcs = filter(lambda x: x.blockId == currentBlockId, surgeries)
-                        lastProcInBlock = max(currBlockProcs, key = lambda x: x.schedEnd)
-                        schedBlockEnd = lastProcInBlock.schedEnd
-                        if estimate == 'liberal':
-                            if schedBlockEnd > surgeries[i].procEnd:
-                                schedBlockEnd = dt.datetime.combine(dt.datetime(1, 1, 1), schedBlockEnd)
-                                prevProcEnd = dt.datetime.combine(dt.datetime(1, 1, 1), surgeries[i].procEnd)
-                                trailingIdle = schedBlockEnd - prevProcEnd
-                                trailingIdle = trailingIdle.seconds / 60  # convert to int in minutes
-                                currentBlockIdles.append(trailingIdle)
-                        else:
-                            if schedBlockEnd > surgeries[i].outRoom:
-                                schedBlockEnd = dt.datetime.combine(dt.datetime(1, 1, 1), schedBlockEnd)
-                                prevOutRoom = dt.datetime.combine(dt.datetime(1, 1, 1), surgeries[i].outRoom)
-                                trailingIdle = schedBlockEnd - prevOutRoom
-                                trailingIdle = trailingIdle.seconds / 60  # convert to int in minutes
-                                currentBlockIdles.append(trailingIdle)
-
-                    individualIdles.append(currentBlockIdles)
-                    currentBlockIdles = []
+                    for view in views:
+                        if view[1]:
+                            # Look up schedEnd of this block and append any trailing idle time to currentBlockIdles
+                            schedBlockEnd = schedBlockEnds[currentBlockId]
+                            prevEnd = getattr(prevSurgery, ENDS[view[0]])
+                            if schedBlockEnd > prevEnd:
+                                currentBlockIdles[view].append(minutes(schedBlockEnd) - minutes(prevEnd))
+                        individualIdles[view].append(currentBlockIdles[view])
+                        currentBlockIdles[view] = []
                     currentBlockId = surgery.blockId
 
             # Append final block after loop finishes
-            individualIdles.append(currentBlockIdles)
+            for view in views:
+                individualIdles[view].append(currentBlockIdles[view])
 
-        roomIdles[room] = individualIdles
+        for view in views:
+            viewIdles[view][room] = individualIdles[view]
 
-    return roomIdles # TODO: add a withTrailing data structure
+    return viewIdles
+
+
+def minutes(time):
+    """
+    Returns the minutes since midnight of a time
+    """
+    return time.hour * 60 + time.minute
 
 
-def calculateIdealIdles(roomIdles, percentileToAvg=-1, plot=False):
+@instrument.timed('idTableBlocks')
+def idTableBlocks(procs):
     """
     Inputs:
-    roomIdles - List of dicts. Each dict is one day. Keys are rooms, values are lists of lists of individual idle times
+    procs - a ProcedureTable, holding any number of days
+
+    Outputs:
+    blockIds - int array with the block of each procedure. Blocks are joined exactly like idBlocks() joins them, but for
+    all days at once, so ids are unique across the whole table and run from 0 to the number of blocks - 1
+    blockEnds - int array with the scheduled end of each block, the latest schedEnd of its procedures
+    """
+
+    # Stable sort, so procedures with the same scheduled start stay in table order, as in idBlocks()
+    order = np.lexsort((procs.schedStart, procs.room, procs.date))
+    date, room = procs.date[order], procs.room[order]
+    schedStart, schedEnd = procs.schedStart[order], procs.schedEnd[order]
+
+    # A new block starts with each day and room, and wherever a surgery doesn't start when the previous one ends
+    newBlock = np.ones(len(order), dtype=bool)
+    newBlock[1:] = (date[1:] != date[:-1]) | (room[1:] != room[:-1]) | (schedStart[1:] != schedEnd[:-1])
+
+    blockIds = np.empty(len(order), dtype=np.int32)
+    blockIds[order] = np.cumsum(newBlock) - 1
+    blockEnds = np.maximum.reduceat(schedEnd, np.flatnonzero(newBlock)) if len(order) else schedEnd
+    return blockIds, blockEnds
+
+
+def tableRunBlocks(procs, blocks=None):
+    """
+    Inputs:
+    procs - a ProcedureTable, holding any number of days
+    blocks - the output of idTableBlocks(procs), computed if not given
+
+    Outputs:
+    An int array with the block of each procedure as tableIdles() numbers them: the index of its run of consecutive
+    surgeries of one block among its room-day's runs, in in room order. The idles of procedure i are in block
+    runBlocks[i] of its room-day in TableIdles.blockIndices()
+    """
+
+    n = len(procs)
+    if not n:
+        return np.zeros(0, dtype=np.int32)
+    runs = tableRuns(procs, blocks)
+    order, sameRoom, runOf = runs.order, runs.sameRoom, runs.runOf
+    roomDayFirst = np.maximum.accumulate(np.where(sameRoom, 0, np.arange(n))) # first procedure of each room-day
+    runBlocks = np.empty(n, dtype=np.int32)
+    runBlocks[order] = runOf - runOf[roomDayFirst]
+    return runBlocks
+
+
+def findTableIdles(procs, estimate='conservative', trailingIdles=False, blocks=None):
+    """
+    Inputs:
+    procs - a ProcedureTable, holding any number of days
+    blocks - the output of idTableBlocks(procs), computed if not given
+
+    Outputs:
+    roomIdles - a list of dicts, one per day in chronological order, each exactly what findIdles() returns for that day
+    """
+
+    return list(iterTableIdles(procs, estimate, trailingIdles, blocks))
+
+
+def iterTableIdles(procs, estimate='conservative', trailingIdles=False, blocks=None):
+    """
+    Generator version of findTableIdles(), yielding one day's dict at a time
+    """
+
+    return tableIdles(procs, estimate, trailingIdles, blocks).days()
+
+
+@instrument.timed(estimateStage('tableIdles'))
+def tableIdles(procs, estimate='conservative', trailingIdles=False, blocks=None):
+    """
+    Inputs:
+    procs - a ProcedureTable, holding any number of days
+    blocks - the output of idTableBlocks(procs), computed if not given
+
+    Outputs:
+    A TableIdles holding the same idles as findTableIdles(procs, estimate, trailingIdles) in flat arrays
+    """
+
+    return tableIdleViews(procs, [(estimate, trailingIdles)], blocks)[(estimate, trailingIdles)]
+
+
+TableRuns = collections.namedtuple('TableRuns', ['order', 'sameRoom', 'runStarts', 'runLasts', 'runOf', 'pairs',
+                                                 'runBlocks', 'blockEnds'])
+
+@instrument.timed('tableRuns')
+def tableRuns(procs, blocks=None):
+    """
+    Inputs:
+    procs - a non-empty ProcedureTable, holding any number of days
+    blocks - the output of idTableBlocks(procs), computed if not given
+
+    Outputs:
+    A TableRuns of the runs of consecutive surgeries of one block that tableIdleViews() lists idles by, in the order
+    of its sort by day, room and in room time. order sorts procs, and the rest index into the sorted procedures:
+    sameRoom - whether each is on the day and in the room of the one before it
+    runStarts, runLasts - the first and last of every run
+    runOf - the run of each
+    pairs - the ones following another of the same run, with an idle before them
+    runBlocks, blockEnds - the block of every run, as numbered by idTableBlocks(), and its scheduled end
+    """
+
+    blockIds, blockEnds = blocks if blocks is not None else idTableBlocks(procs)
+
+    # Sort by real start time within each room, to accommodate for schedules that were shuffled
+    order = np.lexsort((procs.inRoom, procs.room, procs.date))
+    date, room, block = procs.date[order], procs.room[order], blockIds[order]
+
+    sameRoom = np.zeros(len(order), dtype=bool)
+    sameRoom[1:] = (date[1:] == date[:-1]) & (room[1:] == room[:-1])
+    sameBlock = sameRoom.copy()
+    sameBlock[1:] &= block[1:] == block[:-1]
+
+    # Every run of consecutive surgeries of one block gets its own list of idles
+    runStarts = np.flatnonzero(~sameBlock)
+    runLasts = np.append(runStarts[1:], len(order)) - 1
+    runBlocks = block[runLasts]
+    return TableRuns(order, sameRoom, runStarts, runLasts, np.cumsum(~sameBlock) - 1, np.flatnonzero(sameBlock),
+                     runBlocks, blockEnds[runBlocks])
+
+
+def knownPairs(pairs, inRoom, end):
+    """
+    Returns the pairs of a TableRuns whose idle is known: neither surgery's in room time nor the first one's end is
+    MISSING. A surgery without an in room time sorts first in its room-day, wherever it really was. inRoom and end are
+    columns in the TableRuns' sorted order
+    """
+    return pairs[(inRoom[pairs] != sa.MISSING) & (inRoom[pairs - 1] != sa.MISSING) & (end[pairs - 1] != sa.MISSING)]
+
+
+@instrument.timed('tableIdleViews')
+def tableIdleViews(procs, views=IDLE_VIEWS, blocks=None):
+    """
+    Inputs:
+    procs - a ProcedureTable, holding any number of days
+    views - (estimate, trailingIdles) tuples, each naming a tableIdles() output to compute
+    blocks - the output of idTableBlocks(procs), computed if not given
+
+    Outputs:
+    viewIdles - a dict where keys are views and values are TableIdles, each what tableIdles(procs, estimate,
+    trailingIdles) returns
+
+    Vectorized findIdleViews() over the whole table: one sort by (day, room, inRoom), then idles are diffs between
+    neighbours in the same block, wrapped around midnight. Views share the sort and the runs of blocks, and only
+    differ in which end times idles are measured from and whether trailing idles are added.
+    """
+
+    for estimate, _ in views:
+        if estimate not in ENDS:
+            raise ValueError('tableIdles() was given an invalid argument for estimate. Must me liberal or conservative')
+
+    n = len(procs)
+    roomNames = procs.categories['room']
+    if not n:
+        empty = TableIdles(procs.date, procs.room, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), roomNames)
+        return dict((view, empty) for view in views)
+    runs = tableRuns(procs, blocks)
+    order, runStarts, runLasts, runOf = runs.order, runs.runStarts, runs.runLasts, runs.runOf
+    date, room, inRoom = procs.date[order], procs.room[order], procs.inRoom[order]
+
+    # Runs followed by another block of the same room can end with a trailing idle
+    closed = runLasts < n - 1
+    closed[closed] = runs.sameRoom[runLasts[closed] + 1]
+    schedBlockEnds = runs.blockEnds
+
+    viewIdles = {}
+    ends = {}
+    for estimate, trailingIdles in views:
+        with instrument.stage(estimateStage('idleView')(procs, estimate, trailingIdles), rows=n):
+            if estimate not in ends:
+                ends[estimate] = getattr(procs, ENDS[estimate])[order]
+            end = ends[estimate]
+
+            # Idles between neighbours in a block. % wraps them around midnight, like timedelta.seconds. Idles next to a
+            # missing time are unknown, and left out rather than measured from MISSING
+            pairs = knownPairs(runs.pairs, inRoom, end)
+            pairIdles = (inRoom[pairs] - end[pairs - 1]) % MINUTES_PER_DAY
+            pairCounts = np.bincount(runOf[pairs], minlength=len(runStarts))
+
+            # The idle time left before the scheduled block end, if any
+            if trailingIdles:
+                hasTrailing = closed & (end[runLasts] != sa.MISSING) & (schedBlockEnds > end[runLasts])
+            else:
+                hasTrailing = np.zeros(len(runStarts), dtype=bool)
+
+            # Flatten every run's idles into one array, runs back to back
+            offsets = np.zeros(len(runStarts) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(pairCounts + hasTrailing)
+            pairOffsets = np.cumsum(pairCounts) - pairCounts # where each run's idles between neighbours start in pairs
+            pairPositions = np.arange(len(pairs)) - pairOffsets[runOf[pairs]] # where each goes in its run's list
+            idles = np.empty(offsets[-1], dtype=np.int32)
+            idles[offsets[runOf[pairs]] + pairPositions] = pairIdles
+            if trailingIdles:
+                idles[offsets[1:][hasTrailing] - 1] = (schedBlockEnds - end[runLasts])[hasTrailing] % MINUTES_PER_DAY
+
+            viewIdles[(estimate, trailingIdles)] = TableIdles(date[runStarts], room[runStarts], offsets, idles,
+                                                              roomNames)
+
+    return viewIdles
+
+
+class TableIdles(object):
+    """
+    Idles of a whole ProcedureTable, as computed by tableIdles(), in flat arrays that are cheap to keep and to pickle.
+
+    Run r is a run of consecutive surgeries of one block, in chronological order, on the day with ordinal runDates[r]
+    in the room with code runRooms[r], a code into roomNames. Its idles are idles[offsets[r]:offsets[r + 1]]. Runs are
+    sorted by day, then room code, so each room-day's runs are its blocks, in the order findIdles() lists them.
+
+    This is a ragged day x room x block x idle array in CSR form: blockIndices() gives the (day, room, block) of every
+    run and blockTotals() the dense day x room x block array of cumulative idles. Real idles, cumulative idles and
+    padded plots are computed on the arrays, without building nested dicts and lists.
+    """
+
+    ARRAYS = ('runDates', 'runRooms', 'offsets', 'idles')
+
+    def __init__(self, runDates, runRooms, offsets, idles, roomNames):
+        self.runDates = runDates
+        self.runRooms = runRooms
+        self.offsets = offsets
+        self.idles = idles
+        self.roomNames = roomNames
+
+    def days(self):
+        """
+        Yields one dict per day, each exactly what findIdles() returns for that day, converting one day at a time
+        """
+        offsets, idles, runRooms = self.offsets, self.idles, self.runRooms
+        dayRuns = np.append(np.flatnonzero(np.diff(np.concatenate(([-1], self.runDates)))), len(runRooms))
+        for first, stop in zip(dayRuns[:-1], dayRuns[1:]):
+            dayOffsets = (offsets[first:stop + 1] - offsets[first]).tolist()
+            dayIdleList = idles[offsets[first]:offsets[stop]].tolist()
+            dayIdles = {}
+            prevRoom = None
+            for r, rm in enumerate(runRooms[first:stop].tolist()):
+                if rm != prevRoom:
+                    blocks = dayIdles[self.roomNames[rm]] = []
+                    prevRoom = rm
+                blocks.append(dayIdleList[dayOffsets[r]:dayOffsets[r + 1]])
+            yield dayIdles
+
+    def idleRooms(self):
+        """
+        Returns the room code of every idle
+        """
+        return np.repeat(self.runRooms, np.diff(self.offsets))
+
+    def dates(self):
+        """
+        Returns the ordinals of the days with idles, in chronological order
+        """
+        return np.unique(self.runDates)
+
+    def runTotals(self):
+        """
+        Returns the cumulative idle time of every run
+        """
+        cumulative = np.zeros(len(self.idles) + 1, dtype=np.int64)
+        np.cumsum(self.idles, out=cumulative[1:])
+        return cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
+    def roomDayStarts(self):
+        """
+        Returns the index of the first run of every room-day, followed by the number of runs
+        """
+        newRoomDay = np.ones(len(self.runDates), dtype=bool)
+        newRoomDay[1:] = (self.runDates[1:] != self.runDates[:-1]) | (self.runRooms[1:] != self.runRooms[:-1])
+        return np.append(np.flatnonzero(newRoomDay), len(self.runDates))
+
+    def blockIndices(self):
+        """
+        Returns the day, an index into dates(), the room code and the block, an index among its room-day's runs, of
+        every run
+        """
+        starts = self.roomDayStarts()
+        blocks = np.arange(len(self.runDates)) - np.repeat(starts[:-1], np.diff(starts))
+        return np.searchsorted(self.dates(), self.runDates), self.runRooms, blocks
+
+    def blockTotals(self):
+        """
+        Returns a dense days x rooms x blocks array of the cumulative idle time of each block, 0 where a room has fewer
+        blocks that day. Days index dates() and rooms index roomNames
+        """
+        days, rooms, blocks = self.blockIndices()
+        numBlocks = blocks.max() + 1 if len(blocks) else 0
+        totals = np.zeros((len(self.dates()), len(self.roomNames), numBlocks), dtype=np.int64)
+        totals[days, rooms, blocks] = self.runTotals()
+        return totals
+
+    def roomDayTotals(self):
+        """
+        Returns the date ordinal, room code and cumulative idle time of every room-day, in order
+        """
+        starts = self.roomDayStarts()
+        cumulative = np.zeros(len(self.runDates) + 1, dtype=np.int64)
+        np.cumsum(self.runTotals(), out=cumulative[1:])
+        return self.runDates[starts[:-1]], self.runRooms[starts[:-1]], cumulative[starts[1:]] - cumulative[starts[:-1]]
+
+    def plotTuples(self):
+        """
+        Returns exactly what idleDictsToTuples(list(self.days())) does, taking each day's block totals, padded to the
+        day's most blocks, from blockTotals() instead of summing and padding nested lists
+        """
+        with instrument.stage('TableIdles.plotTuples', rows=len(self.idles)):
+            totals = self.blockTotals()
+            starts = self.roomDayStarts()
+            numBlocks = np.diff(starts)
+            roomDayDates = self.runDates[starts[:-1]]
+            dayStarts = np.append(np.flatnonzero(np.diff(np.concatenate(([-1], roomDayDates)))), len(roomDayDates))
+
+            roomPlots = []
+            for day, (first, stop) in enumerate(zip(dayStarts[:-1], dayStarts[1:])):
+                codes = self.runRooms[starts[first:stop]].tolist()
+                # Rooms in the order of a dict built like days() builds it
+                rooms = {}
+                for code in codes:
+                    rooms[self.roomNames[code]] = code
+                rooms = rooms.items()
+                cumulatives = totals[day, [code for _, code in rooms], :numBlocks[first:stop].max()].tolist()
+                roomPlots.append(([room for room, _ in rooms], cumulatives))
+            return roomPlots
+
+    def save(self, directory):
+        """
+        Writes the idles to directory as one .npy file per array, which load() can memory-map
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(directory, 'roomNames.npy'), np.array(self.roomNames, dtype=object))
+
+    @staticmethod
+    def load(directory, mmap=False):
+        """
+        Reads idles written by save() from directory. With mmap, arrays are memory-mapped read-only instead of read
+        into memory, so histories larger than memory can be used, paging in only what's touched
+        """
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in TableIdles.ARRAYS]
+        roomNames = np.load(os.path.join(directory, 'roomNames.npy'), allow_pickle=True).tolist()
+        return TableIdles(*(arrays + [roomNames]))
+
+    def take(self, runs):
+        """
+        Returns a TableIdles of the runs selected by an index array, in that order
+        """
+        lengths = np.diff(self.offsets)[runs]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.repeat(self.offsets[:-1][runs] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TableIdles(self.runDates[runs], self.runRooms[runs], offsets, self.idles[positions], self.roomNames)
+
+    def minus(self, ideals):
+        """
+        Returns a TableIdles of every idle minus its room's ideal, floored at 0, as roomIdlesMinusIdeals() computes.
+        ideals is a dict of each room's ideal, or RollingIdeals, whose ideal in effect on each idle's day is subtracted
+        """
+        with instrument.stage('TableIdles.minus', rows=len(self.idles)):
+            if hasattr(ideals, 'runIdeals'): # RollingIdeals, also when run as __main__
+                idleIdeals = np.repeat(ideals.runIdeals(self), np.diff(self.offsets))
+            else:
+                roomIdeals = np.array([ideals.get(room, 0) for room in self.roomNames] or [0], dtype=np.int64)
+                idleIdeals = roomIdeals[self.idleRooms()]
+            idles = np.maximum(self.idles - idleIdeals, 0).astype(self.idles.dtype)
+            return TableIdles(self.runDates, self.runRooms, self.offsets, idles, self.roomNames)
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        Returns one TableIdles of the runs of parts, in chronological order. Room codes of every part must index into
+        the roomNames of the last one, e.g. when parts come from ProcedureTables that were concatenated
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for part in parts:
+            offsets.append(part.offsets[1:] + offsets[-1][-1])
+        joined = TableIdles(np.concatenate([part.runDates for part in parts]),
+                            np.concatenate([part.runRooms for part in parts]), np.concatenate(offsets),
+                            np.concatenate([part.idles for part in parts]), parts[-1].roomNames)
+        return joined.take(np.argsort(joined.runDates, kind='mergesort'))
+
+
+def splitDays(procs, numChunks):
+    """
+    Inputs:
+    procs - a ProcedureTable
+    numChunks - how many tables to split procs into, at most
+
+    Outputs:
+    A list of ProcedureTables of whole days, in chronological order, with about equal numbers of procedures. Procedures
+    keep their order within each day.
+    """
+
+    if not len(procs):
+        return [procs]
+    index = dayIndex.DayIndex(procs.date)
+    cuts = index.split(numChunks)
+    return [index.take(procs, start, stop) for start, stop in zip(cuts[:-1], cuts[1:])]
+
+
+def tableEstimateStats(procs, estimates=ESTIMATES):
+    """
+    Inputs:
+    procs - a ProcedureTable
+    estimates - which estimates to compute, as for calculateIdleEstimates()
+
+    Outputs:
+    roomIdles - a dict where keys are estimates and values are TableIdles of their idles, including trailing idles
+    estimators - a dict where keys are estimates and values are IdealIdleEstimators of their idles between surgeries
+
+    The per day work of calculateIdleEstimates(), done by each worker process in parallel mode
+    """
+
+    views = tableIdleViews(procs, [(estimate, trailingIdles) for estimate in estimates for trailingIdles in (True, False)])
+    roomIdles, estimators = {}, {}
+    for estimate in estimates:
+        roomIdles[estimate] = views[(estimate, True)]
+        estimators[estimate] = IdealIdleEstimator()
+        estimators[estimate].addTableIdles(views[(estimate, False)])
+    return roomIdles, estimators
+
+
+def tableIdleStats(procs):
+    """
+    Inputs:
+    procs - a ProcedureTable
+
+    Outputs:
+    roomIdles - a TableIdles of conservative idles, including trailing idles
+    estimator - an IdealIdleEstimator of the conservative idles between surgeries
+    """
+
+    roomIdles, estimators = tableEstimateStats(procs, estimates=('conservative',))
+    return roomIdles['conservative'], estimators['conservative']
+
+
+def profiledTableEstimateStats(procs, estimates=ESTIMATES):
+    """
+    tableEstimateStats() in a worker process, also returning the instrument stages it recorded, for the parent to merge
+    """
+    instrument.reset() # forget the stages inherited from the parent when it forked
+    return tableEstimateStats(procs, estimates), instrument.records()
+
+
+class IdealIdleEstimator(object):
+    """
+    Streaming per room summary of individual idle times, from which ideal idle times are estimated.
+
+    Idles are whole minutes within a day, 0 to MINUTES_PER_DAY - 1, so each room keeps one count per possible minute.
+    Memory is fixed at one MINUTES_PER_DAY histogram per room no matter how many days are added, and every statistic
+    below is exact: the error bound is zero, unlike a sampled sketch.
+    """
+
+    def __init__(self):
+        self.counts = {} # room -> np array of MINUTES_PER_DAY counts
+
+    def addDay(self, dayIdles):
+        """
+        Inputs:
+        dayIdles - one day of findIdles() output: a dict where keys are rooms and values are lists of lists of idles
+        """
+        for room, blocks in dayIdles.items():
+            if room not in self.counts:
+                self.counts[room] = np.zeros(MINUTES_PER_DAY, dtype=np.int64)
+            flattenedList = [item for sublist in blocks for item in sublist]
+            if flattenedList:
+                self.counts[room] += np.bincount(flattenedList, minlength=MINUTES_PER_DAY)
+
+    def addTableIdles(self, tableIdles):
+        """
+        Inputs:
+        tableIdles - a TableIdles, counted all at once
+        """
+        numRooms = len(tableIdles.roomNames)
+        roomMinutes = tableIdles.idleRooms().astype(np.int64) * MINUTES_PER_DAY + tableIdles.idles
+        counts = np.bincount(roomMinutes, minlength=numRooms * MINUTES_PER_DAY).reshape(numRooms, MINUTES_PER_DAY)
+        for code in np.unique(tableIdles.runRooms):
+            room = tableIdles.roomNames[code]
+            if room not in self.counts:
+                self.counts[room] = np.zeros(MINUTES_PER_DAY, dtype=np.int64)
+            self.counts[room] += counts[code]
+
+    def merge(self, other):
+        """
+        Adds the idles summarized by another IdealIdleEstimator to this one
+        """
+        for room, counts in other.counts.items():
+            if room in self.counts:
+                self.counts[room] += counts
+            else:
+                self.counts[room] = counts.copy()
+
+    def remove(self, other):
+        """
+        Takes the idles summarized by another IdealIdleEstimator, which were added to this one, back out of it
+        """
+        for room, counts in other.counts.items():
+            self.counts[room] -= counts
+
+    def count(self, room):
+        return int(self.counts[room].sum())
+
+    def minimum(self, room):
+        return int(np.flatnonzero(self.counts[room])[0])
+
+    def percentile(self, room, q):
+        """
+        Returns the nearest-rank q-quantile of room's idles, for 0 <= q <= 1
+        """
+        rank = max(int(np.ceil(q * self.count(room))), 1)
+        return int(np.searchsorted(np.cumsum(self.counts[room]), rank))
+
+    def meanOfFastest(self, room, fraction):
+        """
+        Returns the mean of the fastest fraction of room's idles, rounded down. Always includes at least the fastest
+        """
+        k = max(int(self.count(room) * fraction), 1)
+        counts = self.counts[room]
+        taken = np.minimum(counts, np.maximum(k - (np.cumsum(counts) - counts), 0)) # how many of each minute are in
+        return int(np.dot(taken, np.arange(MINUTES_PER_DAY))) / k
+
+    def ideals(self, percentileToAvg=-1, percentile=None):
+        """
+        Returns a dict where keys are rooms and values are estimated ideal idle times: the q-quantile of each room's
+        idles if percentile is q, else the mean of the fastest percentileToAvg of them, else only the fastest when
+        percentileToAvg is < 0 or > 1. Rooms without idles get 0.
+        """
+        ideals = {}
+        for room in self.counts:
+            if not self.count(room):
+                print room + " had no individual idle times"
+                ideals[room] = 0
+            elif percentile is not None:
+                ideals[room] = self.percentile(room, percentile)
+            elif 0 < percentileToAvg <= 1:
+                ideals[room] = self.meanOfFastest(room, percentileToAvg)
+            else:
+                ideals[room] = self.minimum(room)
+        return ideals
+
+
+def calculateIdealIdles(roomIdles, percentileToAvg=-1, plot=False, percentile=None):
+    """
+    Inputs:
+    roomIdles - Iterable of dicts, e.g. a generator. Each dict is one day. Keys are rooms, values are lists of lists of
+    individual idle times. An IdealIdleEstimator that already summarizes them may be given instead
     percentileToAvg - Float. A value of 0.1 will average the fastest 10% of idle times. Values < 0 or > 1 will use
     only the fastest time
+    percentile - Float. If given, the ideal is this quantile of idle times instead, e.g. 0.1 for the 10th percentile
 
     Outputs:
     ideals - Dict. Keys are rooms, values are estimated ideal cleaning times
 
-    Inefficient
+    Days are summarized as they are read, so memory doesn't grow with the number of days
     """
 
-    # gather by room
-    ideals = {}
-    if percentileToAvg > 1 or percentileToAvg <= 0:
-        onlyBest = True
-    for day in roomIdles:
-        for room in day.keys():
-            if room in ideals:
-                flattenedList = [item for sublist in day[room] for item in sublist]
-                for item in flattenedList:
-                    if onlyBest and not plot:
-                        ideals[room].add(item)
-                        if len(ideals[room]) > 1:
-                            ideals[room].pop()
-                    else:
-                        ideals[room].add(item)
-            else:
-                flattenedList = [item for sublist in day[room] for item in sublist]
-                if onlyBest and not plot:
-                    if flattenedList:
-                        ideals[room] = SortedList([min(flattenedList)])
-                    else:
-                        ideals[room] = SortedList([])
-                else:
-                    ideals[room] = SortedList(flattenedList)
+    with instrument.stage('calculateIdealIdles') as stage:
+        if hasattr(roomIdles, 'ideals'): # an IdealIdleEstimator, also when run as __main__
+            estimator = roomIdles
+        else:
+            estimator = IdealIdleEstimator()
+            for day in roomIdles:
+                estimator.addDay(day)
+
+        ideals = estimator.ideals(percentileToAvg, percentile)
+        stage.rows = sum(estimator.count(room) for room in estimator.counts)
 
     if plot:
+        plt = pyplot()
         def idleHistogram(curr_pos = 0, plots = None, **kwargs):
-            #TODO: incorporate percentileToAvg
-            try:
-                plt.hist(plots.values()[curr_pos], 60, facecolor='green', alpha=0.75)
-            except IndexError:
-                print plots.keys()[curr_pos] + " had no individual idle times"
+            room, counts = plots.items()[curr_pos]
+            observed = np.flatnonzero(counts)
+            if len(observed):
+                plt.hist(np.arange(MINUTES_PER_DAY), 60, range=(observed[0], observed[-1] + 1), weights=counts,
+                         facecolor='green', alpha=0.75)
+                plt.axvline(ideals[room], color='black', linestyle='--', label='Ideal')
+            else:
+                print room + " had no individual idle times"
             plt.xlabel('Individual Idle Times')
             plt.ylabel('Occurences')
-            plt.title(plots.keys()[curr_pos])
+            plt.title(room)
             plt.grid(True)
 
-        flipThruPlotter(idleHistogram, ideals)
-
-    # reduce to an integer
-    for room, l in ideals.items():
-        if not onlyBest:
-            upperIndex = int(len(l) * percentileToAvg) - 1
-            upperIndex = max(upperIndex, 0)
-            l = sum(l[:upperIndex]) / (upperIndex+1)
-            ideals[room] = l
-        else:
-            try:
-                best = ideals[room].pop(0)
-                ideals[room] = best
-            except IndexError:
-                print room + " had no individual idle times"
-                ideals[room] = 0
+        flipThruPlotter(idleHistogram, estimator.counts)
 
     # Debugging
     for room, l in ideals.items():
@@ -215,6 +920,210 @@ def calculateIdealIdles(roomIdles, percentileToAvg=-1, plot=False):
     return ideals
 
 
+class RoomFenwickTrees(object):
+    """
+    One Fenwick tree (binary indexed tree) per room over the minutes of a day, counting idles of each length and
+    summing their minutes. Adding or removing idles and finding the k-th fastest idle of every room take
+    O(log MINUTES_PER_DAY) steps, each a NumPy operation over all rooms at once
+    """
+
+    SIZE = MINUTES_PER_DAY
+    TOP_BIT = 1 << (MINUTES_PER_DAY.bit_length() - 1) # highest power of 2 <= SIZE, where binary lifting starts
+
+    def __init__(self, numRooms):
+        self.counts = np.zeros((numRooms, self.SIZE + 1), dtype=np.int64) # 1-based, index 0 unused
+        self.minutes = np.zeros((numRooms, self.SIZE + 1), dtype=np.int64)
+        self.totals = np.zeros(numRooms, dtype=np.int64)
+
+    def update(self, rooms, idles, signs):
+        """
+        Adds idles, an array of idle minutes, to the trees of rooms, an array of their room codes, where signs is 1, and
+        takes them back out where it's -1. Every tree node the idles touch is gathered first and updated at once
+        """
+        self.totals += np.bincount(rooms, signs, minlength=len(self.totals)).astype(np.int64)
+        positions = idles.astype(np.int64) + 1
+        nodes, deltas, weights = [], [], []
+        while len(positions):
+            nodes.append(rooms * (self.SIZE + 1) + positions)
+            deltas.append(signs)
+            weights.append(signs * idles)
+            positions = positions + (positions & -positions)
+            inTree = positions <= self.SIZE
+            rooms, positions, signs, idles = rooms[inTree], positions[inTree], signs[inTree], idles[inTree]
+        if nodes:
+            touched, inverse = np.unique(np.concatenate(nodes), return_inverse=True) # np.add.at is much slower
+            self.counts.ravel()[touched] += np.bincount(inverse, np.concatenate(deltas)).astype(np.int64)
+            self.minutes.ravel()[touched] += np.bincount(inverse, np.concatenate(weights)).astype(np.int64)
+
+    def kth(self, rooms, k):
+        """
+        Returns the k-th fastest idle, 1-based, of each of rooms, by binary lifting. k must be at most their counts
+        """
+        position = np.zeros(len(rooms), dtype=np.int64)
+        remaining = np.asarray(k, dtype=np.int64).copy()
+        bit = self.TOP_BIT
+        while bit:
+            step = position + bit
+            valid = step <= self.SIZE
+            below = np.where(valid, self.counts[rooms, np.minimum(step, self.SIZE)], 0)
+            taken = valid & (below < remaining)
+            position[taken] = step[taken]
+            remaining[taken] -= below[taken]
+            bit >>= 1
+        return position # the 1-based position after the last one with fewer than k idles, as a minute
+
+    def prefix(self, rooms, minutes):
+        """
+        Returns the number of idles and their total minutes of each of rooms that are at most minutes long
+        """
+        positions = np.asarray(minutes, dtype=np.int64) + 1
+        count = np.zeros(len(rooms), dtype=np.int64)
+        total = np.zeros(len(rooms), dtype=np.int64)
+        while positions.any():
+            inTree = positions > 0
+            count[inTree] += self.counts[rooms[inTree], positions[inTree]]
+            total[inTree] += self.minutes[rooms[inTree], positions[inTree]]
+            positions = positions - (positions & -positions)
+        return count, total
+
+
+class WindowedIdealEstimator(object):
+    """
+    Ideal idle times of each room estimated from the idles of a sliding window of days only, as IdealIdleEstimator
+    estimates them from every day. Days are added in chronological order, and days that fall out of the window are
+    evicted, each in O(log MINUTES_PER_DAY) steps per idle, so sliding over years costs about one pass over them
+    """
+
+    def __init__(self, roomNames, window, percentileToAvg=-1, percentile=None):
+        """
+        Inputs:
+        roomNames - names of the room codes idles are added with
+        window - number of days up to and including the latest added day whose idles make up the estimate
+        percentileToAvg, percentile - how ideals are estimated, as for calculateIdealIdles()
+        """
+        self.roomNames = roomNames
+        self.window = window
+        self.percentileToAvg = percentileToAvg
+        self.percentile = percentile
+        self.trees = RoomFenwickTrees(len(roomNames))
+        self.days = collections.deque() # (ordinal, rooms, idles) of the days in the window
+        self.last = np.zeros(len(roomNames), dtype=np.int64) # ideals of the last estimate
+
+    def addDay(self, ordinal, rooms, idles):
+        """
+        Inputs:
+        ordinal - date ordinal of the day, no earlier than the last one added
+        rooms, idles - the room code and minutes of each of the day's idles between surgeries
+
+        Days that end up out of the window are evicted
+        """
+        updates = [(rooms, idles, 1)] if len(idles) else []
+        while self.days and self.days[0][0] <= ordinal - self.window:
+            _, oldRooms, oldIdles = self.days.popleft()
+            updates.append((oldRooms, oldIdles, -1))
+        if updates: # one update of the day's idles and the evicted days' together
+            self.trees.update(np.concatenate([r for r, _, _ in updates]).astype(np.int64),
+                              np.concatenate([i for _, i, _ in updates]).astype(np.int64),
+                              np.concatenate([np.full(len(i), sign, dtype=np.int64) for _, i, sign in updates]))
+        if len(idles):
+            self.days.append((ordinal, rooms, idles))
+
+    def ideals(self):
+        """
+        Returns an array of every room code's ideal idle time estimated from the window. Rooms without idles in the
+        window keep the ideal of their last estimate, 0 before they had one
+        """
+        rooms = np.flatnonzero(self.trees.totals)
+        counts = self.trees.totals[rooms]
+        if self.percentile is not None:
+            self.last[rooms] = self.trees.kth(rooms, np.maximum(np.ceil(self.percentile * counts).astype(np.int64), 1))
+        elif 0 < self.percentileToAvg <= 1:
+            k = np.maximum((counts * self.percentileToAvg).astype(np.int64), 1)
+            kth = self.trees.kth(rooms, k)
+            below, belowMinutes = self.trees.prefix(rooms, kth - 1)
+            self.last[rooms] = (belowMinutes + (k - below) * kth) // k
+        else:
+            self.last[rooms] = self.trees.kth(rooms, np.ones(len(rooms), dtype=np.int64))
+        return self.last.copy()
+
+
+class RollingIdeals(object):
+    """
+    Ideal idle time of each room on each day, e.g. estimated over a trailing window by calculateRollingIdeals(). The
+    ideal in effect on a day is the one estimated on it, or on the last day before it that has one
+    """
+
+    def __init__(self, ordinals, roomNames, ideals):
+        """
+        Inputs:
+        ordinals - chronological date ordinals of the days ideals were estimated on
+        roomNames - names of the rooms, one per column of ideals
+        ideals - days x rooms array of ideal idle times
+        """
+        self.ordinals = ordinals
+        self.roomNames = roomNames
+        self.ideals = ideals
+
+    def on(self, date):
+        """
+        Returns a dict where keys are rooms and values are their ideal idle times in effect on date, 0 before the first
+        """
+        day = np.searchsorted(self.ordinals, date.toordinal(), side='right') - 1
+        return dict((room, int(self.ideals[day, i]) if day >= 0 else 0) for i, room in enumerate(self.roomNames))
+
+    def latest(self):
+        """
+        Returns the dict of on() the last day
+        """
+        return dict((room, int(ideal)) for room, ideal in zip(self.roomNames, self.ideals[-1].tolist())) \
+            if len(self.ordinals) else dict((room, 0) for room in self.roomNames)
+
+    def runIdeals(self, tableIdles):
+        """
+        Returns the ideal in effect for every run of tableIdles, on its day and in its room. 0 for rooms without one
+        """
+        columns = dict((room, i) for i, room in enumerate(self.roomNames))
+        roomColumns = np.array([columns.get(room, -1) for room in tableIdles.roomNames] or [-1], dtype=np.int64)
+        days = np.searchsorted(self.ordinals, tableIdles.runDates, side='right') - 1
+        runColumns = roomColumns[tableIdles.runRooms]
+        known = (days >= 0) & (runColumns >= 0)
+        ideals = np.zeros(len(tableIdles.runDates), dtype=np.int64)
+        ideals[known] = self.ideals[days[known], runColumns[known]]
+        return ideals
+
+
+@instrument.timed('calculateRollingIdeals')
+def calculateRollingIdeals(tableIdles, window, percentileToAvg=-1, percentile=None, dates=None):
+    """
+    Inputs:
+    tableIdles - a TableIdles of idles between surgeries, without trailing idles, as ideals are estimated from
+    window - number of days, up to and including each day, whose idles that day's ideal is estimated from
+    percentileToAvg, percentile - how ideals are estimated, as for calculateIdealIdles()
+    dates - ordinals of extra days to estimate ideals on, e.g. every day with procedures, even without such idles
+
+    Outputs:
+    A RollingIdeals with the ideal of each room on every day with idles or in dates. Each is exactly what
+    calculateIdealIdles() estimates from only that window's idles, or the room's previous ideal if it had none in it
+    """
+
+    runs = np.append(np.flatnonzero(np.diff(np.concatenate(([-1], tableIdles.runDates)))), len(tableIdles.runDates))
+    idleDays = tableIdles.runDates[runs[:-1]]
+    ordinals = np.union1d(idleDays, dates if dates is not None else [])
+    estimator = WindowedIdealEstimator(tableIdles.roomNames, window, percentileToAvg, percentile)
+    idleRooms = tableIdles.idleRooms().astype(np.int64)
+    ideals = np.zeros((len(ordinals), len(tableIdles.roomNames)), dtype=np.int64)
+    day = 0
+    for i, ordinal in enumerate(ordinals.tolist()):
+        if day < len(idleDays) and idleDays[day] == ordinal:
+            first, stop = tableIdles.offsets[runs[day]], tableIdles.offsets[runs[day + 1]]
+            estimator.addDay(ordinal, idleRooms[first:stop], tableIdles.idles[first:stop])
+            day += 1
+        else:
+            estimator.addDay(ordinal, idleRooms[:0], tableIdles.idles[:0])
+        ideals[i] = estimator.ideals()
+    return RollingIdeals(ordinals.astype(np.int64), list(tableIdles.roomNames), ideals)
+
+
 def makeRoomsDict(procs):
     rooms = {}
     for proc in procs:
@@ -225,6 +1134,7 @@ def makeRoomsDict(procs):
     return rooms
 
 
+@instrument.timed('idleDictsToTuples')
 def idleDictsToTuples(dictsOfIdles):
     """
     Inputs:
@@ -258,34 +1168,194 @@ def idleDictsToTuples(dictsOfIdles):
     return roomPlots
 
 
-def dailyIdlePlot(curr_pos=0, plots=None, ax=None, excel=None):
-    rooms = plots[0][curr_pos][0]
+def dailyIdleFrame(curr_pos=0, plots=None, excel=None, dates=None, **kwargs):
+    """
+    Returns what dailyIdlePlot() draws for day curr_pos of plots, a list of plotTuples() outputs: a dict of the day's
+    rooms, each plot's cumulative idles per room and block as an array, and the title
+    """
+    if not dates: # plots have a day per day with procedures, which needn't be consecutive or start with the first row
+        dates = dayDates(excel.procs)
+    currDay = dates[curr_pos].isoformat()[:10]
+    cumIdles = []
+    for rooms, cumulatives in (p[curr_pos] for p in plots):
+        numBlocks = len(cumulatives[0]) if cumulatives else 0
+        cumIdles.append(np.array(cumulatives, dtype=float).reshape(len(rooms), numBlocks))
+    return {'rooms': plots[0][curr_pos][0], 'cumIdles': cumIdles, 'title': currDay}
+
+def dailyIdlePlot(curr_pos=0, plots=None, ax=None, excel=None, dates=None, frame=None, artists=None):
+    """
+    Draws a stacked bar per room and plot of each block's cumulative idle time on day curr_pos
+
+    Inputs:
+    frame - dailyIdleFrame() of the day, computed here if not given
+    artists - what an earlier call on ax returned. Its bars are updated in place while the day fits in them, so that
+    flipping through days doesn't rebuild the axes, ticks and legend
+
+    Outputs:
+    artists - to pass to the next call on ax
+    """
+
+    frame = frame or dailyIdleFrame(curr_pos, plots, excel, dates)
+    rooms = frame['rooms']
+    numBlocks = frame['cumIdles'][0].shape[1]
+    if artists is None or len(rooms) > artists['rooms'] or numBlocks > artists['blocks']:
+        if artists is not None:
+            ax.cla()
+        return drawDailyIdles(ax, frame)
+
+    for plotNum, cumIdles in enumerate(frame['cumIdles']):
+        start = np.zeros(artists['rooms'])
+        for i in range(artists['blocks']):
+            block = np.zeros(artists['rooms'])
+            if i < numBlocks:
+                block[:len(rooms)] = cumIdles[:, i]
+            for j, bar in enumerate(artists['bars'][plotNum][i]):
+                visible = j < len(rooms) and i < numBlocks
+                bar.set_y(start[j])
+                bar.set_height(block[j])
+                bar.set_visible(visible)
+                bar.sticky_edges.y[:] = [start[j]] if visible else [] # as bar() sets them, for autoscaling
+            start += block
+
+    if numBlocks != artists['shownBlocks']:
+        ax.legend(artists['bars'][0][:numBlocks], ['Block ' + str(i + 1) for i in range(numBlocks)],
+                  bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+        artists['shownBlocks'] = numBlocks
+    width = IDLE_BAR_WIDTH
+    if rooms != artists['labels']:
+        ax.set_xticks(np.arange(len(rooms)) + width / 2)
+        ax.set_xticklabels(rooms, rotation=90)
+        artists['labels'] = rooms
+    # The visible bars' extent, as relim() would find it from every bar, but without visiting them
+    top = max(cumIdles.sum(axis=1).max() if cumIdles.size else 0 for cumIdles in frame['cumIdles'])
+    ax.dataLim.set_points(np.array([[-width / 2, 0], [len(rooms) - 1 + width * (len(frame['cumIdles']) - 0.5), top]]))
+    ax.autoscale_view()
+    ax.set_title(frame['title'])
+    return artists
+
+def drawDailyIdles(ax, frame):
+    """
+    Draws frame, a dailyIdleFrame(), on an empty ax. Returns its bars, as artists for dailyIdlePlot()
+    """
+    rooms = frame['rooms']
     ind = np.arange(len(rooms))
-    width = 0.2
+    width = IDLE_BAR_WIDTH
     palette = ['#a8e6ce', '#dcedc2', '#ffd3b5', '#ffaaa6', '#ff8c94']
 
-    for plotNum in range(len(plots)):
-        cumIdles = plots[plotNum][curr_pos][1]
+    bars = []
+    for plotNum, cumIdles in enumerate(frame['cumIdles']):
         start = [0]*len(cumIdles)
-        for i in range(len(cumIdles[0])):
+        bars.append([])
+        for i in range(cumIdles.shape[1]):
             color = palette[i % len(palette)]
-            block = [c[i] for c in cumIdles]
+            block = cumIdles[:, i].tolist()
             if plotNum == 0: # Don't create duplicate labels
-                ax.bar(ind + width*plotNum, block, width, color=color, bottom=start, label='Block ' + str(i + 1))
+                bars[-1].append(ax.bar(ind + width*plotNum, block, width, color=color, bottom=start,
+                                       label='Block ' + str(i + 1)))
             else:
-                ax.bar(ind + width*plotNum, block, width, color=color, bottom=start)
+                bars[-1].append(ax.bar(ind + width*plotNum, block, width, color=color, bottom=start))
             start = map(lambda x, y: x + y, start, block)
 
 
-    plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+    ax.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
     ax.set_xticks(ind + width / 2)
     ax.set_xticklabels(rooms, rotation=90)
-    currDay = (excel.procs[0].date + dt.timedelta(days=curr_pos)).isoformat()[:10]
-    ax.set_title(currDay)
+    ax.set_title(frame['title'])
     ax.set_ylabel('Minutes')
+    numBlocks = frame['cumIdles'][0].shape[1]
+    return {'bars': bars, 'rooms': len(rooms), 'blocks': numBlocks, 'shownBlocks': numBlocks, 'labels': rooms}
 
 
-def flipThruPlotter(plotFunction, plots, multiple=False, **kwargs):
+class FrameCache(object):
+    """
+    Bounded LRU cache of the frames flipThruPlotter() shows, each computed by frameFunction(position) when first
+    needed, or ahead of time by a background thread. frameFunction must not touch matplotlib, which isn't thread safe
+    """
+
+    def __init__(self, frameFunction, size=FRAME_CACHE_SIZE):
+        self.frameFunction = frameFunction
+        self.size = size
+        self.frames = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def get(self, position):
+        with self.lock:
+            frame = self.frames.pop(position, None)
+        if frame is None:
+            frame = self.frameFunction(position)
+        self.put(position, frame)
+        return frame
+
+    def put(self, position, frame):
+        with self.lock:
+            self.frames.pop(position, None)
+            self.frames[position] = frame
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+
+    def prerender(self, positions):
+        """
+        Computes the frames at positions in the background, nearest first, dropping any still queued from before
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work)
+            self.thread.daemon = True
+            self.thread.start()
+        while not self.queue.empty():
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        for position in positions:
+            self.queue.put(position)
+
+    def work(self):
+        while True:
+            position = self.queue.get()
+            if position is None:
+                return
+            with self.lock:
+                cached = position in self.frames
+            if not cached:
+                self.put(position, self.frameFunction(position))
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+
+def flipThruPlotter(plotFunction, plots, multiple=False, frameFunction=None, cacheSize=FRAME_CACHE_SIZE, **kwargs):
+    """
+    Shows plotFunction(curr_pos=i, plots=plots, ax=ax, **kwargs) of the first plot, flipping to the next or previous
+    one with the right and left arrow keys
+
+    Inputs:
+    plots - the data to plot, one item per plot, or with multiple, a list of such lists that are plotted together
+    frameFunction - computes what plotFunction draws, as frameFunction(curr_pos=i, plots=plots, **kwargs). If given,
+    frames are kept in a FrameCache of cacheSize, the ones next to the shown one are computed in the background, and
+    plotFunction is also passed frame and the artists it returned last, so that it updates them instead of the axes
+    being cleared and drawn again
+    """
+
+    numPlots = len(plots[0]) if multiple else len(plots)
+    frames = None
+    if frameFunction is not None:
+        frames = FrameCache(lambda i: frameFunction(curr_pos=i, plots=plots, **kwargs), cacheSize)
+    artists = [None]
+
+    def show(i):
+        with instrument.stage('render', rows=1):
+            if frames is None:
+                ax.cla()
+                plotFunction(curr_pos=i, plots=plots, ax=ax, **kwargs)
+            else:
+                artists[0] = plotFunction(curr_pos=i, plots=plots, ax=ax, frame=frames.get(i), artists=artists[0],
+                                          **kwargs)
+                near = [i + sign * step for step in range(1, PRERENDER_FRAMES + 1) for sign in (1, -1)]
+                frames.prerender([j % numPlots for j in near])
 
     # Closure is needed so that key_event can write to curr_pos
     def callback():
@@ -297,49 +1367,69 @@ def flipThruPlotter(plotFunction, plots, multiple=False, **kwargs):
                 curr_pos[0] -= 1
             else:
                 return
-            curr_pos[0] = curr_pos[0] % len(plots[0]) if multiple else curr_pos[0] % len(plots)
-            ax.cla()
-            plotFunction(curr_pos = curr_pos[0], plots=plots, **kwargs)
-            fig.canvas.draw()
+            curr_pos[0] = curr_pos[0] % numPlots
+            show(curr_pos[0])
+            fig.canvas.draw_idle() # repeated key presses only redraw once
         return key_event
 
+    plt = pyplot()
     fig = plt.figure()
     fig.canvas.mpl_connect('key_press_event', callback())
     ax = fig.add_subplot(111)
     box = ax.get_position()
     ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])  # make room for legend
-    kwargs['ax'] = ax
-    plotFunction(curr_pos = 0, plots = plots, **kwargs)
-    plt.show()
+    show(0)
+    try:
+        plt.show()
+    finally:
+        if frames is not None:
+            frames.stop()
+
+@instrument.timed('roomIdlesMinusIdeals')
+def roomIdlesMinusIdeals(roomIdles, ideals, dates=None):
+    """
+    Inputs:
+    roomIdles - a list of dicts of idles, one per day, as findIdles() returns them
+    ideals - a dict of each room's ideal idle time, or RollingIdeals of each day's, with the date of each day in dates
 
-def roomIdlesMinusIdeals(roomIdles, ideals):
+    Outputs:
+    realRoomIdles - roomIdles with every idle minus its room's ideal in effect that day, floored at 0
+    """
 
     realRoomIdles = []
-    for r in roomIdles:
+    for i, r in enumerate(roomIdles):
+        if hasattr(ideals, 'on'): # RollingIdeals, also when run as __main__
+            dayIdeals = ideals.on(dates[i])
+        else:
+            dayIdeals = ideals
         newIdles = {}
         for room, idles in r.items():
             newBlocks = []
             for block in idles:
-                newBlock = [max(indiv - ideals[room], 0) for indiv in block]
+                newBlock = [max(indiv - dayIdeals[room], 0) for indiv in block]
                 newBlocks.append(newBlock)
             newIdles[room] = newBlocks
         realRoomIdles.append(newIdles)
     return realRoomIdles
 
-def plotTrueIdleDist(roomIdles):
-
-    # TODO: do liberal too
-    allCumIdles = []
-    for r in roomIdles:
-        for room, idles in r.items():
-            allCumIdles.append(idles[0])
+def plotTrueIdleDist(roomIdles, liberalRoomIdles=None):
+    """
+    Inputs:
+    roomIdles - a list of dicts of conservative idles, one per day, e.g. the output of roomIdlesMinusIdeals()
+    liberalRoomIdles - the same days' liberal idles, drawn over the conservative ones if given
+    """
 
-    allCumIdles.sort()
-    # get rid of zeros
-    allCumIdles = [i for i in allCumIdles if i != 0]
+    def cumulativeIdles(dictsOfIdles):
+        allCumIdles = [sum(sum(block) for block in idles) for r in dictsOfIdles for idles in r.values()]
+        # get rid of zeros
+        return sorted(i for i in allCumIdles if i != 0)
 
     # the histogram of the data
-    n, bins, patches = plt.hist(allCumIdles, 60, facecolor='blue', alpha=0.75)
+    plt = pyplot()
+    plt.hist(cumulativeIdles(roomIdles), 60, facecolor='blue', alpha=0.75, label='Conservative')
+    if liberalRoomIdles is not None:
+        plt.hist(cumulativeIdles(liberalRoomIdles), 60, facecolor='green', alpha=0.5, label='Liberal')
+        plt.legend()
 
     plt.xlabel('Cumulative Idle Minutes per OR per Day')
     plt.ylabel('Occurences')
@@ -348,17 +1438,37 @@ def plotTrueIdleDist(roomIdles):
 
     plt.show()
 
-def printThresholdedDates(excel, realRoomIdles, room, threshold):
+def dayDates(procs):
+    """
+    Inputs:
+    procs - the procedures given to calculateIdleStats()
+
+    Outputs:
+    dates - the date of each day of calculateIdleStats()' output
+    """
+
+    if isinstance(procs, sa.ProcedureTable):
+        return [dt.datetime.fromordinal(int(d)) for d in np.unique(procs.date)]
+    return sorted(set(proc.date for proc in procs))
 
-    startDate = excel.procs[0].date
-    thresholdedDates = []
-    for i, roomIdle in enumerate(realRoomIdles):
-        if room in roomIdle:
-            flattenedList = [item for sublist in roomIdle[room] for item in sublist]
-            dailyCumulative = sum(flattenedList)
-            if dailyCumulative >= threshold:
-                date = (startDate + dt.timedelta(days=i)).isoformat()[:10]
-                thresholdedDates.append(date)
+def printThresholdedDates(excel, realRoomIdles, room, threshold, index=None):
+    """
+    Prints and returns the days with cumulative real idle >= threshold in room. Given an idleIndex.IdleIndex of
+    realRoomIdles, days are found by binary search instead of summing every day's idles
+    """
+
+    if index is not None:
+        thresholdedDates = [date.isoformat()[:10] for date in index.daysOver(room, threshold)]
+    else:
+        dates = dayDates(excel.procs)
+        thresholdedDates = []
+        for i, roomIdle in enumerate(realRoomIdles):
+            if room in roomIdle:
+                flattenedList = [item for sublist in roomIdle[room] for item in sublist]
+                dailyCumulative = sum(flattenedList)
+                if dailyCumulative >= threshold:
+                    date = dates[i].isoformat()[:10]
+                    thresholdedDates.append(date)
 
     print "\n\nDays with \"real\" cumulative idle time >= " +  str(threshold) + " minutes in " + str(room) + ":"
     for d in thresholdedDates:
@@ -368,31 +1478,115 @@ def printThresholdedDates(excel, realRoomIdles, room, threshold):
 def parseInputs():
     parser = argparse.ArgumentParser(description="Query excel file for days with daily cumulative \"real\" idle time "
                                                  "over a threshold")
-    parser.add_argument("filename", help="Excel file to read surgery data from")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
     parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data. If row, 1 refers "
                                             "to first row containing data, not necessarily first row of excel sheet",
                         required=True)
     parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data. If row, 1 refers ",
                         required=True)
+    parser.add_argument("-q", "--queries", help="File of threshold queries to answer instead of prompting for them, one "
+                                                "per line, e.g. 'room=\"OR 3\" min=60 from=01/01/16 to=03/31/16 "
+                                                "weekdays=Mon,Fri top=10'")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes to calculate idles with")
+    parser.add_argument("--state", help="File to keep results in between runs, so that a rerun only processes the rows "
+                                        "appended to the excel file since the last one. A CSV or Parquet file is only "
+                                        "read from where the last run stopped, but a workbook is still parsed from "
+                                        "its first row, so keep long histories as CSV or Parquet")
+    parser.add_argument("--rebuild", action="store_true", help="Reprocess every row, replacing the --state file")
+    parser.add_argument("--mmap", metavar="DIR", help="Keep the idles in this directory, memory-mapped, instead of in "
+                                                      "memory, for very long histories")
+    parser.add_argument("--plot", action="store_true", help="Flip through histograms of each room's idle times and "
+                                                            "plots of each day's idles before querying. Without it, "
+                                                            "matplotlib is never loaded")
+    parser.add_argument("-e", "--estimate", choices=ESTIMATES, default='conservative',
+                        help="Idles to plot and query: from the previous surgery's out of room time (conservative) or "
+                             "procedure end time (liberal). Both are computed")
+    parser.add_argument("--window", type=int, metavar="DAYS", help="Estimate each day's ideal idle times from only the "
+                                                                   "idles of the DAYS days up to it, instead of from "
+                                                                   "every day, so that ideals follow changes in practice")
+    parser.add_argument("--percentile", type=float, metavar="Q", help="Estimate ideal idle times as this quantile of "
+                                                                      "idle times, e.g. 0.1, instead of the fastest")
+    parser.add_argument("--memory-rows", type=int, metavar="ROWS",
+                        help="Hold about ROWS procedures in memory at a time, for exports larger than memory: files are "
+                             "read one at a time, CSV files ROWS rows at a time, sorted by day on disk, and idles are "
+                             "calculated a chunk of days at a time")
+    parser.add_argument("--spill-dir", help="Directory to sort on disk in with --memory-rows. Defaults to the system's "
+                                            "temporary directory")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
 
     args = parser.parse_args()
-
-    # TODO: fix plotTrueIdleDist()
+    instrument.fromArgs(args)
 
     # should be 'Report for Dr Stehr_Jean Walrand 2016.xlsx', 1, 1000
-    excel = sa.StatAggregator(args.filename, min= args.min, max=args.max) #TODO: ensure valid file name and exists
-    ideals, roomIdles = calculateIdleStats(excel.procs)
-    realRoomIdles = roomIdlesMinusIdeals(roomIdles, ideals)
-    # plotTrueIdleDist(realRoomIdles)
-    roomPlots = idleDictsToTuples(roomIdles)
-    realRoomPlots = idleDictsToTuples(realRoomIdles)
-    flipThruPlotter(dailyIdlePlot, [roomPlots, realRoomPlots], multiple=True, excel=excel)
+    if args.state and args.estimate != 'conservative':
+        parser.error("--state only keeps conservative idles")
+    if args.state and len(args.filename) != 1:
+        parser.error("--state reads a single file")
+    if args.memory_rows and (args.state or args.window):
+        parser.error("--state and --window need every procedure in memory, so can't be used with --memory-rows")
+    if args.memory_rows and args.quality_report:
+        parser.error("--quality-report can't be written with --memory-rows, as files are validated a chunk at a time")
+    dates = None
+    if args.state:
+        import incrementalState
+        excel = None
+        state = incrementalState.fromArgs(args)
+        procs = state.procs
+        ideals = calculateIdealIdles(state.estimator, plot=args.plot, percentile=args.percentile)
+        roomIdles = state.roomIdles
+    elif args.memory_rows:
+        import multiSource
+        excel = procs = None
+        options = dict(min=args.min, max=args.max, streaming=not args.full_load, sortedByDate=args.sorted, cache=None,
+                       format=args.format, invalid=args.invalid)
+        sources = multiSource.expandSources(args.filename)
+        with dayIndex.sortSources(sources, options, args.memory_rows, args.spill_dir) as sorter:
+            dates = sorter.dayIndex().dates(empty=False)
+            estimateIdeals, estimateIdles = calculateChunkEstimates(sorter.chunks(dedupe=len(sources) > 1),
+                                                                    plot=(args.estimate,) if args.plot else (),
+                                                                    percentile=args.percentile)
+        ideals, roomIdles = estimateIdeals[args.estimate], estimateIdles[args.estimate]
+    else:
+        excel = sa.StatAggregator.fromArgs(args) #TODO: ensure valid file name and exists
+        procs = excel.procs
+        estimateIdeals, estimateIdles = calculateTableEstimates(procs, workers=args.workers,
+                                                                plot=(args.estimate,) if args.plot else (),
+                                                                percentile=args.percentile)
+        ideals, roomIdles = estimateIdeals[args.estimate], estimateIdles[args.estimate]
+        # plotTrueIdleDist(list(estimateIdles['conservative'].minus(estimateIdeals['conservative']).days()),
+        #                  list(estimateIdles['liberal'].minus(estimateIdeals['liberal']).days()))
+    if args.window:
+        ideals = calculateRollingIdeals(tableIdles(procs, args.estimate), args.window, percentile=args.percentile,
+                                        dates=np.unique(procs.date))
+        for room, ideal in sorted(ideals.latest().items()):
+            print "Ideal idle time for " + room + " over the last " + str(args.window) + " days is " + str(ideal) + \
+                  " minutes"
+    if args.mmap:
+        roomIdles.save(args.mmap)
+        roomIdles = TableIdles.load(args.mmap, mmap=True)
+
+    # Idles stay in flat arrays: real idles, cumulative idles and padded plots are computed on them
+    realRoomIdles = roomIdles.minus(ideals)
+    if args.plot: # padded plots of every day are only built to be flipped through
+        roomPlots = roomIdles.plotTuples()
+        realRoomPlots = realRoomIdles.plotTuples()
+        flipThruPlotter(dailyIdlePlot, [roomPlots, realRoomPlots], multiple=True, frameFunction=dailyIdleFrame,
+                        dates=dates or dayDates(procs))
+
+    index = idleIndex.IdleIndex.fromTableIdles(realRoomIdles)
+    if args.queries:
+        with open(args.queries) as queries:
+            index.runQueries(queries)
+        return
 
     while True:
         print "\n"
         room = raw_input("Enter room: ")
         threshold = raw_input("Enter threshold, in minutes:")
-        printThresholdedDates(excel, realRoomIdles, room, int(threshold))
+        printThresholdedDates(excel, realRoomIdles, room, int(threshold), index=index)
 
 if __name__ == "__main__":
     parseInputs()
@@ -0,0 +1,335 @@
+"""
+Day alignment of procedures read in any order, and an external sort by day for exports larger than memory.
+
+A DayIndex maps every calendar day from the first to the last procedure, including days without procedures, to the
+range of its procedures in day order, so day i is always the date first + i, however rows were ordered or spaced.
+
+A DaySorter takes procedures in any order, a table at a time, and hands them back in tables of whole days in
+chronological order. It holds at most about maxRows procedures in memory: when more have been added, they're sorted by
+day and spilled to disk as a run, in pages. Handing them back reads, for each chunk of days, the pages of every run that
+hold them, so only a page of every run and one chunk are in memory at once. A day's procedures keep the order they were
+added in.
+"""
+
+import datetime as dt
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import instrument
+import multiSource
+import statAggregator as sa
+
+SORT_ROWS = 1000000 # procedures a DaySorter holds in memory before spilling them to disk, and per chunk it hands back
+PAGE_ROWS = 65536 # procedures per file of a spilled run, at most
+
+
+class DayIndex(object):
+    """
+    Procedures of a table grouped by calendar day. Day i, the date with ordinal first + i, has the rows
+    order[offsets[i]:offsets[i + 1]] of the table, in table order. Days without procedures have equal offsets
+    """
+
+    def __init__(self, ordinals):
+        """
+        Inputs:
+        ordinals - the date ordinal of every procedure, e.g. a ProcedureTable's date column, in any order
+        """
+        ordinals = np.asarray(ordinals)
+        if len(ordinals) and np.any(ordinals[1:] < ordinals[:-1]):
+            self.order = np.argsort(ordinals, kind='mergesort') # stable, so each day's procedures keep their order
+        else:
+            self.order = None # already in chronological order
+        self.first = int(ordinals.min()) if len(ordinals) else 0
+        counts = np.bincount(ordinals - self.first) if len(ordinals) else np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    @staticmethod
+    def fromCounts(first, counts):
+        """
+        Returns the index of procedures already in chronological order, with counts[i] of them on day first + i
+        """
+        index = DayIndex([])
+        index.first = int(first)
+        index.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=index.offsets[1:])
+        return index
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def ordinals(self):
+        return self.first + np.arange(len(self))
+
+    def counts(self):
+        """
+        Returns the number of procedures on every day
+        """
+        return np.diff(self.offsets)
+
+    def nonEmpty(self):
+        """
+        Returns the positions of the days with procedures
+        """
+        return np.flatnonzero(self.counts())
+
+    def dates(self, empty=True):
+        """
+        Returns the date of every day, or without empty, of every day with procedures, as datetimes
+        """
+        days = np.arange(len(self)) if empty else self.nonEmpty()
+        return [dt.datetime.fromordinal(self.first + int(day)) for day in days]
+
+    def position(self, date):
+        """
+        Returns the position of date, a datetime or an ordinal, or None if it's before the first day or after the last
+        """
+        day = (date if isinstance(date, (int, long, np.integer)) else date.toordinal()) - self.first
+        return int(day) if 0 <= day < len(self) else None
+
+    def rows(self, start, stop=None):
+        """
+        Returns the rows of the table on days start up to stop, or on day start alone, as an index array or a slice
+        """
+        stop = start + 1 if stop is None else stop
+        first, last = self.offsets[start], self.offsets[stop]
+        return slice(first, last) if self.order is None else self.order[first:last]
+
+    def take(self, procs, start, stop=None):
+        """
+        Returns a ProcedureTable of procs' procedures on days start up to stop, or on day start alone, in day order
+        """
+        return procs.take(self.rows(start, stop))
+
+    def days(self, procs, empty=True):
+        """
+        Yields the date and ProcedureTable of procs' procedures of every day, or without empty, of every day with some
+        """
+        for day in (xrange(len(self)) if empty else self.nonEmpty()):
+            yield dt.datetime.fromordinal(self.first + int(day)), self.take(procs, day)
+
+    def split(self, numChunks):
+        """
+        Returns the days at which to cut the index into at most numChunks ranges of whole days with about equal numbers
+        of procedures, starting with 0 and ending with len(self)
+        """
+        dayStarts = self.offsets[:-1][self.nonEmpty()]
+        if not len(dayStarts):
+            return np.array([0, len(self)])
+        targets = np.arange(1, numChunks) * self.offsets[-1] // numChunks
+        cuts = dayStarts[np.searchsorted(dayStarts, targets).clip(0, len(dayStarts) - 1)]
+        cuts = np.searchsorted(self.offsets[:-1], cuts) # first day starting there, the first with procedures
+        return np.unique(np.concatenate(([0], cuts, [len(self)])))
+
+    def chunks(self, maxRows):
+        """
+        Returns (start, stop) ranges of whole days, in order, covering every day, each with at most maxRows procedures
+        unless one day has more
+        """
+        ranges = []
+        start = 0
+        while start < len(self):
+            stop = np.searchsorted(self.offsets, self.offsets[start] + maxRows, side='right') - 1
+            stop = max(int(stop), start + 1)
+            ranges.append((start, stop))
+            start = stop
+        return ranges
+
+
+def joinTables(tables, categories):
+    """
+    Returns one ProcedureTable of the rows of tables, in order, whose category codes all index into categories
+    """
+    return sa.ProcedureTable(dict((name, np.concatenate([getattr(t, name) for t in tables]))
+                                  for name in sa.ProcedureTable.COLUMNS), categories)
+
+
+class RunCursor(object):
+    """
+    Reads a spilled run of a DaySorter front to back, a page at a time
+    """
+
+    def __init__(self, directory, pages, categories):
+        self.directory = directory
+        self.pages = pages
+        self.categories = categories
+        self.next = 0 # next page to read
+        self.page = None # what's left of the last page read
+
+    def until(self, last):
+        """
+        Returns a list of tables of the run's procedures on days up to the ordinal last that weren't returned yet
+        """
+        pieces = []
+        while True:
+            if self.page is None:
+                if self.next == self.pages:
+                    return pieces
+                with np.load(os.path.join(self.directory, 'page%d.npz' % self.next), allow_pickle=True) as arrays:
+                    self.page = sa.ProcedureTable(dict((name, arrays[name]) for name in sa.ProcedureTable.COLUMNS),
+                                                  self.categories)
+                self.next += 1
+            stop = np.searchsorted(self.page.date, last, side='right')
+            pieces.append(self.page.take(slice(0, stop)))
+            if stop < len(self.page):
+                self.page = self.page.take(slice(stop, None))
+                return pieces
+            self.page = None
+
+
+class DaySorter(object):
+    """
+    External sort of procedures by day, as described above
+    """
+
+    def __init__(self, directory=None, maxRows=SORT_ROWS):
+        """
+        Inputs:
+        directory - where to make the temporary directory runs are spilled to. Defaults to the system's
+        maxRows - procedures to hold in memory before spilling them
+        """
+        self.parent = directory
+        self.directory = None # made on the first spill
+        self.maxRows = maxRows
+        self.categories = dict((name, []) for name in sa.ProcedureTable.CATEGORY_COLUMNS)
+        self.codes = dict((name, {}) for name in sa.ProcedureTable.CATEGORY_COLUMNS) # label -> code
+        self.buffer = [] # tables added since the last spill
+        self.buffered = 0
+        self.runs = [] # (directory, number of pages, DayIndex) of every spilled run
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, procs):
+        """
+        Adds a ProcedureTable of procedures, in any order. Its category codes are remapped onto the sorter's labels,
+        which only grow, so that the codes of every table handed back index into the same labels
+        """
+        columns = procs.columns()
+        for name in sa.ProcedureTable.CATEGORY_COLUMNS:
+            codes, labels = self.codes[name], self.categories[name]
+            mapping = []
+            for label in procs.categories[name]:
+                if label not in codes:
+                    codes[label] = len(labels)
+                    labels.append(label)
+                mapping.append(codes[label])
+            if mapping:
+                columns[name] = np.array(mapping, dtype=np.int16)[columns[name]]
+        self.buffer.append(sa.ProcedureTable(columns, self.categories))
+        self.buffered += len(procs)
+        self.rows += len(procs)
+        if self.buffered >= self.maxRows:
+            self.spill()
+
+    def spill(self):
+        """
+        Sorts the procedures added since the last spill by day and writes them to a new run, in pages of PAGE_ROWS
+        """
+        if not self.buffered:
+            return
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='choplotter-sort-', dir=self.parent)
+        with instrument.stage('spill', rows=self.buffered):
+            procs = joinTables(self.buffer, self.categories)
+            self.buffer, self.buffered = [], 0
+            index = DayIndex(procs.date)
+            procs = index.take(procs, 0, len(index))
+            run = os.path.join(self.directory, 'run%d' % len(self.runs))
+            os.mkdir(run)
+            pages = 0
+            for start in xrange(0, len(procs), PAGE_ROWS):
+                np.savez(os.path.join(run, 'page%d.npz' % pages), **procs.take(slice(start, start + PAGE_ROWS)).columns())
+                pages += 1
+            self.runs.append((run, pages, DayIndex.fromCounts(index.first, index.counts())))
+
+    def dayIndex(self):
+        """
+        Returns the DayIndex of every procedure added, in the order chunks() hands them back
+        """
+        indices = [index for _, _, index in self.runs]
+        if self.buffered:
+            indices.append(DayIndex(joinTables(self.buffer, self.categories).date))
+        indices = [index for index in indices if len(index)]
+        if not indices:
+            return DayIndex([])
+        first = min(index.first for index in indices)
+        counts = np.zeros(max(index.first + len(index) for index in indices) - first, dtype=np.int64)
+        for index in indices:
+            counts[index.first - first:index.first - first + len(index)] += index.counts()
+        return DayIndex.fromCounts(first, counts)
+
+    def chunks(self, maxRows=None, dedupe=False):
+        """
+        Yields ProcedureTables of whole days, in chronological order, with at most maxRows procedures each unless one day
+        has more. Defaults to the sorter's maxRows. A day's procedures keep the order they were added in. With dedupe, a
+        log number repeated on a day is only kept the first time, as multiSource.mergeTables() keeps it
+
+        If nothing was spilled, chunks are taken from memory instead of disk
+        """
+        maxRows = maxRows or self.maxRows
+        if not self.runs:
+            procs = joinTables(self.buffer, self.categories) if self.buffer else None
+            index = DayIndex(procs.date if procs is not None else [])
+            for start, stop in index.chunks(maxRows):
+                chunk = index.take(procs, start, stop)
+                yield multiSource.mergeTables([chunk])[0] if dedupe else chunk
+            return
+
+        self.spill()
+        index = self.dayIndex()
+        cursors = [RunCursor(run, pages, self.categories) for run, pages, _ in self.runs]
+        for start, stop in index.chunks(maxRows):
+            pieces = []
+            for cursor in cursors: # in the order runs were spilled, so days keep the order procedures were added in
+                pieces.extend(cursor.until(index.first + stop - 1))
+            with instrument.stage('merge runs') as stage:
+                chunk = joinTables(pieces, self.categories)
+                if dedupe:
+                    chunk = multiSource.mergeTables([chunk])[0]
+                else:
+                    chunkIndex = DayIndex(chunk.date)
+                    chunk = chunkIndex.take(chunk, 0, len(chunkIndex))
+                stage.rows = len(chunk)
+            yield chunk
+
+    def close(self):
+        """
+        Deletes the spilled runs
+        """
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.runs = []
+
+
+def sortSources(sources, options, maxRows=SORT_ROWS, directory=None):
+    """
+    Inputs:
+    sources - multiSource.Sources, e.g. from expandSources()
+    options - the other arguments of StatAggregator, applied to every source
+    maxRows, directory - as for DaySorter. CSV files are also read maxRows rows at a time
+
+    Outputs:
+    A DaySorter of the procedures of every source, read one source at a time, so that memory is bounded by the largest
+    workbook or Parquet file, or maxRows procedures, instead of by every source together
+    """
+
+    sorter = DaySorter(directory, maxRows)
+    for source in sources:
+        aggregator = sa.StatAggregator(source.path, sheet=source.sheet, tag=source.tag, chunkRows=maxRows, **options)
+        for procs in aggregator.tables():
+            sorter.add(procs)
+    print "Sorted " + str(len(sorter)) + " procedures from " + str(len(sources)) + " sources by day" + \
+          (", spilling " + str(len(sorter.runs)) + " runs to " + sorter.directory if sorter.runs else " in memory")
+    return sorter
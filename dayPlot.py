@@ -1,12 +1,16 @@
 import datetime as dt
 import argparse
+import numpy as np
 
+import dayIndex
+import instrument
 import statAggregator as sa
 import calculateIdles as ci
 
 
 def groupProcsByDay(procs):
 
+    procs = sorted(procs, key=lambda proc: proc.date) # stable, so each day's procedures keep their order
     dayList = []
     i = 0
     while i < len(procs): # Because i is incremented in inner loop, this outer while loop is iterated once per day
@@ -19,60 +23,140 @@ def groupProcsByDay(procs):
         dayList.append(todaysProcs)
     return dayList
 
-def dayPlot(curr_pos = 0, plots = None, ax=None):
-
-    barSpacing = 12
-    barWidth = 4
+def groupTableByDay(procs):
+    """
+    Inputs:
+    procs - a ProcedureTable, in any order
+
+    Outputs:
+    dayList - a list of ProcedureTables, one per day with procedures in chronological order. Procedures keep their
+    order within a day
+    """
+
+    index = dayIndex.DayIndex(procs.date)
+    return [index.take(procs, day) for day in index.nonEmpty()]
+
+BAR_SPACING = 12
+BAR_WIDTH = 4
+COLORS = ('#66b3ff', '#ffcc99', '#e67300') # scheduled, in room and procedure times
+HALF_HOURS = [30*i for i in range(48)]
+
+def minutesOf(procs, name):
+    """
+    Returns the name time or duration of each of procs, a ProcedureTable or a list of Procedures, in minutes, with
+    sa.MISSING for empty cells
+    """
+    if isinstance(procs, sa.ProcedureTable):
+        minutes = getattr(procs, name).astype(int)
+        if name in sa.ProcedureTable.DURATION_COLUMNS:
+            minutes = np.where(minutes == sa.MISSING, sa.MISSING, minutes % ci.MINUTES_PER_DAY)
+        return minutes
+    values = [getattr(proc, name) for proc in procs]
+    if name in sa.ProcedureTable.DURATION_COLUMNS:
+        return np.array([sa.MISSING if value is None else value.seconds/60 for value in values], dtype=int)
+    return np.array([sa.MISSING if value is None else value.hour * 60 + value.minute for value in values], dtype=int)
+
+def dayFrame(curr_pos=0, plots=None, **kwargs):
+    """
+    Returns what dayPlot() draws for plots[curr_pos], one day's procedures: a dict of the title, the rooms, the x
+    limits, and the corners of every scheduled, in room and procedure bar as an array of (bars, 4, 2) for each
+    """
 
     procs = plots[curr_pos]
-    if procs:
+    if len(procs):
         currDay = procs[0].date.isoformat()[:10]
     else:
         currDay = "No Procedures"
 
-    # Group the procedures by room
-    rooms = ci.makeRoomsDict(procs)
-
-    earliest = min(min([proc.schedStart.hour * 60 + proc.schedStart.minute for proc in procs]),
-                   min([proc.inRoom.hour * 60 + proc.inRoom.minute for proc in procs]))
-    latest = max(max([proc.schedEnd.hour * 60 + proc.schedEnd.minute for proc in procs]),
-                   max([proc.outRoom.hour * 60 + proc.outRoom.minute for proc in procs]))
-
-    for i, (room, l) in enumerate(rooms.items()):
-        schedTimes = [(proc.schedStart.hour * 60 + proc.schedStart.minute, proc.schedLength.seconds/60) for proc in l]
-        inOutTimes = [(proc.inRoom.hour * 60 + proc.inRoom.minute, proc.roomDuration.seconds/60) for proc in l]
-        procTimes = [(proc.procStart.hour * 60 + proc.procStart.minute, proc.procDuration.seconds/60) for proc in l]
-        ax.broken_barh(schedTimes, (barSpacing * i + barWidth + 1, barWidth), facecolors='#66b3ff')
-        ax.broken_barh(inOutTimes, (barSpacing * i + (barWidth + 1) * 2, barWidth), facecolors='#ffcc99')
-        ax.broken_barh(procTimes, (barSpacing * i + (barWidth + 1) * 2, barWidth), facecolors='#e67300')
-
-    ax.set_ylim(0, len(rooms) * barSpacing + (barWidth + 1) * 3)
-    ax.set_xlabel('Hour')
-    ax.set_ylabel('Room')
-    ax.set_yticks([barSpacing * i + (barWidth + 1) * 2 for i in range(len(rooms))])
-    ax.set_yticklabels(rooms.keys())
-    halfHourList = [30*i for i in range(48)]
-    ax.set_xticks(halfHourList)
-    ax.set_xticklabels([str(h/60) + ':' + str(h%60).zfill(2)  for h in halfHourList], rotation=90)
-    ax.set_xlim(earliest - 30, latest + 30)
-    ax.set_title(currDay)
-    ax.grid(True)
+    roomNames = [proc.room for proc in procs]
+    rooms = dict.fromkeys(roomNames).keys() # in the order of ci.makeRoomsDict()'s dict
+    position = dict((room, i) for i, room in enumerate(rooms))
+    rows = np.array([position[room] for room in roomNames], dtype=int)
+
+    starts = dict((name, minutesOf(procs, name)) for name in ('schedStart', 'inRoom', 'procStart', 'schedEnd',
+                                                               'outRoom'))
+    # Missing times, kept by the 'keep' validation policy, don't stretch the x axis
+    firsts = np.concatenate((starts['schedStart'], starts['inRoom']))
+    lasts = np.concatenate((starts['schedEnd'], starts['outRoom']))
+    firsts, lasts = firsts[firsts != sa.MISSING], lasts[lasts != sa.MISSING]
+    if len(firsts) and len(lasts):
+        xlim = (firsts.min() - 30, lasts.max() + 30)
+    else:
+        xlim = (0, ci.MINUTES_PER_DAY)
+
+    # Bars missing a time or a length have no length, at the scheduled start, as in timeline.Timeline
+    bars = []
+    for start, length, offset in (('schedStart', 'schedLength', BAR_WIDTH + 1),
+                                  ('inRoom', 'roomDuration', (BAR_WIDTH + 1) * 2),
+                                  ('procStart', 'procDuration', (BAR_WIDTH + 1) * 2)):
+        lengths = minutesOf(procs, length)
+        valid = (starts[start] != sa.MISSING) & (lengths > 0)
+        x0 = np.where(valid, starts[start], starts['schedStart'])
+        x1 = x0 + np.where(valid, lengths, 0)
+        y0 = BAR_SPACING * rows + offset
+        y1 = y0 + BAR_WIDTH
+        bars.append(np.dstack((np.column_stack((x0, x0, x1, x1)), np.column_stack((y0, y1, y1, y0)))).astype(float))
+
+    return {'title': currDay, 'rooms': rooms, 'xlim': xlim, 'bars': bars}
+
+def dayPlot(curr_pos = 0, plots = None, ax=None, frame=None, artists=None):
+    """
+    Draws a row per room of the scheduled, in room and procedure times of each of the day's procedures
+
+    Inputs:
+    frame - dayFrame() of the day, computed here if not given
+    artists - what an earlier call on ax returned. Its bars are replaced in place, so that flipping through days
+    doesn't rebuild the axes and ticks
+
+    Outputs:
+    artists - to pass to the next call on ax
+    """
+
+    frame = frame or dayFrame(curr_pos, plots)
+    if artists is None:
+        from matplotlib.collections import PolyCollection
+        # One collection per color for every room, which draws the same as a broken_barh() per room and color
+        artists = {'bars': [ax.add_collection(PolyCollection([], facecolors=color)) for color in COLORS],
+                   'rooms': None}
+        ax.set_xlabel('Hour')
+        ax.set_ylabel('Room')
+        ax.set_xticks(HALF_HOURS)
+        ax.set_xticklabels([str(h/60) + ':' + str(h%60).zfill(2)  for h in HALF_HOURS], rotation=90)
+        ax.grid(True)
+    for collection, bars in zip(artists['bars'], frame['bars']):
+        collection.set_verts(bars)
+
+    rooms = frame['rooms']
+    if rooms != artists['rooms']:
+        ax.set_ylim(0, len(rooms) * BAR_SPACING + (BAR_WIDTH + 1) * 3)
+        ax.set_yticks([BAR_SPACING * i + (BAR_WIDTH + 1) * 2 for i in range(len(rooms))])
+        ax.set_yticklabels(rooms)
+        artists['rooms'] = rooms
+    ax.set_xlim(*frame['xlim'])
+    ax.set_title(frame['title'])
+    return artists
 
 
 
 def parseInputs():
     parser = argparse.ArgumentParser(description="Query excel file for days with daily cumulative \"real\" idle time "
                                                  "over a threshold")
-    parser.add_argument("filename", help="Excel file to read surgery data from")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
     parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data. If row, 1"
                                             " refers to first row containing data, not necessarily first row of excel sheet",
                         required=True)
     parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data. If row, 1",
                         required=True)
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
     args = parser.parse_args()
+    instrument.fromArgs(args)
 
-    excel = sa.StatAggregator(args.filename, min=args.min, max=args.max)  # TODO: ensure valid file name and exists
-    dayList = groupProcsByDay(excel.procs)
-    ci.flipThruPlotter(dayPlot, dayList)
+    excel = sa.StatAggregator.fromArgs(args)  # TODO: ensure valid file name and exists
+    dayList = groupTableByDay(excel.procs)
+    ci.flipThruPlotter(dayPlot, dayList, frameFunction=dayFrame)
 
-parseInputs()
\ No newline at end of file
+if __name__ == "__main__":
+    parseInputs()
\ No newline at end of file
@@ -0,0 +1,192 @@
+import argparse
+import csv
+import datetime as dt
+
+import numpy as np
+import openpyxl
+
+import statAggregator as sa
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+HEADER = ['', 'Date', 'Day', '', '', 'Sched Start', 'Sched End', 'Sched Length', 'In Room', 'Ready', 'Proc Start',
+          'Proc End', 'Out Room', 'Proc Duration', 'Room Duration', 'Room', 'Loc', '', 'Log Num'] # ProcedureParams' layout
+
+
+def generateColumns(rooms=10, days=30, blocksPerDay=3, casesPerBlock=4, straddleRate=0.05, badDurationRate=0.01,
+                    start=dt.date(2016, 1, 4), seed=0):
+    """
+    Inputs:
+    rooms - number of ORs
+    days - number of consecutive days
+    blocksPerDay - most blocks a room has in a day. Each room-day has 1 to blocksPerDay
+    casesPerBlock - most cases in a block. Each block has 1 to casesPerBlock, scheduled back to back
+    straddleRate - fraction of room-days whose schedule starts late in the evening and runs past midnight
+    badDurationRate - fraction of procedures with a recorded duration that disagrees with their start and end times
+    start - date of the first day
+    seed - random seed, so that the same arguments always generate the same schedule
+
+    Outputs:
+    columns - dict in the format of statAggregator.ProcedureTableBuilder.extend(), in chronological order, then by room
+
+    Cases start late by a random delay, wait for the room to be turned over after the previous case, and run a bit
+    shorter or longer than scheduled. Generation is vectorized over every room-day, so millions of procedures take
+    seconds.
+    """
+
+    rng = np.random.RandomState(seed)
+    numRoomDays = rooms * days
+    slots = blocksPerDay * casesPerBlock
+
+    numBlocks = rng.randint(1, blocksPerDay + 1, numRoomDays)
+    numCases = rng.randint(1, casesPerBlock + 1, (numRoomDays, blocksPerDay))
+    dayStart = rng.choice([420, 450, 480], numRoomDays) # 7:00 to 8:00
+    straddles = rng.rand(numRoomDays) < straddleRate
+    dayStart[straddles] = rng.randint(21 * 60, 23 * 60, straddles.sum())
+    numBlocks[straddles] = 1 # an overnight room only runs one block
+
+    # Minutes from the start of the scheduled day, may pass midnight. One column per case slot of a room-day
+    columns = dict((name, np.zeros((numRoomDays, slots), dtype=np.int64)) for name in
+                   ('schedStart', 'schedEnd', 'inRoom', 'ready', 'procStart', 'procEnd', 'outRoom'))
+    active = np.zeros((numRoomDays, slots), dtype=bool)
+    schedEnd = dayStart.copy()
+    outRoom = np.zeros(numRoomDays, dtype=np.int64)
+    for slot in range(slots):
+        block, case = slot // casesPerBlock, slot % casesPerBlock
+        isActive = (block < numBlocks) & (case < numCases[:, block])
+        active[:, slot] = isActive
+
+        schedStart = schedEnd.copy()
+        if case == 0 and block > 0: # gap between blocks
+            schedStart += rng.choice([30, 60, 90, 120], numRoomDays)
+        length = rng.choice([30, 45, 60, 90, 120, 180, 240], numRoomDays)
+        delay = rng.randint(-10, 30, numRoomDays)
+        turnover = 15 + rng.exponential(20, numRoomDays).astype(np.int64)
+        inRoom = np.maximum(schedStart + delay, outRoom + turnover) if slot else schedStart + delay
+        ready = inRoom + rng.randint(5, 20, numRoomDays)
+        procStart = ready + rng.randint(0, 10, numRoomDays)
+        procEnd = procStart + (length * rng.uniform(0.7, 1.3, numRoomDays)).astype(np.int64)
+        newOutRoom = procEnd + rng.randint(5, 15, numRoomDays)
+
+        for name, values in (('schedStart', schedStart), ('schedEnd', schedStart + length), ('inRoom', inRoom),
+                             ('ready', ready), ('procStart', procStart), ('procEnd', procEnd),
+                             ('outRoom', newOutRoom)):
+            columns[name][:, slot] = values
+        schedEnd = np.where(isActive, schedStart + length, schedEnd)
+        outRoom = np.where(isActive, newOutRoom, outRoom)
+
+    # Flatten the active slots, which keeps them sorted by day, then room, then time
+    roomDay = np.nonzero(active)[0]
+    n = len(roomDay)
+
+    # Wrap times past midnight. 00:00 is nudged to 00:01, because a Procedure reads 0 as an empty cell
+    for name in sa.ProcedureTable.TIME_COLUMNS:
+        minutes = columns[name][active] % (24 * 60)
+        minutes[minutes == 0] = 1
+        columns[name] = minutes
+
+    bad = rng.rand(n) < badDurationRate
+    for name, (first, last) in (('schedLength', ('schedStart', 'schedEnd')), ('roomDuration', ('inRoom', 'outRoom')),
+                                ('procDuration', ('procStart', 'procEnd'))):
+        columns[name] = (columns[last] - columns[first]) % (24 * 60)
+        columns[name][bad] += rng.choice([-5, 5, 10], bad.sum())
+
+    for name in sa.ProcedureTable.TIME_COLUMNS:
+        columns[name] = columns[name] // 60 * 100 + columns[name] % 60
+
+    dayOfRoomDay = roomDay // rooms
+    columns['date'] = start.toordinal() + dayOfRoomDay
+    columns['day'] = np.array(DAYS, dtype=object)[(start.weekday() + dayOfRoomDay) % 7]
+    columns['room'] = np.array(['OR %02d' % r for r in range(rooms)], dtype=object)[roomDay % rooms]
+    columns['loc'] = np.array(['MAIN'] * n, dtype=object)
+    columns['logNum'] = np.arange(100000, 100000 + n)
+    return columns
+
+
+def generateTable(**kwargs):
+    """
+    Returns a ProcedureTable of generateColumns(**kwargs)' schedule, as StatAggregator would read it from a workbook
+    """
+    builder = sa.ProcedureTableBuilder()
+    builder.extend(generateColumns(**kwargs))
+    return builder.build()
+
+
+def iterRows(columns):
+    """
+    Yields one list of cell values per procedure of columns, in the column layout ProcedureParams reads
+    """
+    dates = {}
+    names = ['schedStart', 'schedEnd', 'schedLength', 'inRoom', 'ready', 'procStart', 'procEnd', 'outRoom',
+             'procDuration', 'roomDuration']
+    values = zip(*[columns[name].tolist() for name in ['date', 'day'] + names + ['room', 'loc', 'logNum']])
+    for row in values:
+        date = dates.get(row[0])
+        if date is None:
+            date = dates[row[0]] = dt.datetime.fromordinal(row[0])
+        yield [None, date, row[1], None, None] + list(row[2:12]) + [row[12], row[13], None, row[14]]
+
+
+def writeWorkbook(path, columns):
+    """
+    Writes columns to an xlsx workbook at path, streaming rows so memory stays flat
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(HEADER)
+    for row in iterRows(columns):
+        sheet.append(row)
+    wb.save(path)
+
+
+def writeCsv(path, columns):
+    """
+    Writes columns to a CSV file at path, one column per field of statAggregator.FIELDS, with ISO dates
+    """
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(sa.FIELDS)
+        for row in iterRows(columns):
+            writer.writerow([row[1].isoformat()[:10]] + row[2:3] + row[5:17] + row[18:])
+
+
+def writeParquet(path, columns, rowGroupSize=100000):
+    """
+    Writes columns to a Parquet file at path, one column per field of statAggregator.FIELDS, in row groups of
+    rowGroupSize procedures so that readers can skip the groups outside a date range
+    """
+    pyarrow, parquet = sa.importParquet()
+    arrays = []
+    for name in sa.FIELDS:
+        if name == 'date':
+            arrays.append(pyarrow.array([dt.date.fromordinal(d) for d in columns[name].tolist()], type=pyarrow.date32()))
+        else:
+            arrays.append(pyarrow.array(columns[name].tolist()))
+    parquet.write_table(pyarrow.Table.from_arrays(arrays, names=list(sa.FIELDS)), path, row_group_size=rowGroupSize)
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Write a synthetic OR schedule in the layout of the hospital exports")
+    parser.add_argument("filename", help="Excel, CSV or Parquet file to write, by extension")
+    parser.add_argument("-r", "--rooms", type=int, default=10, help="Number of ORs")
+    parser.add_argument("-d", "--days", type=int, default=30, help="Number of days")
+    parser.add_argument("-b", "--blocks", type=int, default=3, help="Most blocks per room per day")
+    parser.add_argument("-c", "--cases", type=int, default=4, help="Most cases per block")
+    parser.add_argument("--straddle-rate", type=float, default=0.05, help="Fraction of room-days running past midnight")
+    parser.add_argument("--bad-duration-rate", type=float, default=0.01,
+                        help="Fraction of procedures with an incorrect duration length")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    columns = generateColumns(rooms=args.rooms, days=args.days, blocksPerDay=args.blocks, casesPerBlock=args.cases,
+                              straddleRate=args.straddle_rate, badDurationRate=args.bad_duration_rate, seed=args.seed)
+    format = sa.fileFormat(args.filename)
+    if format == 'csv':
+        writeCsv(args.filename, columns)
+    elif format == 'parquet':
+        writeParquet(args.filename, columns)
+    else:
+        writeWorkbook(args.filename, columns)
+    print "Wrote " + str(len(columns['logNum'])) + " procedures to " + args.filename
+
+if __name__ == "__main__":
+    parseInputs()
@@ -0,0 +1,477 @@
+"""
+Aggregate cube of idles and procedure times, built once from the per day results so that questions like "average real
+idle per block by weekday for rooms 3-7 in Q2" or "room time per scheduled minute per room per month" are answered by
+summing a few precomputed arrays instead of rerunning the idle pipeline.
+
+The cube is a dense period x room x block array per measure. Blocks are numbered as TableIdles numbers them, so block
+1 of a room-day is the first block plotted by dailyIdlePlot(). Every measure adds up, so any slice rolls up by summing,
+and averages are the sum of one measure over the sum of another, e.g. realIdle per blocks. Days are rolled up into
+weeks, months and quarters when the cube is built, and a query is answered from the coarsest of them it fits, so
+quarterly questions about years of history sum a handful of periods. Weekdays, and windows that don't start and end
+on a level's period boundaries, are answered from days.
+
+Measures:
+procedures - number of procedures
+schedMinutes, roomMinutes, procMinutes - their scheduled, in room and procedure minutes
+idle, realIdle, idles - cumulative idle time with trailing idles, the same minus the room's ideal idle time, and the
+number of idles, for the conservative or liberal estimate
+blocks - number of blocks, 1 for each block that has procedures
+roomDays - number of room-days with procedures, counted in block 1
+
+For example, python idleCube.py report.xlsx -m 1 -M 100000 --cube cube.npz -q queries.txt with the query
+    measure=realIdle per=blocks by=weekday rooms="OR 0[3-7]" from=04/01/16 to=06/30/16
+"""
+
+import argparse
+import datetime as dt
+import fnmatch
+import json
+import os
+import shlex
+import tempfile
+
+import numpy as np
+
+import calculateIdles as ci
+import idleIndex
+import instrument
+import multiSource
+import statAggregator as sa
+
+CUBE_VERSION = 1 # bump whenever what's saved changes, to rebuild older cubes
+LEVELS = ('day', 'week', 'month', 'quarter') # finest first
+KEYS = LEVELS + ('weekday', 'room', 'block') # what queries group by
+DERIVABLE = {'day': KEYS, 'week': ('week',), 'month': ('month', 'quarter'), 'quarter': ('quarter',)} # time keys
+# that are the same for every day of one of a level's periods
+PROCEDURE_MEASURES = ('procedures', 'schedMinutes', 'roomMinutes', 'procMinutes')
+IDLE_MEASURES = ('idle', 'realIdle', 'idles')
+COUNT_MEASURES = ('blocks', 'roomDays')
+MEASURES = PROCEDURE_MEASURES + IDLE_MEASURES + COUNT_MEASURES
+
+
+def measureKey(measure, estimate='conservative'):
+    """
+    Returns the name the cube keeps measure under, e.g. 'conservativeRealIdle' for the estimate's idle measures
+    """
+    if measure not in MEASURES:
+        raise ValueError('Unknown measure ' + measure + '. Must be one of ' + ', '.join(MEASURES))
+    if measure in IDLE_MEASURES:
+        if estimate not in ci.ESTIMATES:
+            raise ValueError('Unknown estimate ' + estimate + '. Must be one of ' + ', '.join(ci.ESTIMATES))
+        return estimate + measure[0].upper() + measure[1:]
+    return measure
+
+
+def periodKeys(ordinals, key):
+    """
+    Returns the period of key, one of KEYS' time keys, that each day of ordinals falls in, as an int that increases
+    with time: the ordinal for days and the ordinal of its Monday for weeks, year * 12 + month - 1 for months, year * 4
+    + quarter - 1 for quarters, and 0 for Monday to 6 for Sunday for weekdays
+    """
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if key == 'day':
+        return ordinals
+    if key == 'weekday':
+        return (ordinals + 6) % 7 # ordinal 1 was a Monday
+    if key == 'week':
+        return ordinals - (ordinals + 6) % 7
+    months = np.array([date.year * 12 + date.month - 1 for date in map(dt.date.fromordinal, ordinals.tolist())],
+                      dtype=np.int64)
+    return months if key == 'month' else months // 3
+
+
+def periodBounds(keys, level):
+    """
+    Returns the ordinals of the first and last day of each of level's periods keys, as periodKeys() numbers them
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if level == 'day':
+        return keys, keys
+    if level == 'week':
+        return keys, keys + 6
+    months = keys * 3 if level == 'quarter' else keys
+    length = 3 if level == 'quarter' else 1
+    firsts = [dt.date(m // 12, m % 12 + 1, 1).toordinal() for m in months.tolist()]
+    nexts = [dt.date((m + length) // 12, (m + length) % 12 + 1, 1).toordinal() for m in months.tolist()]
+    return np.array(firsts, dtype=np.int64), np.array(nexts, dtype=np.int64) - 1
+
+
+def keyLabel(key, value):
+    """
+    Returns how value of key, as periodKeys() numbers periods, is printed: an ISO date for days and the Monday of weeks,
+    e.g. '2016-04' for months, '2016-Q2' for quarters, the name of weekdays, and 'Block 1' for the first block. Rooms
+    are their names
+    """
+    if key in ('day', 'week'):
+        return dt.date.fromordinal(int(value)).isoformat()
+    if key == 'month':
+        return '%d-%02d' % (value // 12, value % 12 + 1)
+    if key == 'quarter':
+        return '%d-Q%d' % (value // 4, value % 4 + 1)
+    if key == 'weekday':
+        return idleIndex.DAYS[value]
+    if key == 'room':
+        return value
+    return 'Block ' + str(value + 1)
+
+
+class IdleCube(object):
+
+    def __init__(self, rooms, keys, measures, meta=None):
+        """
+        Inputs:
+        rooms - names of the rooms along the room axis
+        keys - dict from each of LEVELS to its periods along the period axis, as periodKeys() numbers them, in order
+        measures - dict from each of LEVELS to a dict from measure names, as measureKey() gives them, to int32 arrays
+        of periods x rooms x blocks
+        meta - what the cube was built from, to tell whether a saved cube is still current
+        """
+        self.rooms = rooms
+        self.keys = keys
+        self.measures = measures
+        self.meta = meta or {}
+        self.bounds = dict((level, periodBounds(keys[level], level)) for level in LEVELS)
+
+    @staticmethod
+    @instrument.timed('cube build')
+    def build(procs, ideals, roomIdles, meta=None):
+        """
+        Inputs:
+        procs - a ProcedureTable
+        ideals, roomIdles - dicts from estimates to ideal idle times per room and TableIdles of procs' idles, including
+        trailing idles, as calculateTableEstimates() returns them
+        meta - as for IdleCube()
+
+        Outputs:
+        The cube of procs, with every level rolled up from its days
+        """
+
+        ordinals = np.unique(procs.date)
+        codes = np.unique(procs.room)
+        roomOf = np.zeros(len(procs.categories['room']) or 1, dtype=np.int64) # room code -> position on the room axis
+        roomOf[codes] = np.arange(len(codes))
+        runBlocks = ci.tableRunBlocks(procs)
+        shape = (len(ordinals), len(codes), runBlocks.max() + 1 if len(procs) else 0)
+        size = shape[0] * shape[1] * shape[2]
+
+        def cells(dates, rooms, blocks):
+            return (np.searchsorted(ordinals, dates) * shape[1] + roomOf[rooms]) * shape[2] + blocks
+
+        def total(cellIndices, weights=None):
+            totals = np.bincount(cellIndices, weights, minlength=size) if size else np.zeros(0)
+            return totals.astype(np.int32).reshape(shape)
+
+        days = {}
+        procCells = cells(procs.date, procs.room, runBlocks)
+        days['procedures'] = total(procCells)
+        for measure, column in (('schedMinutes', 'schedLength'), ('roomMinutes', 'roomDuration'),
+                                ('procMinutes', 'procDuration')):
+            minutes = getattr(procs, column)
+            days[measure] = total(procCells, np.where(minutes == sa.MISSING, 0, minutes))
+        days['blocks'] = np.minimum(days['procedures'], 1)
+        days['roomDays'] = np.zeros(shape, dtype=np.int32)
+        if size:
+            days['roomDays'][:, :, 0] = days['procedures'].any(axis=2)
+
+        for estimate, tableIdles in roomIdles.items():
+            _, rooms, blocks = tableIdles.blockIndices()
+            runCells = cells(tableIdles.runDates, rooms, blocks)
+            days[measureKey('idle', estimate)] = total(runCells, tableIdles.runTotals())
+            days[measureKey('realIdle', estimate)] = total(runCells, tableIdles.minus(ideals[estimate]).runTotals())
+            days[measureKey('idles', estimate)] = total(runCells, np.diff(tableIdles.offsets))
+
+        keys, measures = {'day': ordinals.astype(np.int64)}, {'day': days}
+        for level in LEVELS[1:]:
+            periods = periodKeys(ordinals, level)
+            starts = np.flatnonzero(np.diff(np.concatenate(([-1], periods)))) # days are chronological
+            keys[level] = periods[starts]
+            measures[level] = dict((name, np.add.reduceat(values, starts, axis=0) if len(starts) else values)
+                                   for name, values in days.items())
+        return IdleCube([procs.categories['room'][code] for code in codes], keys, measures, meta)
+
+    def level(self, by=(), start=None, end=None, weekdays=None):
+        """
+        Returns the coarsest of LEVELS that can answer a query grouping by the keys by, over the days from start to
+        end, and only on weekdays: every key of by must be the same for all days of one of its periods, and start and
+        end must be its periods' first and last days
+        """
+        if weekdays is not None:
+            return 'day'
+        for level in reversed(LEVELS):
+            if any(key in LEVELS + ('weekday',) and key not in DERIVABLE[level] for key in by):
+                continue
+            firsts, lasts = periodBounds(periodKeys([d.toordinal() for d in (start, end) if d is not None], level),
+                                         level)
+            if start is not None and firsts[0] != start.toordinal():
+                continue
+            if end is not None and lasts[-1] != end.toordinal():
+                continue
+            return level
+        return 'day'
+
+    def query(self, measure, by=(), per=None, estimate='conservative', rooms=None, start=None, end=None,
+              weekdays=None, blocks=None):
+        """
+        Inputs:
+        measure - what to sum, one of MEASURES
+        by - keys to group by, any of KEYS. Without any, the whole slice is summed into one value
+        per - a measure to divide each group's sum by, e.g. blocks for the average per block
+        estimate - the estimate of the idle measures
+        rooms - only rooms matching these shell style patterns, e.g. ['OR 0[3-7]']
+        start, end - only days in this window, inclusive. Either may be None for no bound
+        weekdays - only days on these weekdays, 0 for Monday to 6 for Sunday
+        blocks - only these blocks, 1 for the first block of a room-day
+
+        Outputs:
+        A list of (labels, value) tuples, one per group with blocks, in the order of by's keys. labels are the group's
+        keyLabel()s, in by's order. value is the sum, an int, or with per, the ratio, None where per sums to 0
+        """
+
+        for key in by:
+            if key not in KEYS:
+                raise ValueError('Unknown key ' + key + '. Must be one of ' + ', '.join(KEYS))
+        level = self.level(by, start, end, weekdays)
+        measures = self.measures[level]
+        firsts, lasts = self.bounds[level]
+
+        periods = np.ones(len(firsts), dtype=bool)
+        if start is not None:
+            periods &= firsts >= start.toordinal()
+        if end is not None:
+            periods &= lasts <= end.toordinal()
+        if weekdays is not None:
+            periods &= np.in1d(periodKeys(firsts, 'weekday'), list(weekdays))
+        periods = np.flatnonzero(periods)
+        roomAxis = np.arange(len(self.rooms))
+        if rooms is not None:
+            roomAxis = np.array([i for i, room in enumerate(self.rooms)
+                                 if any(fnmatch.fnmatchcase(room, pattern) for pattern in rooms)], dtype=np.int64)
+        numBlocks = measures['blocks'].shape[2]
+        blockAxis = np.arange(numBlocks)
+        if blocks is not None:
+            blockAxis = np.array(sorted(set(b - 1 for b in blocks if 0 < b <= numBlocks)), dtype=np.int64)
+        selection = np.ix_(periods, roomAxis, blockAxis)
+
+        # Groups along the period axis, each a distinct combination of by's time keys
+        timeKeys = [key for key in by if key in LEVELS + ('weekday',)]
+        labels = np.column_stack([periodKeys(firsts[periods], key) for key in timeKeys] or
+                                 [np.zeros(len(periods), dtype=np.int64)])
+        if len(periods):
+            groupLabels, groups = np.unique(labels.view([('', labels.dtype)] * labels.shape[1]).ravel(),
+                                            return_inverse=True)
+        else:
+            groupLabels, groups = np.zeros(0, dtype=labels.dtype), np.zeros(0, dtype=np.int64)
+        order = np.argsort(groups, kind='mergesort')
+        groupStarts = np.flatnonzero(np.diff(np.concatenate(([-1], groups[order]))))
+
+        def rollUp(name):
+            values = measures[name][selection].astype(np.int64)[order]
+            summed = np.add.reduceat(values, groupStarts, axis=0) if len(groupStarts) else values[:0]
+            if 'room' not in by:
+                summed = summed.sum(axis=1, keepdims=True)
+            if 'block' not in by:
+                summed = summed.sum(axis=2, keepdims=True)
+            return summed
+
+        sums = rollUp(measureKey(measure, estimate))
+        present = rollUp('blocks')
+        divisors = rollUp(measureKey(per, estimate)) if per is not None else None
+
+        results = []
+        for cell in zip(*np.nonzero(present)):
+            group, room, block = cell
+            values = {'room': self.rooms[roomAxis[room]] if 'room' in by else None,
+                      'block': blockAxis[block] if 'block' in by else None}
+            for i, key in enumerate(timeKeys):
+                values[key] = groupLabels[group][i]
+            if divisors is None:
+                value = int(sums[cell])
+            else:
+                value = float(sums[cell]) / divisors[cell] if divisors[cell] else None
+            results.append(([values[key] for key in by], value))
+        results.sort(key=lambda result: result[0])
+        return [(tuple(keyLabel(key, v) for key, v in zip(by, keyValues)), value)
+                for keyValues, value in results]
+
+    def save(self, path):
+        """
+        Writes the cube to an .npz at path, replacing it atomically so that an interrupted save keeps the old cube
+        """
+        arrays = {'rooms': np.array(self.rooms, dtype=object),
+                  'meta': np.array(json.dumps(dict(self.meta, version=[CUBE_VERSION, sa.PARSER_VERSION])))}
+        for level in LEVELS:
+            arrays[level + '_keys'] = self.keys[level]
+            for name, values in self.measures[level].items():
+                arrays[level + '_' + name] = values
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(tmpPath, path)
+        except:
+            os.remove(tmpPath)
+            raise
+
+    @staticmethod
+    def load(path):
+        """
+        Returns the cube saved at path, or None if it is missing or was saved by another version
+        """
+        try:
+            with np.load(path, allow_pickle=True) as arrays:
+                meta = json.loads(arrays['meta'].item())
+                if meta.pop('version') != [CUBE_VERSION, sa.PARSER_VERSION]:
+                    return None
+                keys, measures = {}, {}
+                for level in LEVELS:
+                    keys[level] = arrays[level + '_keys']
+                    measures[level] = dict((name[len(level) + 1:], arrays[name]) for name in arrays.files
+                                           if name.startswith(level + '_') and name != level + '_keys')
+                rooms = arrays['rooms'].tolist()
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return IdleCube(rooms, keys, measures, meta)
+
+    def runQueries(self, lines):
+        """
+        Runs and prints one query per line of lines, e.g. an open query file. See parseQuery() for the format. Blank
+        lines and lines starting with # are skipped
+        """
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kwargs = parseQuery(line)
+            printQuery(self.query(**kwargs), **kwargs)
+
+
+def parseQuery(line):
+    """
+    Parses one query into keyword arguments for IdleCube.query(). Queries are space separated key=value pairs, quoted
+    like a shell command when a value has spaces, as for idleIndex.parseQuery(). Lists are comma separated. For example:
+
+        measure=realIdle per=blocks by=weekday rooms="OR 0[3-7]" from=04/01/16 to=06/30/16
+        measure=roomMinutes per=schedMinutes by=room,month estimate=liberal weekdays=Mon,Tue blocks=1
+    """
+
+    kwargs = queryArguments(token.partition('=')[::2] for token in shlex.split(line))
+    if 'measure' not in kwargs:
+        raise ValueError('Query "' + line + '" has no measure')
+    return kwargs
+
+
+def queryArguments(pairs):
+    """
+    Returns keyword arguments for IdleCube.query() of (key, value) pairs of a query, in parseQuery()'s keys and
+    formats, e.g. the parameters of an idleServer request
+    """
+
+    kwargs = {}
+    for key, value in pairs:
+        if key in ('measure', 'per', 'estimate'):
+            kwargs[key] = value
+        elif key == 'by':
+            kwargs['by'] = tuple(value.split(',')) if value else ()
+        elif key == 'rooms':
+            kwargs['rooms'] = value.split(',')
+        elif key == 'from':
+            kwargs['start'] = sa.parseDate(value)
+        elif key == 'to':
+            kwargs['end'] = sa.parseDate(value)
+        elif key == 'weekdays':
+            kwargs['weekdays'] = [idleIndex.DAYS.index(day) for day in value.split(',')]
+        elif key == 'blocks':
+            kwargs['blocks'] = [int(block) for block in value.split(',')]
+        else:
+            raise ValueError('Unknown query key ' + key + '. Must be measure, per, estimate, by, rooms, from, to, '
+                             'weekdays or blocks')
+    return kwargs
+
+
+def printQuery(results, measure, by=(), per=None, estimate='conservative', rooms=None, start=None, end=None,
+               weekdays=None, blocks=None):
+
+    description = ("Total " + measure if per is None else measure + " per " + per)
+    if measure in IDLE_MEASURES or per in IDLE_MEASURES:
+        description += " (" + estimate + ")"
+    if by:
+        description += " by " + ", ".join(by)
+    if rooms is not None:
+        description += " in " + ", ".join(rooms)
+    if start is not None or end is not None:
+        description += " from " + (start.isoformat()[:10] if start else "the start") + \
+                       " to " + (end.isoformat()[:10] if end else "the end")
+    if weekdays is not None:
+        description += " on " + ", ".join(idleIndex.DAYS[w] for w in weekdays)
+    if blocks is not None:
+        description += " in blocks " + ", ".join(str(block) for block in blocks)
+
+    print "\n\n" + description + ":"
+    for labels, value in results:
+        formatted = '-' if value is None else str(value) if isinstance(value, int) else '%.2f' % value
+        print "  ".join(labels + (formatted,))
+
+
+def fromArgs(args, rebuild=False):
+    """
+    Returns the cube of parsed command line args holding filename, min, max, workers and
+    statAggregator.addReadingArguments()' options. With args.cube, the cube saved there is used if it was built with
+    the same arguments and the files haven't changed since, else it's built and saved there
+    """
+
+    meta = {'sources': list(args.filename), 'min': args.min, 'max': args.max, 'format': args.format,
+            'invalid': args.invalid}
+    mtime = multiSource.modifiedTime(args.filename) # before reading, so a change made while reading is read again
+    if args.cube and not rebuild:
+        cube = IdleCube.load(args.cube)
+        if cube is not None and cube.meta.pop('sourceModified', None) == mtime and cube.meta == meta:
+            print "Loaded the cube of " + ' '.join(args.filename) + " from " + args.cube
+            return cube
+
+    procs = sa.StatAggregator.fromArgs(args).procs
+    ideals, roomIdles = ci.calculateTableEstimates(procs, workers=args.workers)
+    cube = IdleCube.build(procs, ideals, roomIdles, dict(meta, sourceModified=mtime))
+    if args.cube:
+        cube.save(args.cube)
+        print "Saved the cube to " + args.cube
+    return cube
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Answer aggregate queries about idles and procedure times by room, "
+                                                 "period, weekday and block from a precomputed cube")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
+    parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data",
+                        required=True)
+    parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data",
+                        required=True)
+    parser.add_argument("--cube", help="File to keep the cube in between runs, rebuilt when the excel files change")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the --cube file even if it's current")
+    parser.add_argument("-q", "--queries", help="File of queries to answer instead of prompting for them, one per "
+                                                "line, e.g. 'measure=realIdle per=blocks by=weekday rooms=\"OR 0[3-7]\" "
+                                                "from=04/01/16 to=06/30/16'")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes to calculate idles with")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
+
+    args = parser.parse_args()
+    instrument.fromArgs(args)
+    cube = fromArgs(args, rebuild=args.rebuild)
+    if args.queries:
+        with open(args.queries) as queries:
+            cube.runQueries(queries)
+        return
+
+    while True:
+        print "\n"
+        try:
+            cube.runQueries([raw_input("Enter query: ")])
+        except ValueError as e:
+            print e
+
+if __name__ == "__main__":
+    parseInputs()
@@ -0,0 +1,186 @@
+import datetime as dt
+import shlex
+
+import numpy as np
+
+import statAggregator as sa
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+class IdleIndex(object):
+    """
+    Per room index of daily cumulative idle time, built once so that queries don't revisit every day's idles.
+
+    Each room keeps its days in chronological order, as ordinals, with their cumulative idles, plus the same totals
+    sorted. Threshold queries are a binary search on the sorted totals and date windows are a binary search on the
+    ordinals.
+    """
+
+    def __init__(self, roomIdles, dates):
+        """
+        Inputs:
+        roomIdles - a list of dicts, where keys are rooms and values are lists of lists of idle times. Each dict is
+        one day, e.g. the output of roomIdlesMinusIdeals()
+        dates - the date of each dict in roomIdles, in chronological order, e.g. the output of dayDates()
+        """
+
+        roomDays = {}
+        for date, dayIdles in zip(dates, roomIdles):
+            ordinal = date.toordinal()
+            for room, blocks in dayIdles.items():
+                roomDays.setdefault(room, ([], []))
+                roomDays[room][0].append(ordinal)
+                roomDays[room][1].append(sum(sum(block) for block in blocks))
+        self.index(roomDays)
+
+    @staticmethod
+    def fromTableIdles(tableIdles):
+        """
+        Returns the index of a calculateIdles.TableIdles, e.g. real idles from its minus(), from its room-day totals
+        without building a dict per day
+        """
+        index = IdleIndex([], [])
+        ordinals, rooms, totals = tableIdles.roomDayTotals()
+        roomDays = {}
+        for code in np.unique(rooms):
+            inRoom = rooms == code
+            roomDays[tableIdles.roomNames[code]] = (ordinals[inRoom], totals[inRoom])
+        index.index(roomDays)
+        return index
+
+    def index(self, roomDays):
+        """
+        Indexes roomDays, a dict where keys are rooms and values are (ordinals, totals) of their days in chronological
+        order
+        """
+        self.ordinals = {}
+        self.totals = {}
+        self.byTotal = {} # room -> indices of its days sorted by total
+        self.sortedTotals = {}
+        for room, (ordinals, totals) in roomDays.items():
+            self.ordinals[room] = np.array(ordinals, dtype=np.int32)
+            self.totals[room] = np.array(totals, dtype=np.int64)
+            self.byTotal[room] = np.argsort(self.totals[room], kind='mergesort')
+            self.sortedTotals[room] = self.totals[room][self.byTotal[room]]
+
+    def rooms(self):
+        return sorted(self.totals)
+
+    def daysOver(self, room, threshold):
+        """
+        Returns the dates, in chronological order, with cumulative idle >= threshold minutes in room
+        """
+        if room not in self.totals:
+            return []
+        first = np.searchsorted(self.sortedTotals[room], threshold)
+        days = np.sort(self.byTotal[room][first:])
+        return [dt.datetime.fromordinal(int(o)) for o in self.ordinals[room][days]]
+
+    def query(self, room, threshold=None, start=None, end=None, weekdays=None, top=None):
+        """
+        Inputs:
+        room - room to query
+        threshold - only days with cumulative idle >= threshold minutes
+        start, end - only days in this window, inclusive. Either may be None for no bound
+        weekdays - only days on these weekdays, 0 for Monday to 6 for Sunday
+        top - only the top many days with the most idle, worst first
+
+        Outputs:
+        A list of (date, cumulative idle) tuples, in chronological order unless top is given
+        """
+
+        if room not in self.totals:
+            return []
+        ordinals, totals = self.ordinals[room], self.totals[room]
+
+        if start is None and end is None and weekdays is None and top is None:
+            first = np.searchsorted(self.sortedTotals[room], threshold) if threshold is not None else 0
+            days = np.sort(self.byTotal[room][first:])
+        else:
+            first = np.searchsorted(ordinals, start.toordinal()) if start is not None else 0
+            stop = np.searchsorted(ordinals, end.toordinal(), side='right') if end is not None else len(ordinals)
+            days = np.arange(first, stop)
+            if weekdays is not None:
+                days = days[np.in1d((ordinals[days] + 6) % 7, list(weekdays))] # ordinal 1 was a Monday
+            if threshold is not None:
+                days = days[totals[days] >= threshold]
+            if top is not None:
+                days = days[np.argsort(-totals[days], kind='mergesort')[:top]]
+
+        return [(dt.datetime.fromordinal(int(ordinals[d])), int(totals[d])) for d in days]
+
+    def runQueries(self, lines):
+        """
+        Runs and prints one query per line of lines, e.g. an open query file. See parseQuery() for the format. Blank
+        lines and lines starting with # are skipped, and malformed ones are reported and skipped
+        """
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                kwargs = parseQuery(line)
+                days = self.query(**kwargs)
+            except ValueError as e:
+                print "\nSkipping query on line " + str(number) + ", \"" + line + "\": " + str(e)
+                continue
+            printQuery(days, **kwargs)
+
+
+def parseQuery(line):
+    """
+    Parses one query into keyword arguments for IdleIndex.query(). Queries are space separated key=value pairs, quoted
+    like a shell command when a value has spaces. Dates are ISO ('2016-01-04') or 'mm/dd/yy'. For example:
+
+        room="OR 3" min=60 from=01/01/16 to=03/31/16 weekdays=Mon,Fri top=10
+    """
+
+    kwargs = queryArguments(token.partition('=')[::2] for token in shlex.split(line))
+    if 'room' not in kwargs:
+        raise ValueError('Query "' + line + '" has no room')
+    return kwargs
+
+
+def queryArguments(pairs):
+    """
+    Returns keyword arguments for IdleIndex.query() of (key, value) pairs of a query, in parseQuery()'s keys and
+    formats, e.g. the parameters of an idleServer request
+    """
+
+    kwargs = {}
+    for key, value in pairs:
+        if key == 'room':
+            kwargs['room'] = value
+        elif key == 'min':
+            kwargs['threshold'] = int(value)
+        elif key == 'from':
+            kwargs['start'] = sa.parseDate(value)
+        elif key == 'to':
+            kwargs['end'] = sa.parseDate(value)
+        elif key == 'weekdays':
+            kwargs['weekdays'] = [DAYS.index(day) for day in value.split(',')]
+        elif key == 'top':
+            kwargs['top'] = int(value)
+        else:
+            raise ValueError('Unknown query key ' + key + '. Must be room, min, from, to, weekdays or top')
+    return kwargs
+
+
+def printQuery(days, room, threshold=None, start=None, end=None, weekdays=None, top=None):
+
+    description = "Days"
+    if threshold is not None:
+        description += " with \"real\" cumulative idle time >= " + str(threshold) + " minutes"
+    description += " in " + str(room)
+    if start is not None or end is not None:
+        description += " from " + (start.isoformat()[:10] if start else "the start") + \
+                       " to " + (end.isoformat()[:10] if end else "the end")
+    if weekdays is not None:
+        description += " on " + ", ".join(DAYS[w] for w in weekdays)
+    if top is not None:
+        description += ", top " + str(top)
+
+    print "\n\n" + description + ":"
+    for date, total in days:
+        print date.isoformat()[:10] + "  " + str(total)
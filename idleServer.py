@@ -0,0 +1,329 @@
+"""
+Resident analysis service. Reads the source file once, keeps its procedures, idles and ideals in memory and answers
+queries about them over a local HTTP port or Unix socket, so that a question doesn't mean reparsing the workbook and
+rerunning the idle pipeline. Requests are served on a thread each. The source is watched, and when it changes it is
+read again in the background while queries keep being answered from the previous read.
+
+Every endpoint is a GET answered with JSON. Dates are ISO ('2016-01-04') or 'mm/dd/yy', and estimate is conservative
+(the default) or liberal:
+
+    /status                             sources, when they were read, number of procedures, last reload error
+    /rooms                              rooms with idles
+    /ideals?estimate=                   ideal idle time per room
+    /thresholds?room=&min=&from=&to=&weekdays=&top=&estimate=
+                                        days with cumulative real idle time >= min in room, as idleIndex.parseQuery()
+    /days/DATE?estimate=                the day's idles, real idles, ideal and totals per room
+    /schedule/DATE                      the day's procedures, with the times dayPlot draws
+    /cube?measure=&per=&by=&rooms=&from=&to=&weekdays=&blocks=&estimate=
+                                        sums or ratios of measures by room, period, weekday and block, as
+                                        idleCube.parseQuery()
+
+For example, python idleServer.py report.xlsx -m 1 -M 100000, then curl 'localhost:8765/thresholds?room=OR%201&min=60'
+"""
+
+import argparse
+import BaseHTTPServer
+import datetime as dt
+import json
+import os
+import SocketServer
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+
+import numpy as np
+
+import calculateIdles as ci
+import idleCube
+import idleIndex
+import instrument
+import multiSource
+import statAggregator as sa
+
+DEFAULT_PORT = 8765
+DEFAULT_POLL_SECONDS = 5.0
+
+
+class Analysis(object):
+    """
+    Everything queries are answered from, computed from one read of the source. Never changed once built, so request
+    threads can share it while a reload builds its replacement
+    """
+
+    def __init__(self, procs, ideals, roomIdles, mtime):
+        """
+        Inputs:
+        procs - the ProcedureTable read from the source
+        ideals - dict from estimate to a dict of ideal idle time per room, as calculateTableEstimates() returns
+        roomIdles - dict from estimate to the TableIdles of procs, as calculateTableEstimates() returns
+        mtime - modification time of the source when it was read
+        """
+        self.procs = procs
+        self.ideals = ideals
+        self.roomIdles = roomIdles
+        self.realRoomIdles = dict((estimate, idles.minus(ideals[estimate])) for estimate, idles in roomIdles.items())
+        self.indexes = dict((estimate, idleIndex.IdleIndex.fromTableIdles(idles))
+                            for estimate, idles in self.realRoomIdles.items())
+        self.order = np.argsort(procs.date, kind='mergesort') # procedures by day, for schedules
+        self.idleCube = idleCube.IdleCube.build(procs, ideals, roomIdles)
+        self.mtime = mtime
+        self.loaded = time.time()
+
+    @staticmethod
+    def read(args):
+        """
+        Returns the Analysis of the source of parsed command line args, as given to StatAggregator.fromArgs()
+        """
+        mtime = multiSource.modifiedTime(args.filename) # before reading, so a change made while reading is read again
+        with instrument.stage('server load') as stage:
+            procs = sa.StatAggregator.fromArgs(args).procs
+            ideals, roomIdles = ci.calculateTableEstimates(procs, workers=args.workers)
+            analysis = Analysis(procs, ideals, roomIdles, mtime)
+            stage.rows = len(procs)
+        return analysis
+
+    def estimate(self, params):
+        estimate = params.pop('estimate', 'conservative')
+        if estimate not in self.roomIdles:
+            raise ValueError('Unknown estimate ' + estimate + '. Must be one of ' + ', '.join(sorted(self.roomIdles)))
+        return estimate
+
+    def rooms(self, params):
+        return sorted(set(room for index in self.indexes.values() for room in index.rooms()))
+
+    def idealIdles(self, params):
+        return self.ideals[self.estimate(params)]
+
+    def thresholds(self, params):
+        index = self.indexes[self.estimate(params)]
+        kwargs = idleIndex.queryArguments(params.items())
+        if 'room' not in kwargs:
+            raise ValueError('Query has no room')
+        return [{'date': date.isoformat()[:10], 'idle': total} for date, total in index.query(**kwargs)]
+
+    def cubeQuery(self, params):
+        kwargs = idleCube.queryArguments(params.items())
+        if 'measure' not in kwargs:
+            raise ValueError('Query has no measure')
+        return [dict(zip(kwargs.get('by', ()), labels), value=value)
+                for labels, value in self.idleCube.query(**kwargs)]
+
+    def day(self, params, date):
+        """
+        Returns the idles of each room on date: its idles and real idles by block, as findIdles() and
+        roomIdlesMinusIdeals() list them, their totals and the room's ideal
+        """
+        estimate = self.estimate(params)
+        ordinal = sa.parseDate(date).toordinal()
+        idles, realIdles = dayIdles(self.roomIdles[estimate], ordinal), dayIdles(self.realRoomIdles[estimate], ordinal)
+        rooms = {}
+        for room, blocks in idles.items():
+            rooms[room] = {'idles': blocks, 'realIdles': realIdles[room], 'ideal': self.ideals[estimate].get(room),
+                           'total': sum(sum(block) for block in blocks),
+                           'realTotal': sum(sum(block) for block in realIdles[room])}
+        return {'date': dt.date.fromordinal(ordinal).isoformat(), 'estimate': estimate, 'rooms': rooms}
+
+    def schedule(self, params, date):
+        """
+        Returns the procedures on date, in the order they were read, with the times and durations dayPlot draws
+        """
+        ordinal = sa.parseDate(date).toordinal()
+        first, stop = np.searchsorted(self.procs.date[self.order], [ordinal, ordinal + 1])
+        day = self.procs.take(self.order[first:stop])
+        rows = [{} for _ in xrange(len(day))]
+        for name in ('room', 'loc'):
+            for row, label in zip(rows, day.labels(name).tolist()):
+                row[name] = label
+        for row, logNum in zip(rows, day):
+            row['logNum'] = logNum.logNum
+        for name in sa.ProcedureTable.TIME_COLUMNS:
+            for row, minutes in zip(rows, getattr(day, name).tolist()):
+                row[name] = None if minutes == sa.MISSING else '%02d:%02d' % (minutes / 60, minutes % 60)
+        for name in sa.ProcedureTable.DURATION_COLUMNS:
+            for row, minutes in zip(rows, getattr(day, name).tolist()):
+                row[name] = None if minutes == sa.MISSING else minutes
+        return {'date': dt.date.fromordinal(ordinal).isoformat(), 'procedures': rows}
+
+
+def dayIdles(tableIdles, ordinal):
+    """
+    Returns the findIdles() dict of tableIdles' day with ordinal, empty if it has no idles
+    """
+    first, stop = np.searchsorted(tableIdles.runDates, [ordinal, ordinal + 1])
+    return next(tableIdles.take(np.arange(first, stop)).days(), {})
+
+
+class Service(object):
+    """
+    The current Analysis of a source, and the thread that replaces it when the source changes
+    """
+
+    def __init__(self, args, pollSeconds=DEFAULT_POLL_SECONDS):
+        """
+        Inputs:
+        args - parsed command line args, as given to StatAggregator.fromArgs(), plus workers
+        pollSeconds - how often to check whether the source changed
+        """
+        self.args = args
+        self.pollSeconds = pollSeconds
+        self.analysis = Analysis.read(args)
+        self.reloading = False
+        self.lastError = None
+        self.failedMtime = None # modification time of the source when it last failed to read, retried once it changes
+        self.stopped = threading.Event()
+        self.watcher = threading.Thread(target=self.watch)
+        self.watcher.daemon = True
+
+    def start(self):
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.watcher.is_alive() and not self.reloading:
+            self.watcher.join()
+
+    def watch(self):
+        """
+        Reads the source again once it changed and then stayed unchanged for one poll, so that a file still being
+        written isn't read half way, and swaps the new Analysis in. A failed read keeps the old one, and isn't retried
+        until the source changes again
+        """
+        seen = self.analysis.mtime
+        while not self.stopped.wait(self.pollSeconds):
+            try:
+                mtime = multiSource.modifiedTime(self.args.filename)
+            except (OSError, ValueError) as e: # e.g. being replaced
+                self.lastError = str(e)
+                continue
+            if mtime == self.analysis.mtime or mtime == self.failedMtime or mtime != seen:
+                seen = mtime
+                continue
+            self.reloading = True
+            try:
+                self.analysis = Analysis.read(self.args)
+                self.lastError = self.failedMtime = None
+                print "Reloaded " + ' '.join(self.args.filename) + ", " + str(len(self.analysis.procs)) + " procedures"
+            except Exception:
+                self.lastError = traceback.format_exc()
+                self.failedMtime = mtime
+                print "Reloading " + ' '.join(self.args.filename) + " failed, still answering from the previous " \
+                      "read\n" + self.lastError
+            finally:
+                self.reloading = False
+
+    def status(self, params):
+        analysis = self.analysis
+        return {'sources': self.args.filename, 'procedures': len(analysis.procs),
+                'loaded': dt.datetime.fromtimestamp(analysis.loaded).isoformat()[:19],
+                'sourceModified': dt.datetime.fromtimestamp(analysis.mtime).isoformat()[:19],
+                'reloading': self.reloading, 'lastError': self.lastError}
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    ENDPOINTS = {'rooms': 'rooms', 'ideals': 'idealIdles', 'thresholds': 'thresholds', 'days': 'day',
+                 'schedule': 'schedule', 'cube': 'cubeQuery'} # path -> Analysis method
+    DATED = ('days', 'schedule') # endpoints followed by a date
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        path = [urllib.unquote(part) for part in url.path.split('/') if part]
+        params = dict(urlparse.parse_qsl(url.query))
+        service = self.server.service
+        analysis = service.analysis # the whole request is answered from one read, even if a reload swaps it meanwhile
+        try:
+            if path == ['status']:
+                body = service.status(params)
+            elif path and path[0] in self.DATED:
+                if len(path) == 1:
+                    raise ValueError('/' + path[0] + ' needs a date, e.g. /' + path[0] + '/2016-01-04')
+                body = getattr(analysis, self.ENDPOINTS[path[0]])(params, '/'.join(path[1:])) # mm/dd/yy has slashes
+            elif len(path) == 1 and path[0] in self.ENDPOINTS:
+                body = getattr(analysis, self.ENDPOINTS[path[0]])(params)
+            else:
+                return self.send(404, {'error': 'Unknown endpoint ' + url.path + '. Must be /status or one of /' +
+                                                ', /'.join(sorted(self.ENDPOINTS))})
+        except ValueError as e: # bad parameters
+            return self.send(400, {'error': str(e)})
+        self.send(200, body)
+
+    def send(self, status, body):
+        data = json.dumps(body, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        client = self.client_address[0] if isinstance(self.client_address, tuple) else 'unix socket'
+        print "%s - - [%s] %s" % (client, self.log_date_time_string(), format % args)
+
+
+class IdleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixIdleServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address): # left behind by a server that didn't shut down cleanly
+            os.remove(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address, 0
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT, socketPath=None):
+    """
+    Answers queries about service's Analysis until interrupted, on socketPath if given, else on host:port
+    """
+    if socketPath:
+        server = UnixIdleServer(socketPath, RequestHandler)
+        where = socketPath
+    else:
+        server = IdleServer((host, port), RequestHandler)
+        where = 'http://' + host + ':' + str(server.server_address[1])
+    server.service = service
+    service.start()
+    print "Answering queries about " + ' '.join(service.args.filename) + " on " + where
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+        if socketPath and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Keep an excel file's procedures, idles and ideals in memory and answer "
+                                                 "queries about them over local HTTP")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
+    parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data",
+                        required=True)
+    parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data",
+                        required=True)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes to calculate idles with")
+    parser.add_argument("--host", default='127.0.0.1', help="Address to listen on. Keep it local, there's no "
+                                                            "authentication")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--socket", help="Unix socket to listen on instead of a port")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SECONDS,
+                        help="Seconds between checks of whether the excel file changed")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
+
+    args = parser.parse_args()
+    instrument.fromArgs(args)
+    serve(Service(args, args.poll), args.host, args.port, args.socket)
+
+if __name__ == "__main__":
+    parseInputs()
@@ -0,0 +1,188 @@
+"""
+Saved results of calculateIdleStats() over a source file that grows, so that rerunning after rows are appended only
+reads and processes the new rows.
+
+The state keeps every procedure read so far, their idles with trailing idles, the IdealIdleEstimator of their in
+between idles and the last source row read. Refreshing reads the rows after that one and recomputes only the days they
+fall on: new days, and earlier days that late rows were added to. Those days' old idles are swapped for the new ones,
+and their old in between idles are taken back out of the estimator before the new ones are counted, so ideals and
+real idles come out exactly as a full run's.
+
+Rows are assumed to only ever be appended. Rows whose log number was already read are skipped, so a re-export that
+repeats the last rows is fine, but after editing or deleting earlier rows the state must be rebuilt.
+
+A refresh still costs more as the history grows. A CSV file is read from the byte offset where the last read stopped,
+and a Parquet file only from the row groups holding new rows, but a workbook's sheet is parsed from its first row every
+time, as openpyxl can't seek, so keep long histories as CSV or Parquet. Every refresh also checks the new log numbers
+against all the kept ones and rewrites the whole state file.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import calculateIdles as ci
+import instrument
+import statAggregator as sa
+
+STATE_VERSION = 1 # bump whenever what's saved changes, to rebuild older states
+
+
+class IncrementalState(object):
+
+    def __init__(self, source, bounds, procs, roomIdles, estimator, lastRow, lastOffset=None):
+        """
+        Inputs:
+        source - real path of the file the procedures are read from
+        bounds - (min, max, format, sortedByDate, invalid) the file is read with, as given to StatAggregator
+        procs - a ProcedureTable of every procedure read so far
+        roomIdles - a TableIdles of procs' conservative idles, including trailing idles
+        estimator - an IdealIdleEstimator of procs' conservative idles between surgeries
+        lastRow - last data row of source that was read
+        lastOffset - byte offset in source just past lastRow, for CSV files, or None
+        """
+        self.source = source
+        self.bounds = bounds
+        self.procs = procs
+        self.roomIdles = roomIdles
+        self.estimator = estimator
+        self.lastRow = lastRow
+        self.lastOffset = lastOffset
+
+    @staticmethod
+    def build(source, bounds, excel):
+        """
+        Returns the state of a first, full read of source, a StatAggregator
+        """
+        roomIdles, estimator = ci.tableIdleStats(excel.procs)
+        return IncrementalState(source, bounds, excel.procs, roomIdles, estimator, excel.lastRow,
+                                excel.lastOffset)
+
+    def add(self, procs, lastRow, lastOffset=None):
+        """
+        Inputs:
+        procs - a ProcedureTable of the procedures read after the state's lastRow
+        lastRow - the last data row they were read up to
+        lastOffset - byte offset just past lastRow, for CSV files
+
+        Outputs:
+        changed - the ordinals of the days that were recomputed
+        """
+
+        self.lastRow, self.lastOffset = lastRow, lastOffset
+        procs = procs[~np.in1d(procs.logNum, self.procs.logNum)] # already read, e.g. repeated by a re-export
+        if not len(procs):
+            return np.zeros(0, dtype=self.procs.date.dtype)
+
+        changed = np.unique(procs.date)
+        oldDays = np.in1d(self.procs.date, changed)
+        if oldDays.any(): # late rows for days already counted
+            self.estimator.remove(ci.tableIdleStats(self.procs[oldDays])[1])
+
+        # New labels get new codes after the old ones, so the kept idles' room codes stay valid
+        self.procs = sa.ProcedureTable.concatenate([self.procs, procs])
+        roomIdles, estimator = ci.tableIdleStats(self.procs[np.in1d(self.procs.date, changed)])
+        self.estimator.merge(estimator)
+        kept = self.roomIdles.take(np.flatnonzero(~np.in1d(self.roomIdles.runDates, changed)))
+        self.roomIdles = ci.TableIdles.concatenate([kept, roomIdles])
+        return changed
+
+    def save(self, path):
+        """
+        Writes the state to an .npz at path, replacing it atomically so that an interrupted save keeps the old state
+        """
+        rooms = sorted(self.estimator.counts)
+        arrays = self.procs.arrays(prefix='procs_')
+        arrays.update(runDates=self.roomIdles.runDates, runRooms=self.roomIdles.runRooms,
+                      offsets=self.roomIdles.offsets, idles=self.roomIdles.idles,
+                      estimatorRooms=np.array(rooms, dtype=object),
+                      estimatorCounts=np.array([self.estimator.counts[room] for room in rooms], dtype=np.int64)
+                      .reshape(len(rooms), ci.MINUTES_PER_DAY),
+                      meta=np.array(json.dumps({'version': [STATE_VERSION, sa.PARSER_VERSION], 'source': self.source,
+                                                'bounds': self.bounds, 'lastRow': self.lastRow,
+                                                'lastOffset': self.lastOffset})))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(tmpPath, path)
+        except:
+            os.remove(tmpPath)
+            raise
+
+    @staticmethod
+    def load(path):
+        """
+        Returns the state saved at path, or None if it is missing or was saved by another version
+        """
+        try:
+            with np.load(path, allow_pickle=True) as arrays:
+                meta = json.loads(arrays['meta'].item())
+                if meta['version'] != [STATE_VERSION, sa.PARSER_VERSION]:
+                    return None
+                procs = sa.ProcedureTable.fromArrays(arrays, prefix='procs_')
+                roomIdles = ci.TableIdles(arrays['runDates'], arrays['runRooms'], arrays['offsets'], arrays['idles'],
+                                          procs.categories['room'])
+                estimator = ci.IdealIdleEstimator()
+                for room, counts in zip(arrays['estimatorRooms'].tolist(), arrays['estimatorCounts']):
+                    estimator.counts[room] = counts.copy()
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return IncrementalState(meta['source'], tuple(meta['bounds']), procs, roomIdles, estimator, meta['lastRow'],
+                                meta.get('lastOffset'))
+
+
+def refresh(path, excel, min=None, max=None, format=None, sortedByDate=False, streaming=True, rebuild=False,
+            invalid='keep', qualityReport=None):
+    """
+    Inputs:
+    path - where the state is saved between runs
+    excel, min, max, format, sortedByDate, streaming, invalid - the source file and how to read it, as for
+    StatAggregator
+    qualityReport - path to write the QualityReport of the rows read by this run to, as for StatAggregator
+    rebuild - ignore the saved state and read the whole file again
+
+    Outputs:
+    The state, updated with the rows appended to excel since it was saved, and saved again. Starts from scratch when
+    there's no saved state, or it was saved for another file or other bounds
+    """
+
+    source = os.path.realpath(excel)
+    bounds = (min, max, sa.fileFormat(excel, format), sortedByDate, invalid)
+    state = None if rebuild else IncrementalState.load(path)
+    if state is not None and (state.source != source or state.bounds != bounds):
+        print "Saved state in " + path + " is for other data, rebuilding it"
+        state = None
+
+    if state is None:
+        aggregator = sa.StatAggregator(excel, min, max, streaming, sortedByDate, format=bounds[2], invalid=invalid,
+                                       qualityReport=qualityReport)
+        with instrument.stage('incremental build', rows=len(aggregator.procs)):
+            state = IncrementalState.build(source, bounds, aggregator)
+        print "Processed " + str(len(state.procs)) + " procedures up to row " + str(state.lastRow)
+    else:
+        aggregator = sa.StatAggregator(excel, min, max, streaming, sortedByDate, format=bounds[2],
+                                       startRow=state.lastRow + 1, invalid=invalid, qualityReport=qualityReport,
+                                       startOffset=state.lastOffset)
+        with instrument.stage('incremental update', rows=len(aggregator.procs)):
+            changed = state.add(aggregator.procs, aggregator.lastRow, aggregator.lastOffset)
+        print "Read " + str(len(aggregator.procs)) + " new procedures up to row " + str(state.lastRow) + \
+              ", recomputed " + str(len(changed)) + " days"
+
+    state.save(path)
+    return state
+
+
+def fromArgs(args):
+    """
+    Returns refresh() of the state file args.state, for parsed command line args holding filename, min, max, rebuild
+    and statAggregator.addReadingArguments()' options. filename may be a list of one file
+    """
+    filename = args.filename[0] if isinstance(args.filename, list) else args.filename
+    return refresh(args.state, filename, args.min, args.max, format=args.format, sortedByDate=args.sorted,
+                   streaming=not args.full_load, rebuild=args.rebuild, invalid=args.invalid,
+                   qualityReport=args.quality_report)
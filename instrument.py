@@ -0,0 +1,162 @@
+"""
+Stage level timing of the pipeline. Off by default, and then nearly free. When enabled, with --profile REPORT.json or
+the CHOPLOTTER_PROFILE environment variable, every stage records its calls, wall time, rows handled and the process'
+memory, and a JSON report of them is written when the program exits.
+
+Memory is the process' peak resident set size when the stage finished, and how much resident memory grew during it.
+Python 2 has no per allocation tracing, so a stage's own peak can't be told apart from earlier stages' peaks.
+"""
+
+import atexit
+import contextlib
+import datetime as dt
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+ENV_VAR = 'CHOPLOTTER_PROFILE'
+
+_reportPath = None
+_stages = {} # name -> record dict
+_order = [] # stage names in the order they first ran
+_started = time.time()
+
+
+def enable(reportPath):
+    """
+    Starts recording stages, and writes a report of them to reportPath on exit
+    """
+    global _reportPath
+    if _reportPath is None:
+        atexit.register(lambda: writeReport(_reportPath))
+    _reportPath = reportPath
+
+
+def isEnabled():
+    return _reportPath is not None
+
+
+def addArguments(parser):
+    parser.add_argument("--profile", metavar="REPORT", help="Record the time, rows and memory of every stage and write "
+                                                            "them to this JSON file on exit. Also enabled by $" + ENV_VAR)
+
+
+def fromArgs(args):
+    if args.profile:
+        enable(args.profile)
+
+
+def peakRssMegabytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # kilobytes on Linux
+
+
+def rssMegabytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2.0**20
+    except IOError: # not Linux
+        return peakRssMegabytes()
+
+
+def record(name, seconds, rows=None, rssDelta=0.0):
+    """
+    Adds one call of stage name that took seconds and handled rows to the report
+    """
+    if name not in _stages:
+        _stages[name] = {'name': name, 'calls': 0, 'seconds': 0.0, 'rows': None, 'rssDeltaMB': 0.0}
+        _order.append(name)
+    stage = _stages[name]
+    stage['calls'] += 1
+    stage['seconds'] += seconds
+    if rows is not None:
+        stage['rows'] = (stage['rows'] or 0) + rows
+    stage['rssDeltaMB'] = max(stage['rssDeltaMB'], rssDelta)
+    stage['peakRssMB'] = max(stage.get('peakRssMB', 0.0), peakRssMegabytes())
+
+
+class Stage(object):
+    """
+    What stage() yields. Set rows on it when the number of rows is only known at the end of the stage
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """
+    Records the with block as one call of stage name
+    """
+    if not isEnabled():
+        yield Stage(rows)
+        return
+    current = Stage(rows)
+    rss = rssMegabytes()
+    start = time.time()
+    try:
+        yield current
+    finally:
+        record(name, time.time() - start, current.rows, rssMegabytes() - rss)
+
+
+def timed(name):
+    """
+    Decorator recording every call of a function as stage name, with the length of its first argument as rows. name
+    may also be a function of the call's arguments returning the stage's name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not isEnabled():
+                return function(*args, **kwargs)
+            stageName = name(*args, **kwargs) if callable(name) else name
+            rows = len(args[0]) if args and hasattr(args[0], '__len__') else None
+            with stage(stageName, rows):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    _stages.clear()
+    del _order[:]
+
+
+def records():
+    """
+    Returns the stages recorded so far, e.g. to send from a worker process back to the parent
+    """
+    return [dict(_stages[name]) for name in _order]
+
+
+def merge(stageRecords):
+    """
+    Adds stages recorded in another process, e.g. a worker's, to this process' report
+    """
+    for other in stageRecords:
+        name = other['name']
+        if name not in _stages:
+            _stages[name] = dict(other)
+            _order.append(name)
+            continue
+        stage = _stages[name]
+        stage['calls'] += other['calls']
+        stage['seconds'] += other['seconds']
+        if other['rows'] is not None:
+            stage['rows'] = (stage['rows'] or 0) + other['rows']
+        stage['rssDeltaMB'] = max(stage['rssDeltaMB'], other['rssDeltaMB'])
+        stage['peakRssMB'] = max(stage.get('peakRssMB', 0.0), other.get('peakRssMB', 0.0))
+
+
+def writeReport(path):
+    report = {'command': sys.argv, 'started': dt.datetime.fromtimestamp(_started).isoformat()[:19],
+              'totalSeconds': time.time() - _started, 'peakRssMB': peakRssMegabytes(), 'stages': records()}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
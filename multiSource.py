@@ -0,0 +1,169 @@
+"""
+Reading many exports as one, e.g. one export per campus per month. Sources are files, globs of files and sheets of
+workbooks. They're parsed in parallel worker processes, then merged into one ProcedureTable in chronological order,
+with the source of every procedure in its source column. Procedures exported more than once are only kept once.
+
+A source is given as [TAG=]PATH[#SHEET]:
+PATH - a workbook, CSV or Parquet file, or a glob of them, e.g. 'exports/*.xlsx'
+SHEET - the workbook sheet to read instead of the first, or * for every sheet
+TAG - the label of the procedures' source, e.g. a campus. Defaults to statAggregator.sourceTag() of each file and sheet
+"""
+
+import functools
+import glob
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import instrument
+import statAggregator as sa
+
+
+class Source(object):
+
+    def __init__(self, path, sheet=None, tag=None):
+        self.path = path
+        self.sheet = sheet
+        self.tag = tag
+
+    def __repr__(self):
+        return 'Source(%r, sheet=%r, tag=%r)' % (self.path, self.sheet, self.tag)
+
+
+def expandSources(specs):
+    """
+    Inputs:
+    specs - a source, as described above, or a list of them
+
+    Outputs:
+    A list of Sources, one per file and sheet, in the order given, with glob matches sorted by name
+    """
+
+    if isinstance(specs, basestring):
+        specs = [specs]
+    sources = []
+    for spec in specs:
+        tag = None
+        if not os.path.exists(spec) and '=' in spec.split('#')[0]:
+            tag, _, spec = spec.partition('=')
+        path, sheet = spec, None
+        if not os.path.exists(spec) and '#' in spec:
+            path, _, sheet = spec.rpartition('#')
+
+        paths = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+        if not paths:
+            raise ValueError('No files match ' + path)
+        for p in paths:
+            if sheet == '*':
+                sources.extend(Source(p, name, tag) for name in sheetNames(p))
+            else:
+                sources.append(Source(p, sheet, tag))
+    return sources
+
+
+def sheetNames(path):
+    import openpyxl
+    if sa.fileFormat(path) != 'xlsx':
+        raise ValueError(path + ' has no sheets, only workbooks do')
+    return openpyxl.load_workbook(path, read_only=True).sheetnames
+
+
+def modifiedTime(specs):
+    """
+    Returns the latest modification time of the files of specs, as expandSources() takes
+    """
+    return max(os.path.getmtime(source.path) for source in expandSources(specs))
+
+
+def readSource(source, options):
+    """
+    Returns the ProcedureTable and QualityReport of one Source, read with options as given to StatAggregator
+    """
+    aggregator = sa.StatAggregator(source.path, sheet=source.sheet, tag=source.tag, **options)
+    return aggregator.procs, aggregator.quality
+
+
+def profiledReadSource(source, options):
+    """
+    readSource() in a worker process, also returning the instrument stages it recorded, for the parent to merge
+    """
+    instrument.reset() # forget the stages inherited from the parent when it forked
+    return readSource(source, options), instrument.records()
+
+
+def mergeTables(tables):
+    """
+    Inputs:
+    tables - ProcedureTables, in any order
+
+    Outputs:
+    merged - one ProcedureTable of their procedures, in chronological order. A day's procedures keep the order of
+    tables and their order within them. A log number in several tables, or twice in one, is kept the first time only.
+    Procedures without a log number are all kept
+    duplicates - the number of procedures left out as duplicates
+    """
+
+    merged = sa.ProcedureTable.concatenate(tables)
+    logNums = merged.logNum
+    if logNums.dtype == object:
+        hasLogNum = np.array([logNum is not None and logNum != '' for logNum in logNums.tolist()], dtype=bool)
+    else:
+        hasLogNum = np.ones(len(merged), dtype=bool)
+    numbered = np.flatnonzero(hasLogNum)
+    _, first = np.unique(logNums[numbered], return_index=True)
+    keep = np.sort(np.concatenate((numbered[first], np.flatnonzero(~hasLogNum))))
+    order = keep[np.argsort(merged.date[keep], kind='mergesort')]
+    return merged.take(order), len(merged) - len(keep)
+
+
+class MultiSourceAggregator(object):
+    """
+    The procedures of many sources, merged. Has the procs of a StatAggregator
+    """
+
+    def __init__(self, sources, workers=None, qualityReport=None, **options):
+        """
+        Inputs:
+        sources - Sources, e.g. from expandSources()
+        workers - number of processes to read them with. Defaults to one per source, up to the number of CPUs
+        qualityReport - path to write every source's QualityReport to, as a JSON list
+        options - the other arguments of StatAggregator, applied to every source
+
+        After reading, quality is a list of each source's QualityReport, or None where it came from the cache, and
+        duplicates is the number of procedures left out as exported more than once
+        """
+
+        self.sources = sources
+        self.lastRow = None
+        options['qualityReport'] = None # one report of every source is written instead
+        if qualityReport:
+            options['cache'] = None # cached tables come without a report
+        workers = workers or min(len(sources), multiprocessing.cpu_count())
+
+        if workers > 1 and len(sources) > 1:
+            pool = multiprocessing.Pool(min(workers, len(sources)))
+            try:
+                if instrument.isEnabled():
+                    results = []
+                    for result, stages in pool.map(functools.partial(profiledReadSource, options=options), sources, 1):
+                        results.append(result)
+                        instrument.merge(stages)
+                else:
+                    results = pool.map(functools.partial(readSource, options=options), sources, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [readSource(source, options) for source in sources]
+
+        self.quality = [quality for _, quality in results]
+        with instrument.stage('merge', rows=sum(len(procs) for procs, _ in results)):
+            self.procs, self.duplicates = mergeTables([procs for procs, _ in results])
+        print "Merged " + str(len(self.procs)) + " procedures from " + str(len(sources)) + " sources" + \
+              (", leaving out " + str(self.duplicates) + " duplicates" if self.duplicates else "")
+
+        if qualityReport:
+            with open(qualityReport, 'w') as f:
+                json.dump([quality.toDict() for quality in self.quality], f, indent=2, sort_keys=True, default=str)
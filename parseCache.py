@@ -0,0 +1,103 @@
+"""
+On-disk cache of parsed ProcedureTables. A workbook that hasn't changed since it was last read loads from the cache's
+.npz in milliseconds instead of going through openpyxl again.
+
+Entries are keyed on the workbook's path, size and modification time (and optionally its contents), the arguments it
+was read with and statAggregator.PARSER_VERSION, so editing the workbook or the parser invalidates them. The least
+recently used entries are evicted once the cache outgrows its size limit.
+"""
+
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import statAggregator as sa
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'choplotter')
+DEFAULT_MEGABYTES = 1024
+
+
+class ParseCache(object):
+
+    def __init__(self, directory=None, megabytes=None, hashContents=False):
+        """
+        Inputs:
+        directory - where to keep cached tables. Defaults to $CHOPLOTTER_CACHE_DIR, then ~/.cache/choplotter
+        megabytes - size the cache is evicted down to. Defaults to $CHOPLOTTER_CACHE_MB, then DEFAULT_MEGABYTES
+        hashContents - key on a hash of the workbook's contents instead of its modification time, so touching it
+        doesn't invalidate its entries
+        """
+        self.directory = directory or os.environ.get('CHOPLOTTER_CACHE_DIR') or DEFAULT_DIRECTORY
+        if megabytes is None:
+            megabytes = float(os.environ.get('CHOPLOTTER_CACHE_MB', DEFAULT_MEGABYTES))
+        self.maxBytes = int(megabytes * 2**20)
+        self.hashContents = hashContents
+
+    def key(self, path, *args):
+        """
+        Returns the key of the table read from the file at path with args
+        """
+        stat = os.stat(path)
+        h = hashlib.sha1(repr((sa.PARSER_VERSION, os.path.realpath(path), args)))
+        if self.hashContents:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), ''):
+                    h.update(chunk)
+        else:
+            h.update(repr((stat.st_size, stat.st_mtime)))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        Returns the cached ProcedureTable for key, or None if there isn't one
+        """
+        path = self.path(key)
+        try:
+            table = sa.ProcedureTable.load(path)
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+            return None
+        os.utime(path, None) # mark as recently used
+        return table
+
+    def store(self, key, table):
+        """
+        Caches table under key, then evicts old entries if the cache is over its size limit
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first so that a concurrent load never sees half a table
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                table.save(f)
+            os.rename(tmpPath, self.path(key))
+        except:
+            os.remove(tmpPath)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its size limit
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        totalBytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError: # already evicted by another run
+                pass
+            totalBytes -= size
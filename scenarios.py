@@ -0,0 +1,419 @@
+"""
+What-if replays of schedules with turnovers capped at a target, to show how much time turnovers at the target would
+recover.
+
+Every run of consecutive surgeries of one block, as tableIdleViews() finds them, is replayed with each of its
+turnovers, the idles between its surgeries, capped at the target. Every surgery after a capped turnover starts that much
+earlier, so the run ends earlier by the sum of what its turnovers exceeded the target by. Measures, per run and summed
+per room-day or room:
+freed - minutes recovered, what the run's turnovers exceeded the target by. With each room's ideal idle time as its
+target, the real idle time between surgeries of roomIdlesMinusIdeals()
+overtimeAvoided - minutes less that the run ends after its block's scheduled end. Both are measured from the block's
+scheduled start, so blocks running past midnight are compared in minutes past it
+extraCases - cases that fit in the time left before the block's scheduled end after its last run, but didn't before,
+each taking the room's median in room time and a target turnover
+
+A sweep replays many targets. Each target is vectorized over the runs of every day with turnovers it caps, fewer as
+targets grow, and targets are split between worker processes, so hundreds of them make sensitivity curves in seconds.
+
+For example, python scenarios.py report.xlsx -m 1 -M 100000 --sweep 0:60:1 -w 4 -o sweep.csv --save sweep.png
+"""
+
+import argparse
+import copy
+import csv
+import functools
+import multiprocessing
+
+import numpy as np
+
+import calculateIdles as ci
+import instrument
+import statAggregator as sa
+
+MEASURES = ('freed', 'overtimeAvoided', 'extraCases')
+EARLY_MINUTES = 6 * 60 # most a surgery can go in before its block's scheduled start, rather than late the day before
+UNCAPPED = 10 ** 9 # target of rooms without one, longer than any turnover
+UNKNOWN_END = -UNCAPPED # end of a surgery with a MISSING time, and of a run of only such surgeries, before any block's
+STEP_EPSILON = 1e-9 # fraction of a --sweep step that STOP may fall short of a target by and still include it
+REFILTER_TARGETS = 8 # targets a sweep replays between dropping the turnovers that are no longer capped
+
+
+def blockSpans(procs, blockIds):
+    """
+    Inputs:
+    procs - a non-empty ProcedureTable
+    blockIds - the blocks of procs, as ci.idTableBlocks() numbers them
+
+    Outputs:
+    blockStarts - int64 array with the scheduled start of every block, in minutes since midnight
+    blockLengths - int64 array with the minutes from the scheduled start of every block to its latest scheduled end,
+    across midnight for overnight blocks
+    """
+
+    order = np.lexsort((procs.schedStart, blockIds))
+    ids = blockIds[order]
+    firsts = np.flatnonzero(np.append(True, ids[1:] != ids[:-1]))
+    blockStarts = procs.schedStart[order][firsts].astype(np.int64)
+    schedEnd = procs.schedEnd[order]
+    lengths = np.where(schedEnd == sa.MISSING, 0, (schedEnd - blockStarts[ids]) % ci.MINUTES_PER_DAY)
+    return blockStarts, np.maximum.reduceat(lengths, firsts)
+
+
+class Replay(object):
+    """
+    The runs and turnovers of a ProcedureTable, computed once to replay any number of targets on
+    """
+
+    def __init__(self, procs, estimate='conservative', blocks=None):
+        """
+        Inputs:
+        procs - a ProcedureTable
+        estimate - 'conservative' to measure turnovers and run ends from out of room times, 'liberal' from procedure end
+        times
+        blocks - the output of ci.idTableBlocks(procs), computed if not given
+        """
+
+        if estimate not in ci.ENDS:
+            raise ValueError('Replay() was given an invalid argument for estimate. Must be liberal or conservative')
+        self.roomNames = procs.categories['room']
+        numRooms = len(self.roomNames)
+        with instrument.stage('replay index', rows=len(procs)):
+            if len(procs):
+                blocks = blocks if blocks is not None else ci.idTableBlocks(procs)
+                runs = ci.tableRuns(procs, blocks)
+                order = runs.order
+                end = getattr(procs, ci.ENDS[estimate])[order].astype(np.int64)
+                pairs = ci.knownPairs(runs.pairs, procs.inRoom[order], end)
+                self.turnovers = (procs.inRoom[order][pairs] - end[pairs - 1]) % ci.MINUTES_PER_DAY
+                self.turnoverRuns = runs.runOf[pairs]
+
+                # Run and block ends in minutes from the block's scheduled start, unwrapped across midnight, so that
+                # overnight blocks compare the same as daytime ones
+                blockStarts, blockLengths = blockSpans(procs, blocks[0])
+                blockIds = blocks[0][order]
+                starts = blockStarts[blockIds]
+                inRoom = (procs.inRoom[order] - starts + EARLY_MINUTES) % ci.MINUTES_PER_DAY - EARLY_MINUTES
+                ends = inRoom + (end - procs.inRoom[order]) % ci.MINUTES_PER_DAY
+                ends[(procs.inRoom[order] == sa.MISSING) | (end == sa.MISSING)] = UNKNOWN_END
+                self.runEnds = np.maximum.reduceat(ends, runs.runStarts)
+                self.runBlockEnds = blockLengths[runs.runBlocks]
+                runDates = procs.date[order][runs.runStarts]
+                self.runRooms = procs.room[order][runs.runStarts].astype(np.int64)
+                # Only the run of a block that ends last is followed by the time left in the block
+                byEnd = np.lexsort((self.runEnds, runs.runBlocks))
+                lastOfBlock = np.append(runs.runBlocks[byEnd][1:] != runs.runBlocks[byEnd][:-1], True)
+                self.blockLast = np.zeros(len(runs.runStarts), dtype=bool)
+                self.blockLast[byEnd[lastOfBlock]] = True
+                self.blockLast &= self.runEnds != UNKNOWN_END
+            else:
+                self.turnovers = self.turnoverRuns = self.runEnds = self.runBlockEnds = self.runRooms = \
+                    np.zeros(0, dtype=np.int64)
+                runDates = np.zeros(0, dtype=np.int32)
+                self.blockLast = np.zeros(0, dtype=bool)
+            self.turnoverRooms = self.runRooms[self.turnoverRuns]
+
+            # Runs are sorted by day and room, so each room-day's are together
+            newRoomDay = np.ones(len(runDates), dtype=bool)
+            newRoomDay[1:] = (runDates[1:] != runDates[:-1]) | (self.runRooms[1:] != self.runRooms[:-1])
+            self.runRoomDays = np.cumsum(newRoomDay) - 1
+            self.roomDayDates = runDates[newRoomDay]
+            self.roomDayRooms = self.runRooms[newRoomDay]
+
+            # The length of an extra case in each room
+            self.caseMinutes = np.zeros(numRooms)
+            lengths = procs.roomDuration
+            valid = lengths > 0
+            for code in np.unique(procs.room[valid]):
+                self.caseMinutes[code] = np.median(lengths[valid & (procs.room == code)])
+
+    def roomTargets(self, target):
+        """
+        Returns an array of the target of every room code, for target, a number of minutes for every room, or a dict
+        of each room's, e.g. its ideal idle time. Rooms missing from the dict aren't capped
+        """
+        if isinstance(target, dict):
+            return np.array([target.get(room, UNCAPPED) for room in self.roomNames] or [0], dtype=float)
+        return np.full(max(len(self.roomNames), 1), target, dtype=float)
+
+    def exceeding(self, minutes):
+        """
+        Returns a Replay of only the turnovers longer than minutes, the only ones that targets of at least minutes cap,
+        and of only their runs, the only ones whose measures aren't 0
+        """
+        replay = copy.copy(self)
+        longer = self.turnovers > minutes
+        runs = np.unique(self.turnoverRuns[longer])
+        replay.turnovers = self.turnovers[longer]
+        replay.turnoverRuns = np.searchsorted(runs, self.turnoverRuns[longer])
+        replay.turnoverRooms = self.turnoverRooms[longer]
+        for name in ('runEnds', 'runBlockEnds', 'runRooms', 'blockLast', 'runRoomDays'):
+            setattr(replay, name, getattr(self, name)[runs])
+        return replay
+
+    def runMeasures(self, target):
+        """
+        Returns a dict of every measure of MEASURES per run, as int64 arrays, replaying target as for roomTargets()
+        """
+        roomTargets = self.roomTargets(target)
+        excess = np.maximum(self.turnovers - roomTargets[self.turnoverRooms], 0)
+        freed = np.bincount(self.turnoverRuns, weights=excess, minlength=len(self.runEnds)).astype(np.int64)
+
+        ends = self.runEnds - freed
+        overtimeAvoided = np.maximum(self.runEnds - self.runBlockEnds, 0) - np.maximum(ends - self.runBlockEnds, 0)
+
+        caseMinutes = np.maximum(self.caseMinutes[self.runRooms] + roomTargets[self.runRooms], 1)
+        before = np.floor(np.maximum(self.runBlockEnds - self.runEnds, 0) / caseMinutes)
+        after = np.floor(np.maximum(self.runBlockEnds - ends, 0) / caseMinutes)
+        extraCases = np.where(self.blockLast, after - before, 0).astype(np.int64)
+
+        return {'freed': freed, 'overtimeAvoided': overtimeAvoided, 'extraCases': extraCases}
+
+    @instrument.timed('replay')
+    def replay(self, target):
+        """
+        Inputs:
+        target - minutes to cap every turnover at, or a dict of each room's, as for roomTargets()
+
+        Outputs:
+        A dict of every measure of MEASURES per room-day, as int64 arrays, with 'dates' and 'rooms', the date ordinal and
+        room code of each room-day, in chronological order
+        """
+        measures = self.runMeasures(target)
+        roomDays = dict((measure, np.bincount(self.runRoomDays, weights=values,
+                                              minlength=len(self.roomDayDates)).astype(np.int64))
+                        for measure, values in measures.items())
+        roomDays['dates'] = self.roomDayDates
+        roomDays['rooms'] = self.roomDayRooms
+        return roomDays
+
+
+def sweepTotals(replay, targets):
+    """
+    Returns a dict of every measure of MEASURES as a targets x room codes int64 array of its totals when replaying
+    each of targets, minutes to cap every turnover at
+    """
+    numRooms = max(len(replay.roomNames), 1)
+    totals = dict((measure, np.zeros((len(targets), numRooms), dtype=np.int64)) for measure in MEASURES)
+    # In increasing order, dropping the turnovers the next targets no longer cap every few targets
+    for n, i in enumerate(np.argsort(targets, kind='mergesort')):
+        if n % REFILTER_TARGETS == 0:
+            replay = replay.exceeding(targets[i])
+        for measure, values in replay.runMeasures(targets[i]).items():
+            totals[measure][i] = np.bincount(replay.runRooms, weights=values, minlength=numRooms)
+    return totals
+
+
+def profiledSweepTotals(replay, targets):
+    """
+    sweepTotals() in a worker process, also returning the instrument stages it recorded, for the parent to merge
+    """
+    instrument.reset() # forget the stages inherited from the parent when it forked
+    with instrument.stage('sweep', rows=len(targets)):
+        totals = sweepTotals(replay, targets)
+    return totals, instrument.records()
+
+
+class Sweep(object):
+    """
+    Totals of every measure of MEASURES per room when replaying each of many targets, as sweep() computes them
+    """
+
+    def __init__(self, targets, roomNames, totals):
+        """
+        Inputs:
+        targets - the minutes turnovers were capped at
+        roomNames - the labels of the room codes of totals
+        totals - dict of every measure to a targets x room codes array of its totals
+        """
+        self.targets = targets
+        self.roomNames = roomNames
+        self.totals = totals
+
+    def measure(self, measure, room=None):
+        """
+        Returns the totals of measure for every target, of every room or of room
+        """
+        if room is None:
+            return self.totals[measure].sum(axis=1)
+        return self.totals[measure][:, self.roomNames.index(room)]
+
+    def printSummary(self):
+        print "\n%10s %14s %18s %12s" % ('target', 'freed minutes', 'overtime avoided', 'extra cases')
+        for i, target in enumerate(self.targets):
+            print "%10g %14d %18d %12d" % ((target,) + tuple(self.measure(measure)[i] for measure in MEASURES))
+
+    def write(self, path):
+        """
+        Writes a CSV file of every target's totals, of every room together and of each room
+        """
+        rooms = [code for code in np.argsort(self.roomNames) if self.totals['freed'][:, code].any() or
+                 self.totals['overtimeAvoided'][:, code].any()] if self.roomNames else []
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(('target', 'room') + MEASURES)
+            for i, target in enumerate(self.targets):
+                writer.writerow((target, 'All') + tuple(self.measure(measure)[i] for measure in MEASURES))
+                for code in rooms:
+                    writer.writerow((target, self.roomNames[code]) +
+                                    tuple(self.totals[measure][i, code] for measure in MEASURES))
+
+    def plot(self, path=None):
+        """
+        Plots the sensitivity curve of every measure to the target, saving it to path if given instead of showing it
+        """
+        plt = ci.pyplot()
+        fig, axes = plt.subplots(len(MEASURES), 1, sharex=True, figsize=(8, 9))
+        for ax, (measure, label) in zip(axes, zip(MEASURES, ('Freed minutes', 'Overtime avoided (minutes)',
+                                                             'Extra cases'))):
+            ax.plot(self.targets, self.measure(measure))
+            ax.set_ylabel(label)
+            ax.grid(True)
+        axes[-1].set_xlabel('Target turnover (minutes)')
+        axes[0].set_title('Time recovered with turnovers capped at the target')
+        if path:
+            fig.savefig(path)
+            plt.close(fig)
+        else:
+            plt.show()
+
+
+@instrument.timed('sweep')
+def sweep(replay, targets, workers=1):
+    """
+    Inputs:
+    replay - a Replay
+    targets - minutes to cap every turnover at, one scenario each
+    workers - number of processes to split targets between. Results are identical to a single process
+
+    Outputs:
+    A Sweep of every target's totals per room
+    """
+
+    targets = [float(target) for target in targets]
+    if workers > 1 and len(targets) > 1:
+        # Targets in interleaved chunks, so that each worker gets low and high ones alike
+        chunks = [targets[i::workers] for i in range(min(workers, len(targets)))]
+        pool = multiprocessing.Pool(len(chunks))
+        try:
+            if instrument.isEnabled():
+                results = []
+                for result, stages in pool.map(functools.partial(profiledSweepTotals, replay), chunks, 1):
+                    results.append(result)
+                    instrument.merge(stages)
+            else:
+                results = pool.map(functools.partial(sweepTotals, replay), chunks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        totals = {}
+        for measure in MEASURES:
+            totals[measure] = np.empty((len(targets),) + results[0][measure].shape[1:], dtype=np.int64)
+            for i, result in enumerate(results):
+                totals[measure][i::workers] = result[measure]
+    else:
+        totals = sweepTotals(replay, targets)
+    return Sweep(targets, replay.roomNames, totals)
+
+
+def writeRoomDays(path, replay, roomDays):
+    """
+    Writes a CSV file of every room-day of Replay.replay()'s output, roomDays, of replay
+    """
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(('date', 'room') + MEASURES)
+        for i, (ordinal, room) in enumerate(zip(roomDays['dates'].tolist(), roomDays['rooms'].tolist())):
+            writer.writerow((sa.dt.datetime.fromordinal(ordinal).isoformat()[:10], replay.roomNames[room]) +
+                            tuple(roomDays[measure][i] for measure in MEASURES))
+
+
+def printRoomTotals(replay, roomDays):
+    """
+    Prints the totals of every measure per room of Replay.replay()'s output, roomDays, of replay
+    """
+    numRooms = max(len(replay.roomNames), 1)
+    totals = dict((measure, np.bincount(roomDays['rooms'], weights=roomDays[measure], minlength=numRooms))
+                  for measure in MEASURES)
+    print "\n%-12s %14s %18s %12s" % ('room', 'freed minutes', 'overtime avoided', 'extra cases')
+    for code in np.argsort(replay.roomNames) if replay.roomNames else []:
+        if np.any(roomDays['rooms'] == code):
+            print "%-12s %14d %18d %12d" % ((replay.roomNames[code],) + tuple(totals[m][code] for m in MEASURES))
+    print "%-12s %14d %18d %12d" % (('All',) + tuple(totals[m].sum() for m in MEASURES))
+
+
+def parseTargets(value):
+    """
+    Returns the targets of a --sweep value, START:STOP[:STEP] minutes, inclusive, with a step of 1 by default
+    """
+    bounds = [float(part) for part in value.split(':')]
+    if len(bounds) not in (2, 3) or bounds[1] < bounds[0] or (len(bounds) == 3 and bounds[2] <= 0):
+        raise argparse.ArgumentTypeError('Must be START:STOP[:STEP], e.g. 0:60:5')
+    start, stop = bounds[:2]
+    step = bounds[2] if len(bounds) == 3 else 1
+    count = int(np.floor((stop - start) / step + STEP_EPSILON)) + 1 # a float step may land a hair short of STOP
+    return np.minimum(start + step * np.arange(count), stop).tolist()
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Replay schedules with turnovers capped at target times and report "
+                                                 "the minutes freed, overtime avoided and extra cases that would fit")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
+    parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data. If row, 1"
+                                            " refers to first row containing data, not necessarily first row of excel sheet",
+                        required=True)
+    parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data. If row, 1",
+                        required=True)
+    targets = parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument("--target", type=float, help="Minutes to cap every turnover at. Reports every room-day")
+    targets.add_argument("--ideals", action="store_true", help="Cap every room's turnovers at its ideal idle time. "
+                                                               "Reports every room-day")
+    targets.add_argument("--sweep", type=parseTargets, metavar="START:STOP[:STEP]",
+                         help="Replay every target from START to STOP minutes, inclusive, by STEP, 1 by default, and "
+                              "report each one's totals")
+    parser.add_argument("-e", "--estimate", choices=ci.ESTIMATES, default='conservative',
+                        help="Measure turnovers from the previous surgery's out of room time (conservative) or "
+                             "procedure end time (liberal)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of processes to sweep targets with")
+    parser.add_argument("-o", "--output", help="CSV file to write every room-day's, or with --sweep every target's, "
+                                               "results to")
+    parser.add_argument("--plot", action="store_true", help="Show the sensitivity curves of a --sweep")
+    parser.add_argument("--save", metavar="IMAGE", help="Save the sensitivity curves of a --sweep to this image")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.fromArgs(args)
+
+    excel = sa.StatAggregator.fromArgs(args)
+    procs = excel.procs
+    blocks = ci.idTableBlocks(procs) if len(procs) else None
+    replay = Replay(procs, args.estimate, blocks)
+
+    if args.sweep is not None:
+        result = sweep(replay, args.sweep, args.workers)
+        result.printSummary()
+        if args.output:
+            result.write(args.output)
+        if args.save:
+            import matplotlib
+            matplotlib.use('Agg') # render without a display. Must come before pyplot is first imported
+            result.plot(args.save)
+        elif args.plot:
+            result.plot()
+        return result
+
+    if args.ideals:
+        ideals, _ = ci.calculateTableEstimates(procs, estimates=(args.estimate,))
+        target = ideals[args.estimate]
+    else:
+        target = args.target
+    roomDays = replay.replay(target)
+    printRoomTotals(replay, roomDays)
+    if args.output:
+        writeRoomDays(args.output, replay, roomDays)
+    return roomDays
+
+if __name__ == "__main__":
+    parseInputs()
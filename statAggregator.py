@@ -1,9 +1,27 @@
 #!/usr/bin/env python 
 
+import array
+import csv
 import datetime as dt
-import openpyxl
+import itertools
+import json
+import os
+import numpy as np
 import time
 
+import instrument
+
+NUM_COLUMNS = 19 # ProcedureParams reads up to column index 18
+MISSING = -1 # stands in for empty cells in ProcedureTable's integer columns
+PARSER_VERSION = 3 # bump whenever parsing changes what ends up in a ProcedureTable, to invalidate cached tables
+FIELDS = ('date', 'day', 'schedStart', 'schedEnd', 'schedLength', 'inRoom', 'ready', 'procStart', 'procEnd', 'outRoom',
+          'procDuration', 'roomDuration', 'room', 'loc', 'logNum') # what ProcedureParams reads from a row
+FORMATS = {'.xlsx': 'xlsx', '.xlsm': 'xlsx', '.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'} # by extension
+DATE_FORMATS = ('%m/%d/%y', '%m/%d/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+EPOCH = dt.date(1970, 1, 1).toordinal() # Parquet dates count days from here
+WEEKDAYS = {'Mon':0, 'Tue':1, 'Wed':2, 'Thu':3, 'Fri':4, 'Sat':5, 'Sun':6}
+INVALID_POLICIES = ('keep', 'flag', 'drop') # what to do with procedures failing validation, see checkTable()
+
 
 class Procedure(object):
     """docstring for Procedure"""
@@ -33,9 +51,10 @@ class Procedure(object):
         # self.calculateDelays()
 
 
-    def ensureAllEntriesCorrect(self, procParams):
-        self.durationsAreCorrect(procParams)
-        self.dayIsCorrect(procParams)
+    @staticmethod
+    def ensureAllEntriesCorrect(procParams):
+        Procedure.durationsAreCorrect(procParams)
+        Procedure.dayIsCorrect(procParams)
     
     def toDateTime(self, s, delta=False):
         if s:
@@ -47,7 +66,8 @@ class Procedure(object):
         else:
             return None
         
-    def durationsAreCorrect(self, procParams):
+    @staticmethod
+    def durationsAreCorrect(procParams):
 
         allDursGood = True
         durations = [(procParams.schedStart, procParams.schedEnd, procParams.schedLength), 
@@ -64,16 +84,17 @@ class Procedure(object):
                 calculatedDur = (endMin - startMin) + (endHour - startHour)*60
                 if calculatedDur != dur[2]:
                     allDursGood = False
-                    print "Procedure " + str(self.logNum) + " has an incorrect duration length"
+                    print "Procedure " + str(procParams.logNum) + " has an incorrect duration length"
             except TypeError as e:
-                print "Procedure " + str(self.logNum) + ": " +  e.message
+                print "Procedure " + str(procParams.logNum) + ": " +  e.message
 
         return allDursGood
 
-    def dayIsCorrect(self, procParams):
+    @staticmethod
+    def dayIsCorrect(procParams):
         days = {'Mon':0, 'Tue':1, 'Wed':2, 'Thu':3, 'Fri':4, 'Sat':5, 'Sun':6}
-        if days[procParams.day] != self.date.weekday():
-            print "Procedure " + str(self.logNum) + " has an incorrectly labeled day"
+        if days[procParams.day] != procParams.date.weekday():
+            print "Procedure " + str(procParams.logNum) + " has an incorrectly labeled day"
             return False
         else:
             return True
@@ -113,38 +134,868 @@ class ProcedureParams(object):
         self.loc = row[16].value
         self.logNum = row[18].value
 
+def matchColumns(names):
+    """
+    Inputs:
+    names - the column names of a CSV header or Parquet schema
+
+    Outputs:
+    A dict from every name in FIELDS to the index of its column. Names match ignoring case, spaces and underscores,
+    so 'Sched Start', 'sched_start' and 'schedStart' are all schedStart
+    """
+    normalized = [''.join(c for c in name.lower() if c.isalnum()) for name in names]
+    indices = {}
+    for field in FIELDS:
+        if field.lower() not in normalized:
+            raise ValueError('No ' + field + ' column among ' + ', '.join(names))
+        indices[field] = normalized.index(field.lower())
+    return indices
+
+
+def sourceTag(path, sheet=None):
+    """
+    Returns the default tag of the procedures read from path, or from its sheet: the file's name without extension
+    """
+    tag = os.path.splitext(os.path.basename(path))[0]
+    return tag if sheet is None else tag + '#' + sheet
+
+
+def parseDate(value):
+    """
+    Returns the datetime of a date read from a file: a date, a datetime or a string in one of DATE_FORMATS
+    """
+    if isinstance(value, dt.datetime):
+        return value
+    if isinstance(value, dt.date):
+        return dt.datetime.combine(value, dt.time())
+    for dateFormat in DATE_FORMATS:
+        try:
+            return dt.datetime.strptime(value, dateFormat)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized date ' + value + '. Must be in one of the formats ' + ', '.join(DATE_FORMATS))
+
+
+def parseRange(min, max):
+    """
+    Inputs:
+    min, max - dates ('mm/dd/yy' format) or 1-based data row numbers, as given to StatAggregator
+
+    Outputs:
+    minRow, maxRow - the row bounds, or None if min and max are dates. maxRow is None when reading to the end
+    minDate, maxDate - the date bounds, or None if min and max are rows
+    """
+    try:
+        return int(min) if min else 1, int(max) if max else None, None, None
+    except ValueError:
+        minDate = dt.datetime.strptime(min, '%m/%d/%y') if min else dt.datetime(dt.MINYEAR,1,1) # TODO: Should probably check if valid str
+        maxDate = dt.datetime.strptime(max, '%m/%d/%y') if max else dt.datetime(dt.MAXYEAR,1,1)
+        return None, None, minDate, maxDate
+
+
+def fileFormat(path, format=None):
+    """
+    Returns format, else the format of path's extension: 'xlsx', 'csv' or 'parquet'
+    """
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Unknown format of ' + path + '. Give a format, or use one of the extensions ' +
+                         ', '.join(sorted(FORMATS)))
+    return FORMATS[extension]
+
+
+def importParquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Reading Parquet files needs pyarrow, e.g. pip install pyarrow')
+    return pyarrow, pyarrow.parquet
+
+
+def statisticOrdinal(statistic, logicalType):
+    """
+    Returns the date ordinal of a Parquet date column's min or max statistic, or None if it can't be interpreted
+    """
+    if isinstance(statistic, dt.date):
+        return statistic.toordinal()
+    if isinstance(statistic, (int, long)) and str(logicalType).startswith('Date'): # days since the epoch
+        return EPOCH + statistic
+    if isinstance(statistic, basestring):
+        try:
+            return parseDate(statistic).toordinal()
+        except ValueError:
+            return None
+    return None
+
+
+class ProcedureTable(object):
+    """
+    Columnar store of procedures, one NumPy array per Procedure field. Costs a few dozen bytes per procedure instead of a
+    Procedure object per row, and lets later math run over whole columns at once.
+
+    Columns:
+    date - int32 proleptic Gregorian ordinals
+    schedStart, schedEnd, inRoom, ready, procStart, procEnd, outRoom - int32 minutes since midnight
+    schedLength, procDuration, roomDuration - int32 minutes
+    room, loc, day - int16 codes into the label lists in self.categories
+    source - int16 codes into self.categories['source'], the tag of the file or sheet each procedure was read from
+    logNum - log numbers, int64 when the workbook's are all integers
+    outRoomStraddledMidnight, procEndStraddledMidnight - bool
+    flags - uint16 bit mask of the validation RULES a procedure failed, when read with the 'flag' policy, else 0
+
+    Empty cells are MISSING in the integer columns. Indexing with an int returns a ProcedureRow, which reads like a
+    Procedure, so code written against lists of Procedures keeps working. Slices, index arrays and masks return tables.
+    """
+
+    TIME_COLUMNS = ('schedStart', 'schedEnd', 'inRoom', 'ready', 'procStart', 'procEnd', 'outRoom')
+    DURATION_COLUMNS = ('schedLength', 'procDuration', 'roomDuration')
+    READ_CATEGORY_COLUMNS = ('room', 'loc', 'day') # category columns read from files
+    CATEGORY_COLUMNS = READ_CATEGORY_COLUMNS + ('source',)
+    COLUMNS = ('date',) + TIME_COLUMNS + DURATION_COLUMNS + CATEGORY_COLUMNS + \
+              ('logNum', 'outRoomStraddledMidnight', 'procEndStraddledMidnight', 'flags')
+
+    def __init__(self, columns, categories):
+        """
+        Inputs:
+        columns - dict from every name in COLUMNS to an equal length array
+        categories - dict from every name in CATEGORY_COLUMNS to the list of labels its codes index into
+        """
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.date)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('ProcedureTable index out of range')
+            return ProcedureRow(self, key)
+        return self.take(key)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield ProcedureRow(self, i)
+
+    def take(self, indices):
+        """
+        Returns a ProcedureTable of the rows selected by a slice, an index array or a boolean mask
+        """
+        return ProcedureTable(dict((name, getattr(self, name)[indices]) for name in self.COLUMNS), self.categories)
+
+    def columns(self):
+        return dict((name, getattr(self, name)) for name in self.COLUMNS)
+
+    def arrays(self, prefix=''):
+        """
+        Returns a dict of arrays holding the table's columns and category labels, with names starting with prefix, for
+        saving in an .npz alongside other arrays
+        """
+        arrays = dict((prefix + name, values) for name, values in self.columns().items())
+        for name, labels in self.categories.items():
+            arrays[prefix + 'categories_' + name] = np.array(labels, dtype=object)
+        return arrays
+
+    @staticmethod
+    def fromArrays(arrays, prefix=''):
+        """
+        Returns the table held in arrays, e.g. a loaded .npz, as written by arrays(prefix)
+        """
+        columns = dict((name, arrays[prefix + name]) for name in ProcedureTable.COLUMNS)
+        categories = dict((name, arrays[prefix + 'categories_' + name].tolist())
+                          for name in ProcedureTable.CATEGORY_COLUMNS)
+        return ProcedureTable(columns, categories)
+
+    def save(self, f):
+        """
+        Writes the table to f, a path or binary file, as an uncompressed .npz of its columns and category labels
+        """
+        np.savez(f, **self.arrays())
+
+    @staticmethod
+    def load(f):
+        """
+        Reads a table written by save() from f, a path or binary file
+        """
+        with np.load(f, allow_pickle=True) as arrays:
+            return ProcedureTable.fromArrays(arrays)
+
+    @staticmethod
+    def concatenate(tables):
+        """
+        Returns one table of the rows of tables, in order. Category codes are remapped onto the union of the tables'
+        labels, in which the first table's labels keep their codes, so anything indexed by them stays valid
+        """
+        columns = dict((name, np.concatenate([getattr(t, name) for t in tables])) for name in ProcedureTable.COLUMNS)
+        categories = {}
+        for name in ProcedureTable.CATEGORY_COLUMNS:
+            codes = {}
+            remapped = []
+            for t in tables:
+                mapping = np.array([codes.setdefault(label, len(codes)) for label in t.categories[name]], dtype=np.int16)
+                remapped.append(mapping[getattr(t, name)] if len(mapping) else getattr(t, name))
+            columns[name] = np.concatenate(remapped).astype(np.int16)
+            labels = [None] * len(codes)
+            for label, code in codes.items():
+                labels[code] = label
+            categories[name] = labels
+        return ProcedureTable(columns, categories)
+
+    def labels(self, name):
+        """
+        Returns an array of the labels of category column name, one per procedure
+        """
+        return np.array(self.categories[name], dtype=object)[getattr(self, name)]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.COLUMNS)
+
+
+class ProcedureRow(object):
+    """
+    View of one row of a ProcedureTable with the same fields as a Procedure, converted on access. Like a Procedure, a
+    blockId can be set on it.
+    """
+
+    __slots__ = ('table', 'index', 'blockId')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def date(self):
+        return dt.datetime.fromordinal(int(self.table.date[self.index]))
+
+    @property
+    def logNum(self):
+        logNum = self.table.logNum[self.index]
+        if isinstance(logNum, np.integer):
+            return int(logNum)
+        return logNum.item() if isinstance(logNum, np.generic) else logNum
+
+    @property
+    def outRoomStraddledMidnight(self):
+        return bool(self.table.outRoomStraddledMidnight[self.index])
+
+    @property
+    def procEndStraddledMidnight(self):
+        return bool(self.table.procEndStraddledMidnight[self.index])
+
+
+def _timeField(name):
+    def get(row):
+        minutes = int(getattr(row.table, name)[row.index])
+        return None if minutes == MISSING else dt.time(minutes / 60, minutes % 60)
+    return property(get)
+
+def _durationField(name):
+    def get(row):
+        minutes = int(getattr(row.table, name)[row.index])
+        return None if minutes == MISSING else dt.timedelta(minutes=minutes)
+    return property(get)
+
+def _categoryField(name):
+    def get(row):
+        return row.table.categories[name][getattr(row.table, name)[row.index]]
+    return property(get)
+
+for name in ProcedureTable.TIME_COLUMNS:
+    setattr(ProcedureRow, name, _timeField(name))
+for name in ProcedureTable.DURATION_COLUMNS:
+    setattr(ProcedureRow, name, _durationField(name))
+for name in ProcedureTable.CATEGORY_COLUMNS:
+    setattr(ProcedureRow, name, _categoryField(name))
+
+
+class ProcedureTableBuilder(object):
+    """
+    Accumulates ProcedureParams into typed arrays, 4 bytes per value, and converts them into a ProcedureTable
+    """
+
+    def __init__(self):
+        self.ints = dict((name, array.array('i')) for name in
+                         ('date',) + ProcedureTable.TIME_COLUMNS + ProcedureTable.DURATION_COLUMNS +
+                         ProcedureTable.READ_CATEGORY_COLUMNS)
+        self.codes = dict((name, {}) for name in ProcedureTable.READ_CATEGORY_COLUMNS) # label -> code
+        self.logNums = []
+
+    def __len__(self):
+        return len(self.logNums)
+
+    def append(self, procParams):
+        self.ints['date'].append(procParams.date.toordinal())
+        for name in ProcedureTable.TIME_COLUMNS + ProcedureTable.DURATION_COLUMNS:
+            value = getattr(procParams, name)
+            self.ints[name].append(int(value) if value else MISSING) # a Procedure treats every falsy cell as None
+        for name in ProcedureTable.READ_CATEGORY_COLUMNS:
+            codes = self.codes[name]
+            self.ints[name].append(codes.setdefault(getattr(procParams, name), len(codes)))
+        self.logNums.append(procParams.logNum)
+
+    def extend(self, columns):
+        """
+        Appends many procedures at once, without a ProcedureParams per procedure
+
+        Inputs:
+        columns - dict from 'date' to an array of date ordinals, from every time and duration column to an array of
+        values as they appear in the workbook (hhmm times, minute lengths, 0 for empty cells), from every category column
+        to an array of labels and from 'logNum' to an array of log numbers
+        """
+        for name in ProcedureTable.TIME_COLUMNS + ProcedureTable.DURATION_COLUMNS:
+            values = np.asarray(columns[name])
+            self.ints[name].fromstring(np.where(values == 0, MISSING, values).astype(np.int32).tostring())
+        self.ints['date'].fromstring(np.asarray(columns['date']).astype(np.int32).tostring())
+        for name in ProcedureTable.READ_CATEGORY_COLUMNS:
+            labels, inverse = np.unique(np.asarray(columns[name], dtype=object), return_inverse=True)
+            codes = self.codes[name]
+            labelCodes = np.array([codes.setdefault(label, len(codes)) for label in labels], dtype=np.int32)
+            self.ints[name].fromstring(labelCodes[inverse].tostring())
+        self.logNums.extend(np.asarray(columns['logNum']).tolist())
+
+    def build(self, source=None):
+        """
+        Returns a ProcedureTable of the procedures added so far, all tagged with source
+        """
+        columns = dict((name, np.frombuffer(values, dtype=np.int32).copy()) for name, values in self.ints.items())
+        for name in ProcedureTable.TIME_COLUMNS: # hhmm -> minutes since midnight
+            hhmm = columns[name]
+            columns[name] = np.where(hhmm == MISSING, MISSING, hhmm / 100 * 60 + hhmm % 100).astype(np.int32)
+        for name in ProcedureTable.READ_CATEGORY_COLUMNS:
+            columns[name] = columns[name].astype(np.int16)
+        columns['source'] = np.zeros(len(self.logNums), dtype=np.int16)
+        columns['logNum'] = np.array(self.logNums)
+        # A Procedure can't compare a missing time (None) with another, so a missing time never straddles midnight
+        inRoomKnown = columns['inRoom'] != MISSING
+        for name in ('outRoom', 'procEnd'):
+            columns[name + 'StraddledMidnight'] = inRoomKnown & (columns[name] != MISSING) & \
+                                                  (columns[name] < columns['inRoom'])
+        columns['flags'] = np.zeros(len(self.logNums), dtype=np.uint16)
+
+        categories = {}
+        for name, codes in self.codes.items():
+            labels = [None] * len(codes)
+            for label, code in codes.items():
+                labels[code] = label
+            categories[name] = labels
+        categories['source'] = [source]
+
+        return ProcedureTable(columns, categories)
+
+
+DURATION_RULES = (('schedLength', 'schedStart', 'schedEnd'), ('roomDuration', 'inRoom', 'outRoom'),
+                  ('procDuration', 'procStart', 'procEnd')) # length, start, end
+RULES = tuple('incorrect ' + length for length, _, _ in DURATION_RULES) + ('incorrect day',) + \
+        tuple('missing ' + name for name in ProcedureTable.TIME_COLUMNS + ProcedureTable.DURATION_COLUMNS + ('room',))
+# RULES[i] is bit i of ProcedureTable.flags
+
+
+def validateTable(procs):
+    """
+    Inputs:
+    procs - a ProcedureTable
+
+    Outputs:
+    A dict from every rule in RULES to a boolean array of the procedures failing it, computed over whole columns:
+    incorrect <length> - the length disagrees with its start and end times, wrapping past midnight when the end's
+    hour is earlier than the start's, as Procedure.durationsAreCorrect() checks. Only when all three are present
+    incorrect day - the weekday label isn't the date's, as Procedure.dayIsCorrect() checks
+    missing <field> - the cell was empty
+    """
+
+    violations = {}
+    for length, start, end in DURATION_RULES:
+        lengths, starts, ends = getattr(procs, length), getattr(procs, start), getattr(procs, end)
+        present = (lengths != MISSING) & (starts != MISSING) & (ends != MISSING)
+        calculated = ends - starts + 24 * 60 * (ends / 60 < starts / 60)
+        violations['incorrect ' + length] = present & (calculated != lengths)
+
+    weekdays = np.array([WEEKDAYS.get(label, -1) for label in procs.categories['day']] or [-1], dtype=np.int32)
+    violations['incorrect day'] = weekdays[procs.day] != (procs.date + 6) % 7 # ordinal 1 was a Monday
+
+    for name in ProcedureTable.TIME_COLUMNS + ProcedureTable.DURATION_COLUMNS:
+        violations['missing ' + name] = getattr(procs, name) == MISSING
+    emptyRooms = np.array([not label for label in procs.categories['room']] or [False], dtype=bool)
+    violations['missing room'] = emptyRooms[procs.room]
+    return violations
+
+
+class QualityReport(object):
+    """
+    Counts of the procedures failing each validation rule, overall and per room, with their log numbers
+    """
+
+    def __init__(self, procs, violations, source=None, policy='keep'):
+        """
+        Inputs:
+        procs - the ProcedureTable that was validated
+        violations - validateTable() of procs
+        source - the file procs were read from
+        policy - what was done with failing procedures, one of INVALID_POLICIES
+        """
+        self.source = source
+        self.policy = policy
+        self.procedures = len(procs)
+        self.flags = np.zeros(len(procs), dtype=np.uint16)
+        self.rules = {}
+        rooms = np.array(procs.categories['room'], dtype=object)
+        for bit, rule in enumerate(RULES):
+            failing = violations[rule]
+            self.flags |= failing.astype(np.uint16) << bit
+            roomCounts = np.bincount(procs.room[failing], minlength=len(rooms))
+            self.rules[rule] = {'count': int(failing.sum()),
+                                'rooms': dict((unicode(rooms[code]), int(roomCounts[code]))
+                                              for code in np.flatnonzero(roomCounts)),
+                                'logNums': procs.logNum[failing].tolist()}
+        self.flagged = int(np.count_nonzero(self.flags))
+
+    def merge(self, other):
+        """
+        Adds the counts of other, the report of more procedures of the same source, e.g. the next chunk of a file read in
+        chunks. flags stay those of this report's procedures
+        """
+        self.procedures += other.procedures
+        self.flagged += other.flagged
+        for rule, counts in other.rules.items():
+            self.rules[rule]['count'] += counts['count']
+            rooms = self.rules[rule]['rooms']
+            for room, count in counts['rooms'].items():
+                rooms[room] = rooms.get(room, 0) + count
+            self.rules[rule]['logNums'].extend(counts['logNums'])
+
+    def printSummary(self):
+        """
+        Prints one line per rule that procedures failed, instead of one per failing procedure
+        """
+        for rule in RULES:
+            count = self.rules[rule]['count']
+            if count:
+                print str(count) + " procedures with " + rule
+        if self.flagged:
+            action = {'keep': 'kept', 'flag': 'kept and flagged', 'drop': 'dropped'}[self.policy]
+            print str(self.flagged) + " of " + str(self.procedures) + " procedures failed validation and were " + action
+
+    def toDict(self):
+        return {'source': self.source, 'policy': self.policy, 'procedures': self.procedures, 'flagged': self.flagged,
+                'rules': self.rules}
+
+    def write(self, path):
+        """
+        Writes the report to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2, sort_keys=True, default=str)
+
+
+def iterSheetRows(sheet, minRow=1, maxRow=None, maxCol=None):
+    """
+    Inputs:
+    sheet - an openpyxl worksheet, read-only or regular
+    minRow, maxRow - 1-based sheet rows to start and finish at, inclusive. A maxRow of None reads to the end of the sheet
+    maxCol - last 1-based column to read. Shorter rows are padded with empty cells
+
+    Outputs:
+    A generator of tuples of cells. Rows past maxRow are never parsed, so on a read-only sheet memory stays flat and a
+    narrow row range loads in time proportional to where it ends, not to the size of the sheet.
+    """
+
+    try:
+        return sheet.iter_rows(min_row=minRow, max_row=maxRow, max_col=maxCol)
+    except TypeError: # openpyxl < 2.4 only takes range strings
+        from openpyxl.worksheet.read_only import ReadOnlyWorksheet
+        if not isinstance(sheet, ReadOnlyWorksheet): # regular sheets would create empty cells past the last row
+            maxRow = sheet.max_row if maxRow is None else min(maxRow, sheet.max_row)
+        return sheet.get_squared_range(1, minRow, maxCol, maxRow)
+
+
+def addReadingArguments(parser):
+    """
+    Adds the options of StatAggregator.fromArgs() to an argparse parser
+    """
+    parser.add_argument("--sorted", action="store_true", help="Rows are in chronological order, so stop reading once "
+                                                                "past the max date")
+    parser.add_argument("--full-load", action="store_true", help="Load the whole workbook into memory instead of "
+                                                                   "streaming rows")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the workbook, bypassing the cache of "
+                                                                  "parsed procedures")
+    parser.add_argument("--cache-dir", help="Directory of the cache of parsed procedures. Defaults to "
+                                            "$CHOPLOTTER_CACHE_DIR, then ~/.cache/choplotter")
+    parser.add_argument("--cache-size", type=float, help="Megabytes the cache of parsed procedures is evicted down to")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())),
+                        help="Format of the input file. Defaults to the one of its extension")
+    parser.add_argument("--invalid", choices=INVALID_POLICIES, default='keep',
+                        help="What to do with procedures failing validation: keep them, keep them with the rules they "
+                             "failed in the table's flags column, or drop them")
+    parser.add_argument("--quality-report", metavar="REPORT",
+                        help="Write counts of the procedures failing each validation rule, per room, and their log "
+                             "numbers to this JSON file. Bypasses the cache of parsed procedures")
+    parser.add_argument("--read-workers", type=int, help="Number of processes to read several files or sheets with. "
+                                                         "Defaults to one per file, up to the number of CPUs")
+
+
 class StatAggregator(object):
 
-    def __init__(self, excel, min = None , max = None):
+    def __init__(self, excel, min = None , max = None, streaming=True, sortedByDate=False, cache=None, format=None,
+                 startRow=1, invalid='keep', qualityReport=None, sheet=None, tag=None, chunkRows=None,
+                 startOffset=None):
+        """
+        Inputs:
+        excel - path to the workbook, CSV or Parquet file to read surgery data from
+        min, max - dates ('mm/dd/yy' format) or 1-based data row numbers bounding which procedures are loaded
+        streaming - open the workbook read-only, parsing rows lazily instead of loading the whole sheet into memory
+        sortedByDate - the sheet's rows are in chronological order, so reading can stop at the first row past max
+        cache - a parseCache.ParseCache to reuse the parsed procedures of an unchanged workbook from, or None
+        format - 'xlsx', 'csv' or 'parquet'. Defaults to the one of excel's extension
+        startRow - 1-based data row to start reading at, e.g. the row after those an earlier run already processed. min
+        and max still apply. Earlier rows aren't turned into procedures, but how much of the file is still read depends
+        on the format: a CSV file given startOffset seeks straight to the row, and a Parquet file only reads the row
+        groups from it on, but a workbook's sheet is parsed from its first row, as openpyxl can't seek, so reading the
+        last rows of a workbook takes time in proportion to the whole sheet
+        startOffset - byte offset of startRow in a CSV file, lastOffset of the read that stopped before it. The file is
+        read from the top instead if it isn't where a row starts. Other formats ignore it
+        invalid - what to do with procedures failing validation, one of INVALID_POLICIES. See checkTable()
+        qualityReport - path to write the QualityReport of the procedures read to, as JSON. The cache is only stored to,
+        not loaded from, as loading skips validation
+        sheet - name of the workbook's sheet to read. Defaults to the first
+        tag - label of the procedures' source column. Defaults to sourceTag() of excel and sheet
+        chunkRows - read a CSV file chunkRows dated rows at a time, as tables() is iterated, instead of into procs, for
+        files larger than memory. procs is then None. The cache is bypassed. Other formats are read whole
+
+        After reading, lastRow is the last data row that was read and had a date, lastOffset, for CSV files, the byte
+        offset just past it, and quality is the QualityReport of the procedures read. All are None if procs came from
+        the cache
+        """
+
+        format = fileFormat(excel, format)
+        if sheet is not None and format != 'xlsx':
+            raise ValueError(excel + ' has no sheets, only workbooks do')
+        tag = sourceTag(excel, sheet) if tag is None else tag
+        self.lastRow = None
+        self.lastOffset = None
+        self.quality = None
+        self.chunks = None
+        if chunkRows and format == 'csv':
+            self.procs = None
+            self.chunks = self.readCsvChunks(excel, min, max, sortedByDate, startRow, chunkRows, tag, invalid)
+            return
+        if cache:
+            key = cache.key(excel, min, max, sortedByDate, format, startRow, invalid, sheet, tag, startOffset)
+        if cache and not qualityReport:
+            start = time.clock()
+            with instrument.stage('cache load') as stage:
+                self.procs = cache.load(key)
+                stage.rows = len(self.procs) if self.procs is not None else 0
+            if self.procs is not None:
+                print "Loading cached procedures took " + str(time.clock() - start) + " seconds"
+                return
+
+        if format == 'csv':
+            procs = self.readCsv(excel, min, max, sortedByDate, startRow, startOffset)
+        elif format == 'parquet':
+            procs = self.readParquet(excel, min, max, startRow)
+        else:
+            procs = self.readWorkbook(excel, min, max, streaming, sortedByDate, startRow, sheet)
+        procs.categories['source'] = [tag]
+        self.procs = self.checkTable(procs, excel if sheet is None else excel + '#' + sheet, invalid, qualityReport)
+        if cache:
+            with instrument.stage('cache store', rows=len(self.procs)):
+                cache.store(key, self.procs)
+
+    @staticmethod
+    def fromArgs(args):
+        """
+        Returns a StatAggregator for parsed command line args holding filename, min, max and addReadingArguments()'
+        options. filename may be a list of files, globs and sheets, as multiSource.expandSources() takes, which are read
+        in parallel and merged into a multiSource.MultiSourceAggregator
+        """
+        import multiSource
+        import parseCache
+        cache = None if args.no_cache else parseCache.ParseCache(args.cache_dir, args.cache_size)
+        options = dict(min=args.min, max=args.max, streaming=not args.full_load, sortedByDate=args.sorted, cache=cache,
+                       format=args.format, invalid=args.invalid)
+        sources = multiSource.expandSources(args.filename)
+        if len(sources) == 1:
+            return StatAggregator(sources[0].path, sheet=sources[0].sheet, tag=sources[0].tag,
+                                  qualityReport=args.quality_report, **options)
+        return multiSource.MultiSourceAggregator(sources, workers=args.read_workers, qualityReport=args.quality_report,
+                                                 **options)
+
+    def tables(self):
+        """
+        Returns an iterator over the procedures read, as ProcedureTables: each chunk of a file read with chunkRows, or
+        procs alone. Chunks are read as they're iterated over, so only once
+        """
+        return self.chunks if self.procs is None else iter([self.procs])
+
+    def checkTable(self, procs, source, invalid='keep', qualityReport=None, summary=True):
+        """
+        Inputs:
+        procs - a ProcedureTable of every dated row read, before validation
+        source - the file procs were read from
+        invalid - what to do with procedures failing validation: 'keep' them, as if they were valid, keep them and
+        'flag' them with the rules they failed in procs.flags, or 'drop' them
+        qualityReport - path to write the QualityReport of procs to, or None
+        summary - print the QualityReport's summary
+
+        Outputs:
+        A ProcedureTable of the procedures with a scheduled start, after applying invalid. The QualityReport is kept in
+        self.quality
+        """
+
+        with instrument.stage('validation', rows=len(procs)):
+            self.quality = QualityReport(procs, validateTable(procs), source, invalid)
+        if summary:
+            self.quality.printSummary()
+        if qualityReport:
+            self.quality.write(qualityReport)
+
+        keep = procs.schedStart != MISSING # disregard procs without scheduled start times
+        if invalid == 'drop':
+            keep &= self.quality.flags == 0
+        elif invalid == 'flag':
+            procs.flags = self.quality.flags
+        return procs.take(keep)
 
+    def readWorkbook(self, excel, min, max, streaming, sortedByDate, startRow=1, sheet=None):
+
+        import openpyxl # a quarter second to import, so CSV, Parquet and cached reads don't
         start = time.clock()
-        wb = openpyxl.load_workbook(excel)
-        sheet = wb.worksheets[0]
+        with instrument.stage('workbook load'):
+            wb = openpyxl.load_workbook(excel, read_only=streaming)
+            if sheet is None:
+                sheet = wb.worksheets[0]
+            elif sheet in wb.sheetnames:
+                sheet = wb[sheet]
+            else:
+                raise ValueError(excel + ' has no sheet ' + sheet + ', only ' + ', '.join(wb.sheetnames))
         finish = time.clock()
         print "Loading workbook took " + str(finish - start) + " seconds"
 
         # check if -m and -M args were row nums or dates
-        rowArgs = False
-        dateArgs = False
-        try:
-            minRow = int(min) if min else -float("inf")
-            maxRow = int(max) if max else float("inf")
-            rowArgs = True
-        except ValueError:
-            minDate = dt.datetime.strptime(min, '%m/%d/%y') if min else dt.date(dt.MINYEAR,1,1) # TODO: Should probably check if valid str
-            maxDate = dt.datetime.strptime(max, '%m/%d/%y') if max else dt.date(dt.MAXYEAR,1,1)
-            dateArgs = True
-
-        self.procs = []
-        self.dates = []
-
-        for i, row in enumerate(sheet.rows[1:]): # skip first row of data labels
-            params = ProcedureParams(row)
-            if dateArgs and (params.date and params.date >= minDate and params.date <= maxDate)\
-                    or rowArgs and (params.date and i+1 >= minRow and i+1 <=maxRow): # +1 because data starts on 2nd row
-                proc = Procedure(params)
-
-                if proc.schedStart: # disregard procs without scheduled start times
-                    self.procs.append(proc)
-                    # self.delayedStarts.append(proc.delayedStart)
-                    self.dates.append(proc.date)
+        minRow, maxRow, minDate, maxDate = parseRange(min, max)
+        rowArgs = minDate is None
+        dateArgs = not rowArgs
+
+        procs = ProcedureTableBuilder()
+
+        # Data row i lives on sheet row i+1, below the row of data labels. Only the requested rows become procedures,
+        # though openpyxl still reads the sheet's XML from the top to get to them
+        firstRow = minRow if rowArgs and minRow > startRow else startRow
+        firstSheetRow = firstRow + 1
+        lastSheetRow = maxRow + 1 if rowArgs and maxRow is not None else None
+        self.lastRow = firstRow - 1
+        rows = iterSheetRows(sheet, minRow=firstSheetRow, maxRow=lastSheetRow, maxCol=NUM_COLUMNS)
+        if lastSheetRow is not None and firstSheetRow > lastSheetRow:
+            rows = []
+
+        # Rows are only parsed here. They're validated together, over whole columns, by checkTable()
+        with instrument.stage('row parsing') as stage:
+            parsed = 0
+            for row in rows:
+                params = ProcedureParams(row)
+                parsed += 1
+                if dateArgs and sortedByDate and params.date and params.date > maxDate:
+                    break # every remaining row is later still
+                if params.date:
+                    self.lastRow = firstRow - 1 + parsed
+                if dateArgs and (params.date and params.date >= minDate and params.date <= maxDate)\
+                        or rowArgs and params.date:
+                    procs.append(params)
+            stage.rows = parsed
+
+        with instrument.stage('table build', rows=len(procs)):
+            return procs.build()
+
+    def readCsv(self, path, min, max, sortedByDate, startRow=1, startOffset=None):
+        """
+        Reads procedures from a CSV file with a header row naming the FIELDS columns, in any order. Cells hold what the
+        workbook's do, with dates in one of DATE_FORMATS
+        """
+
+        with instrument.stage('row parsing') as stage:
+            rows = list(self.csvRows(path, min, max, sortedByDate, startRow, startOffset))
+            columns = self.csvColumns(rows)
+            stage.rows = len(rows)
+
+        return self.tableFromColumns(columns)
+
+    def readCsvChunks(self, path, min, max, sortedByDate, startRow, chunkRows, tag, invalid='keep'):
+        """
+        Generator version of readCsv(), yielding a validated table of every chunkRows dated rows in range, so that only
+        one chunk of the file is ever in memory. Yields at least one table, empty if no row is in range
+        """
+
+        rows = self.csvRows(path, min, max, sortedByDate, startRow)
+        quality = None
+        while True:
+            with instrument.stage('row parsing') as stage:
+                chunk = list(itertools.islice(rows, chunkRows))
+                columns = self.csvColumns(chunk)
+                stage.rows = len(chunk)
+            procs = self.tableFromColumns(columns)
+            procs.categories['source'] = [tag]
+            procs = self.checkTable(procs, path, invalid, summary=False)
+            if quality is None:
+                quality = self.quality
+            else:
+                quality.merge(self.quality)
+            if len(chunk) < chunkRows: # the last chunk, so the whole file's report is complete
+                self.quality = quality
+                quality.printSummary()
+                yield procs
+                return
+            yield procs
+
+    def csvRows(self, path, min, max, sortedByDate, startRow=1, startOffset=None):
+        """
+        Yields the FIELDS values of every dated row in range of a CSV file, as read, except for dates, which are
+        ordinals. Keeps lastRow and lastOffset up to date. Seeks to startOffset, the byte offset of startRow, if given
+        """
+
+        minRow, maxRow, minDate, maxDate = parseRange(min, max)
+        firstRow = minRow if minDate is None and minRow > startRow else startRow
+        self.lastRow = firstRow - 1
+        with open(path, 'rb') as f:
+            reader = csv.reader(iter(f.readline, '')) # unlike iterating f, keeps f.tell() just past the last row read
+            indices = matchColumns(next(reader))
+            fieldIndices = [indices[field] for field in FIELDS]
+            self.lastOffset = f.tell() if firstRow == 1 else None
+            skipped = 0 # data rows before the reader's first
+            if startOffset is not None and firstRow == startRow and startOffset > f.tell():
+                f.seek(startOffset - 1)
+                if f.read(1) == '\n': # where a row starts, as the file was only appended to since
+                    skipped, self.lastOffset = startRow - 1, startOffset
+                else:
+                    f.seek(0)
+                    next(reader) # the header, again
+            reader = itertools.islice(reader, firstRow - 1 - skipped, None if maxRow is None else
+                                      (maxRow if maxRow >= firstRow else firstRow - 1) - skipped)
+
+            ordinals = {} # date string -> ordinal, as a file has far fewer dates than rows
+            for rowNum, row in enumerate(reader, firstRow):
+                values = [row[i] for i in fieldIndices]
+                if not values[0]:
+                    continue
+                ordinal = ordinals.get(values[0])
+                if ordinal is None:
+                    ordinal = ordinals[values[0]] = parseDate(values[0]).toordinal()
+                if minDate is not None:
+                    if sortedByDate and ordinal > maxDate.toordinal():
+                        break # every remaining row is later still
+                    self.lastRow, self.lastOffset = rowNum, f.tell()
+                    if not minDate.toordinal() <= ordinal <= maxDate.toordinal():
+                        continue
+                self.lastRow, self.lastOffset = rowNum, f.tell()
+                values[0] = ordinal
+                yield values
+
+    @staticmethod
+    def csvColumns(rows):
+        """
+        Returns the columns tableFromColumns() takes of rows of csvRows()
+        """
+        columns = dict(zip(FIELDS, map(list, zip(*rows)))) if rows else dict((field, []) for field in FIELDS)
+        for field in FIELDS[2:12]: # times and durations
+            columns[field] = [int(float(value)) if value else None for value in columns[field]]
+        columns['logNum'] = [int(value) if value.isdigit() else value for value in columns['logNum']]
+        return columns
+
+    def readParquet(self, path, min, max, startRow=1):
+        """
+        Reads procedures from a Parquet file with columns named like FIELDS, in any order. Only the FIELDS columns are
+        read, and only the row groups that can hold the requested rows: by row count for row bounds, by the date
+        column's min and max statistics for date bounds
+        """
+
+        pyarrow, parquet = importParquet()
+        minRow, maxRow, minDate, maxDate = parseRange(min, max)
+        firstRow = minRow if minDate is None and minRow > startRow else startRow
+
+        with instrument.stage('row parsing') as stage:
+            parquetFile = parquet.ParquetFile(path)
+            metadata = parquetFile.metadata
+            names = parquetFile.schema.names
+            indices = matchColumns(names)
+            projection = [names[indices[field]] for field in FIELDS]
+
+            groups = range(parquetFile.num_row_groups)
+            groupStarts = np.cumsum([0] + [metadata.row_group(g).num_rows for g in groups])
+            lastRow = maxRow if maxRow is not None and maxRow < groupStarts[-1] else groupStarts[-1]
+            groups = [g for g in groups if groupStarts[g] < lastRow and groupStarts[g + 1] >= firstRow]
+            self.lastRow = int(lastRow if lastRow >= firstRow else firstRow - 1)
+            if minDate is not None:
+                kept = []
+                for g in groups:
+                    column = metadata.row_group(g).column(indices['date'])
+                    statistics = column.statistics
+                    if statistics is not None and statistics.has_min_max:
+                        logicalType = getattr(statistics, 'logical_type', None)
+                        first = statisticOrdinal(statistics.min, logicalType)
+                        last = statisticOrdinal(statistics.max, logicalType)
+                        if first is not None and last is not None and \
+                                (last < minDate.toordinal() or first > maxDate.toordinal()):
+                            continue # no date of this group is in range
+                    kept.append(g)
+                groups = kept
+
+            if groups:
+                table = parquetFile.read_row_groups(groups, columns=projection)
+                columns = dict((field, table.column(names[indices[field]]).to_pylist()) for field in FIELDS)
+            else:
+                columns = dict((field, []) for field in FIELDS)
+            rowNums = [n for g in groups for n in xrange(groupStarts[g] + 1, groupStarts[g + 1] + 1)]
+
+            # Dates as ordinals, dropping rows without one, and rows out of range in the kept groups
+            ordinals = {}
+            for value in set(columns['date']):
+                ordinals[value] = parseDate(value).toordinal() if value else None
+            dates = [ordinals[value] for value in columns['date']]
+            inRows = [firstRow <= n <= lastRow for n in rowNums]
+            if minDate is None:
+                keep = [d is not None and r for d, r in zip(dates, inRows)]
+            else:
+                keep = [d is not None and r and minDate.toordinal() <= d <= maxDate.toordinal()
+                        for d, r in zip(dates, inRows)]
+            columns['date'] = dates
+            for field in FIELDS:
+                columns[field] = list(itertools.compress(columns[field], keep))
+            stage.rows = len(columns['date'])
+
+        return self.tableFromColumns(columns)
+
+    @staticmethod
+    def tableFromColumns(columns):
+        """
+        Inputs:
+        columns - dict from every name in FIELDS to a list of values as ProcedureParams holds them, except for dates,
+        which are ordinals. Every row is in range and has a date
+
+        Outputs:
+        A ProcedureTable of the procedures, to be validated by checkTable()
+        """
+
+        with instrument.stage('table build', rows=len(columns['date'])):
+            arrays = {}
+            for field in FIELDS:
+                if field in ProcedureTable.CATEGORY_COLUMNS or field == 'logNum':
+                    values = np.empty(len(columns[field]), dtype=object)
+                    values[:] = columns[field]
+                    if field == 'logNum' and all(isinstance(v, (int, long)) for v in columns[field]):
+                        values = values.astype(np.int64)
+                else:
+                    values = np.array([value or 0 for value in columns[field]], dtype=np.int64)
+                arrays[field] = values
+            builder = ProcedureTableBuilder()
+            builder.extend(arrays)
+            return builder.build()
+
+    @property
+    def dates(self):
+        return [dt.datetime.fromordinal(int(d)) for d in self.procs.date]
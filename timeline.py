@@ -0,0 +1,370 @@
+"""
+Timeline of every room's procedures over days, weeks, months or years at once, zoomed and panned like any matplotlib
+plot, with the toolbar or the keyboard.
+
+Zoomed out, each room is a row of an occupancy heatmap: the fraction of every bin of time that the room was occupied,
+from in room to out of room, with bins as fine as the window allows, from 5 minutes to a week. Zoomed in to at most
+DETAIL_PROCEDURES procedures, each is drawn as dayPlot() draws it, with bars of its scheduled, in room and procedure
+times. Both come from IntervalIndexes built once, so a redraw only looks up the window shown: the procedures
+overlapping it, by binary search, and the occupied minutes of every bin, from prefix sums. Bars are three
+PolyCollections and the heatmap one image, all updated in place.
+
+Keys: left and right pan by half the window, up and down zoom in and out by a factor of 2, home shows everything.
+
+For example, python timeline.py report.xlsx -m 1 -M 100000 --from 01/04/16 --to 01/31/16 --rooms "OR 0*"
+"""
+
+import argparse
+import datetime as dt
+import fnmatch
+
+import numpy as np
+
+import calculateIdles as ci
+import dayPlot as dp
+import instrument
+import statAggregator as sa
+
+BARS = (('schedStart', 'schedLength'), ('inRoom', 'roomDuration'), ('procStart', 'procDuration')) # in dp.COLORS order
+BAR_OFFSETS = (dp.BAR_WIDTH + 1, (dp.BAR_WIDTH + 1) * 2, (dp.BAR_WIDTH + 1) * 2) # of each bar above its room's row
+DETAIL_PROCEDURES = 5000 # most procedures drawn one by one. Wider windows are drawn as a heatmap
+BIN_MINUTES = (5, 15, 30, 60, 120, 240, 480, 1440, 10080) # heatmap bin widths, the finest that fits MAX_BINS is used
+MAX_BINS = 1000 # most heatmap bins across the window
+HEATMAP_COLORS = 'YlOrRd'
+
+
+class IntervalIndex(object):
+    """
+    Intervals of absolute minutes, each in one room, sorted by room and then start. The intervals overlapping a window
+    are found by binary search, and the minutes of each room covered by intervals before any time from prefix sums of
+    the sorted starts and ends, so neither visits intervals outside the window.
+
+    Times are minutes since base, so that a room and a time fit one sorted int64 key, room * span + time.
+    """
+
+    def __init__(self, rooms, starts, ends, numRooms):
+        """
+        Inputs:
+        rooms - room code of every interval, from 0 to numRooms - 1
+        starts, ends - int64 absolute minutes of every interval, from its start up to its end, with ends >= starts
+        numRooms - number of room codes
+        """
+
+        self.numRooms = numRooms
+        self.base = int(starts.min()) if len(starts) else 0
+        self.span = int(ends.max()) - self.base + 1 if len(ends) else 1
+        self.order = np.lexsort((starts, rooms)) # interval of every position
+        rooms = rooms[self.order].astype(np.int64)
+        starts = starts[self.order] - self.base
+        self.ends = ends[self.order] - self.base
+        self.roomStarts = np.searchsorted(rooms, np.arange(numRooms + 1)) # first position of every room
+        self.startKeys = rooms * self.span + starts
+        self.endKeys = np.sort(rooms * self.span + self.ends) # rooms stay in order, each room's ends get sorted
+        self.startSums = np.concatenate(([0], np.cumsum(starts)))
+        self.endSums = np.concatenate(([0], np.cumsum(self.endKeys - rooms * self.span)))
+
+        lengths = self.ends - starts
+        self.maxLengths = np.zeros(numRooms, dtype=np.int64) # longest interval of every room
+        nonEmpty = np.flatnonzero(np.diff(self.roomStarts))
+        if len(nonEmpty):
+            self.maxLengths[nonEmpty] = np.maximum.reduceat(lengths, self.roomStarts[nonEmpty])
+
+    def __len__(self):
+        return len(self.order)
+
+    def bounds(self, start, end):
+        """
+        Returns the first and stop positions of every room's intervals that start before end and no more than its longest
+        interval before start, the only ones that can overlap [start, end)
+        """
+        codes = np.arange(self.numRooms, dtype=np.int64)
+        first = np.searchsorted(self.startKeys, codes * self.span + np.clip(start - self.base - self.maxLengths, 0,
+                                                                           self.span))
+        stop = np.searchsorted(self.startKeys, codes * self.span + np.clip(end - self.base, 0, self.span))
+        return first, stop
+
+    def candidates(self, start, end):
+        """
+        Returns how many intervals overlapping() checks for [start, end), at least as many as overlap it
+        """
+        first, stop = self.bounds(start, end)
+        return int((stop - first).sum())
+
+    def overlapping(self, start, end):
+        """
+        Returns the intervals, as indices into the arrays the index was built from, overlapping [start, end)
+        """
+        first, stop = self.bounds(start, end)
+        lengths = stop - first
+        positions = np.repeat(first - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        positions = positions[self.ends[positions] > start - self.base]
+        return self.order[positions]
+
+    def coveredBefore(self, times):
+        """
+        Returns a rooms x times array of the minutes of each room covered by its intervals before each absolute time. An
+        interval covers min(max(time - start, 0), end - start) minutes, which adds up to the time by the number of
+        starts before it less their sum, less the same of the ends before it
+        """
+        times = np.clip(np.asarray(times, dtype=np.int64) - self.base, 0, self.span - 1)
+        keys = np.arange(self.numRooms, dtype=np.int64)[:, None] * self.span + times[None, :]
+        first = self.roomStarts[:-1, None]
+        starts = np.searchsorted(self.startKeys, keys)
+        ends = np.searchsorted(self.endKeys, keys)
+        return times * (starts - ends) - (self.startSums[starts] - self.startSums[first]) + \
+            (self.endSums[ends] - self.endSums[first])
+
+    def occupancy(self, edges):
+        """
+        Returns a rooms x bins array of the minutes of each room covered by its intervals in each bin between edges
+        """
+        return np.diff(self.coveredBefore(edges), axis=1)
+
+
+def binMinutes(minutes, maxBins=MAX_BINS):
+    """
+    Returns the finest of BIN_MINUTES that splits a window of minutes into at most maxBins bins, or the coarsest
+    """
+    for width in BIN_MINUTES:
+        if minutes <= width * maxBins:
+            return width
+    return BIN_MINUTES[-1]
+
+
+class Timeline(object):
+    """
+    IntervalIndexes of a ProcedureTable's procedures, to draw any window of time of every room from
+    """
+
+    def __init__(self, procs, rooms=None):
+        """
+        Inputs:
+        procs - a ProcedureTable, in any order
+        rooms - fnmatch pattern of the rooms to show, e.g. 'OR 0[3-7]'. Defaults to every room with procedures
+        """
+
+        with instrument.stage('timeline index', rows=len(procs)):
+            names = procs.categories['room']
+            codes = [code for code in np.unique(procs.room).tolist() if rooms is None or
+                     fnmatch.fnmatchcase(unicode(names[code]), unicode(rooms))]
+            codes.sort(key=lambda code: names[code])
+            self.roomNames = [names[code] for code in codes]
+            rowOf = np.full(len(names) or 1, -1, dtype=np.int64)
+            rowOf[codes] = np.arange(len(codes))
+            self.rows = rowOf[procs.room]
+            procs = procs.take(self.rows >= 0)
+            self.rows = self.rows[self.rows >= 0]
+
+            # Bars missing a time or a length have no length, at the scheduled start, which every procedure has, so are
+            # neither drawn nor counted as occupied
+            day = procs.date.astype(np.int64) * ci.MINUTES_PER_DAY
+            self.starts, self.ends = [], []
+            for start, length in BARS:
+                starts, lengths = getattr(procs, start), getattr(procs, length)
+                valid = (starts != sa.MISSING) & (lengths > 0)
+                self.starts.append(day + np.where(valid, starts, procs.schedStart))
+                self.ends.append(self.starts[-1] + np.where(valid, lengths, 0))
+
+            # A procedure is drawn when any of its bars is in the window
+            first = np.minimum.reduce(self.starts)
+            last = np.maximum.reduce(self.ends)
+            self.procedures = IntervalIndex(self.rows, first, last, len(codes))
+            self.occupied = IntervalIndex(self.rows, self.starts[1], self.ends[1], len(codes))
+            self.first, self.last = (int(first.min()), int(last.max())) if len(procs) else (0, ci.MINUTES_PER_DAY)
+
+    def frame(self, start, end, maxBins=MAX_BINS):
+        """
+        Returns what timelinePlot() draws for the window of absolute minutes [start, end): a dict of its mode, 'detail'
+        with the corners of every scheduled, in room and procedure bar overlapping it as (bars, 4, 2) arrays of days and
+        y, as dayFrame() has them, or 'heatmap' with a rooms x bins array of the fraction of each bin a room was occupied
+        and the bins' edges, in days
+        """
+
+        start, end = int(start), int(max(end, start + 1))
+        if self.procedures.candidates(start, end) <= DETAIL_PROCEDURES:
+            procedures = self.procedures.overlapping(start, end)
+            bars = []
+            for starts, ends, offset in zip(self.starts, self.ends, BAR_OFFSETS):
+                x0 = starts[procedures] / float(ci.MINUTES_PER_DAY)
+                x1 = ends[procedures] / float(ci.MINUTES_PER_DAY)
+                y0 = (dp.BAR_SPACING * self.rows[procedures] + offset).astype(float)
+                y1 = y0 + dp.BAR_WIDTH
+                bars.append(np.dstack((np.column_stack((x0, x0, x1, x1)), np.column_stack((y0, y1, y1, y0)))))
+            return {'mode': 'detail', 'bars': bars, 'procedures': len(procedures)}
+
+        width = binMinutes(end - start, maxBins)
+        edges = np.arange(start // width * width, end + width, width)
+        occupancy = self.occupied.occupancy(edges) / float(width)
+        return {'mode': 'heatmap', 'occupancy': occupancy, 'edges': edges / float(ci.MINUTES_PER_DAY),
+                'binMinutes': width}
+
+
+def timelinePlot(ax, timeline, frame, artists=None):
+    """
+    Draws frame, a Timeline.frame() of timeline, on ax, updating artists, what an earlier call on ax returned, in
+    place. Only bars or the heatmap are shown, the other is hidden. The view isn't changed, ax is left as zoomed
+
+    Outputs:
+    artists - to pass to the next call on ax
+    """
+
+    import matplotlib.dates as mdates
+    if artists is None:
+        from matplotlib.collections import PolyCollection
+        offset = mdates.date2num(dt.datetime.fromordinal(1)) - 1 # matplotlib's day of ordinal 0
+        numRooms = len(timeline.roomNames)
+        bottom = (dp.BAR_WIDTH + 1) * 2 - dp.BAR_SPACING / 2.0 # heatmap rows are centered on their room's ticks
+        ax.set_autoscale_on(False) # so that updating the image's extent doesn't move the view
+        image = ax.imshow(np.zeros((max(numRooms, 1), 1)), extent=(0, 1, bottom, bottom + numRooms * dp.BAR_SPACING),
+                          origin='lower', aspect='auto', interpolation='nearest', cmap=HEATMAP_COLORS, vmin=0, vmax=1)
+        artists = {'offset': offset, 'image': image, 'mode': None,
+                   'bars': [ax.add_collection(PolyCollection([], facecolors=color), autolim=False)
+                            for color in dp.COLORS]}
+        ax.figure.colorbar(image, ax=ax, label='Fraction of time occupied')
+        ax.set_ylim(0, numRooms * dp.BAR_SPACING + (dp.BAR_WIDTH + 1) * 3)
+        ax.set_yticks([dp.BAR_SPACING * i + (dp.BAR_WIDTH + 1) * 2 for i in range(numRooms)])
+        ax.set_yticklabels(timeline.roomNames)
+        ax.set_ylabel('Room')
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
+        ax.grid(True, axis='x')
+
+    offset = artists['offset']
+    if frame['mode'] == 'detail':
+        for collection, bars in zip(artists['bars'], frame['bars']):
+            collection.set_verts(bars + [offset, 0])
+        title = str(frame['procedures']) + ' procedures'
+    else:
+        edges = frame['edges'] + offset
+        image = artists['image']
+        image.set_data(frame['occupancy'])
+        image.set_extent((edges[0], edges[-1]) + tuple(image.get_extent()[2:]))
+        title = 'Occupancy per ' + binLabel(frame['binMinutes'])
+    if frame['mode'] != artists['mode']:
+        artists['image'].set_visible(frame['mode'] == 'heatmap')
+        for collection in artists['bars']:
+            collection.set_visible(frame['mode'] == 'detail')
+        artists['mode'] = frame['mode']
+    ax.set_title(title)
+    return artists
+
+
+def binLabel(minutes):
+    if minutes % 10080 == 0:
+        return 'week'
+    if minutes % 1440 == 0:
+        return 'day'
+    if minutes % 60 == 0:
+        return str(minutes / 60) + ' hours' if minutes > 60 else 'hour'
+    return str(minutes) + ' minutes'
+
+
+class TimelineView(object):
+    """
+    A Timeline drawn on a matplotlib axes, redrawn for the window shown whenever it's zoomed or panned
+    """
+
+    def __init__(self, timeline, ax, start=None, end=None):
+        """
+        Inputs:
+        timeline - a Timeline
+        ax - axes to draw on
+        start, end - absolute minutes of the window to show first. Default to the first and last procedure's
+        """
+        self.timeline = timeline
+        self.ax = ax
+        self.artists = None
+        self.updating = False
+        start = timeline.first if start is None else start
+        end = timeline.last if end is None else end
+        self.update(start, end)
+        ax.callbacks.connect('xlim_changed', self.zoomed)
+        ax.figure.canvas.mpl_connect('key_press_event', self.keyPressed)
+
+    def window(self):
+        """
+        Returns the absolute minutes of the window shown
+        """
+        x0, x1 = self.ax.get_xlim()
+        return [int(round((x - self.artists['offset']) * ci.MINUTES_PER_DAY)) for x in (x0, x1)]
+
+    def update(self, start, end):
+        """
+        Draws [start, end), in absolute minutes
+        """
+        with instrument.stage('timeline frame', rows=1):
+            frame = self.timeline.frame(start, end)
+            self.artists = timelinePlot(self.ax, self.timeline, frame, self.artists)
+            self.updating = True # setting the view calls zoomed()
+            try:
+                offset = self.artists['offset']
+                self.ax.set_xlim((start / float(ci.MINUTES_PER_DAY) + offset, end / float(ci.MINUTES_PER_DAY) + offset))
+            finally:
+                self.updating = False
+        self.ax.figure.canvas.draw_idle()
+
+    def zoomed(self, ax):
+        if not self.updating:
+            self.update(*self.window())
+
+    def keyPressed(self, e):
+        start, end = self.window()
+        length = end - start
+        if e.key == 'right':
+            start, end = start + length / 2, end + length / 2
+        elif e.key == 'left':
+            start, end = start - length / 2, end - length / 2
+        elif e.key == 'up':
+            start, end = start + length / 4, end - length / 4
+        elif e.key == 'down':
+            start, end = start - length / 2, end + length / 2
+        elif e.key == 'home':
+            start, end = self.timeline.first, self.timeline.last
+        else:
+            return
+        self.update(start, end)
+
+
+def parseInputs():
+    parser = argparse.ArgumentParser(description="Browse every room's procedures over weeks or months at once, as "
+                                                 "an occupancy heatmap when zoomed out and procedure by procedure when "
+                                                 "zoomed in")
+    parser.add_argument("filename", nargs='+', help="Excel, CSV or Parquet files to read surgery data from, as "
+                                                    "[TAG=]PATH[#SHEET]. PATH may be a glob, SHEET * for every sheet, "
+                                                    "and TAG labels the source")
+    parser.add_argument("-m", "--min", help="Date ('mm/dd/yy' format) or row to start processing excel data. If row, 1"
+                                            " refers to first row containing data, not necessarily first row of excel sheet",
+                        required=True)
+    parser.add_argument("-M", "--max", help="Date ('mm/dd/yy' format) or row to finish processing excel data. If row, 1",
+                        required=True)
+    parser.add_argument("--rooms", help="Only show rooms matching this pattern, e.g. 'OR 0[3-7]'")
+    parser.add_argument("--from", dest="start", help="First day to show ('mm/dd/yy' format). Defaults to the first "
+                                                     "procedure's")
+    parser.add_argument("--to", dest="end", help="Last day to show ('mm/dd/yy' format). Defaults to the last "
+                                                 "procedure's")
+    parser.add_argument("--save", metavar="IMAGE", help="Save the first window to this image instead of showing it")
+    sa.addReadingArguments(parser)
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.fromArgs(args)
+
+    excel = sa.StatAggregator.fromArgs(args)
+    timeline = Timeline(excel.procs, args.rooms)
+    start = sa.parseDate(args.start).toordinal() * ci.MINUTES_PER_DAY if args.start else None
+    end = (sa.parseDate(args.end).toordinal() + 1) * ci.MINUTES_PER_DAY if args.end else None
+
+    if args.save:
+        import matplotlib
+        matplotlib.use('Agg') # render without a display. Must come before pyplot is first imported
+    plt = ci.pyplot()
+    fig = plt.figure(figsize=(14, max(4, 0.3 * len(timeline.roomNames) + 2)))
+    view = TimelineView(timeline, fig.add_subplot(111), start, end)
+    if args.save:
+        fig.savefig(args.save)
+    else:
+        plt.show()
+    return view
+
+if __name__ == "__main__":
+    parseInputs()